@@ -1,308 +1,894 @@
 #1 Import Statements ------------------------------
 
 import os
+import sys
+import csv
+import json
+import errno
 import shutil
+import mmap
+import struct
+import sqlite3
+import math
+import time
+import asyncio
+import argparse
+import contextlib
+import cProfile
+import pstats
+import fnmatch
+import re
+import tempfile
+import threading
 import exifread
 import piexif
 import hashlib
 import string
-import cv2
-from datetime import datetime
-from opencage.geocoder import OpenCageGeocode
+import numpy as np
+import backoff
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# cv2 and the opencage package (with requests) take most of the start-up time, so they are imported by the functions
+# using them: runs without quality checks or with another geocoder don't load them
 
 #2 Constants and Global Variables -----------------
 
-# Prompt the user to enter the source folder
-source_folder = input("Enter the path to the folder containing unstructured photos/videos: ")
-# source_folder = "xyz" # set a fixed source folder if convenient
+# File extensions treated as photos or videos (you can customize the extensions as per your file types)
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.mp4', '.avi', '.mov','.tiff', '.tif', '.m4v', '.3gp')
 
-# Prompt the user to enter the destination folder
-destination_folder = input("Enter the path to the folder where the organized tree will be created: ")
-# destination_folder = "xyz" # set a fixed destination folder if convenient
+# Stages of the pipeline, timed separately for the stage report and the summary. size_index is the first walk of the
+# source folder, which groups the files by size before the walk that processes them.
+STAGES = ('size_index', 'walk', 'hash', 'exif', 'quality', 'geocode', 'rename', 'move')
 
-# Dictionary to keep track of the photo count for each camera on a given day
-photo_count = {}
+# Folder name patterns never walked into: thumbnail caches of NAS and desktop tools, and system folders
+PRUNED_FOLDERS = ['.thumbnails', '@eaDir', '.@__thumb', '.AppleDouble', '.Spotlight-V100', '.fseventsd', '.Trash-*',
+                  '$RECYCLE.BIN', 'System Volume Information']
 
-# Initialize files_not_moved as an empty list
-files_not_moved = []
+# Number of media files that go through the pipeline stages together
+BATCH_SIZE = 256
 
-# Count of files that were not moved
-files_not_moved_count = 0
+# Default mean gray level (from 0 to 255) below which images are low quality
+DEFAULT_BRIGHTNESS_THRESHOLD = 25
 
-# Create a dictionary of file hashes that will be used to handle file duplications
-file_hashes = {}
+# Size the images are scaled to before computing sharpness and clipping, so that the thresholds don't depend on the
+# resolution of the images
+QUALITY_IMAGE_SIZE = (256, 192)
 
-# OpenCage Geocoder API key
-opencage_api_key = input("Enter your OpenCage API Key. Visit https://opencagedata.com/ to create one: ")
-# opencage_api_key = 'xyz' # set a fixed opencage API if convinient
+# Number of images scored together by a worker process
+QUALITY_CHUNK_SIZE = 32
 
-# Create a dictionary to store city names for non-JPEG/TIFF files
-city_names_temp = {}
+# Largest difference between a reduced-size brightness estimate and the full-resolution brightness (measured at
+# about 1.5 for 1/8 decodes and 0.2 for thumbnails); estimates closer than this to the threshold are decoded in full
+BRIGHTNESS_TOLERANCE = 2.0
 
-#3 Function Definitions ------------------------------
+# Number of bytes hashed at the start and at the end of a file before falling back to a full hash
+PARTIAL_HASH_SIZE = 4 * 1024 * 1024
 
-# Recursive function to process files in a directory and its sub-directories
-def process_files(directory):
-    global files_not_moved_count
-    global files_not_moved
+# Distance in km beyond which GeoNamesBackend considers a location to be outside of any city
+MAX_CITY_DISTANCE_KM = 50
 
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
+# Mean radius of the Earth in km
+EARTH_RADIUS_KM = 6371.0
 
-        # Check if the file is a photo or video file (you can customize the extensions as per your file types)
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.mp4', '.avi', '.mov','.tiff', '.tif')):
+# Default size in degrees of the grid cells sharing a geocoding result (0.01 degrees is about 1 km)
+DEFAULT_GEOCODE_GRID = 0.01
 
-            # Calculate the hash of the file content
-            file_hash = hash_file(file_path)
+# Number of grid cells whose city names are kept in memory, least recently used first
+GEOCODE_CACHE_SIZE = 10000
 
-            # Check if the file is a duplicate based on content
-            if file_hash in file_hashes:
-                # Remove the duplicate file
-                try:
-                    os.remove(file_path)
-                    print(f"Removed duplicate file: {file_path}")
-                    # Log the deleted file in the files_not_moved list
-                    files_not_moved.append((filename, "Duplicate - Removed"))
-                except FileNotFoundError:
-                    # If the file was already deleted (e.g., by a previous iteration), just continue to the next file
-                    pass                
-            else:
-                # Add the file to the dictionary with its hash as the key
-                if file_hash in file_hashes:
-                    file_hashes[file_hash].append(file_path)
-                else:
-                    file_hashes[file_hash] = [file_path]
-                
-                # Assess image quality and remove low-quality images
-                if filename.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):                                                      
-                    if is_low_quality_image(file_path):
-                        try:
-                            reason = "Low Quality"
-                            files_not_moved.append((filename, reason))
-                            files_not_moved_count += 1    
-                            continue  # Skip further processing for this image
-                        except FileNotFoundError:
-                            pass
-
-                # Read EXIF data using either piexif or exifread
-                if filename.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):
-                    exif_dict = piexif.load(file_path)
-                else:                    
-                    with open(file_path, 'rb') as f:
-                        tags = exifread.process_file(f)
-
-                # Extract the capture date from the EXIF metadata with either piexif or exifread
-                if filename.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):
-                    capture_date_tag = '0th' if '0th' in exif_dict else 'Exif'
-                    if capture_date_tag in exif_dict:
-                        capture_date_str = exif_dict[capture_date_tag].get(piexif.ExifIFD.DateTimeOriginal, b'').decode('utf-8')
-                        if capture_date_str:
-                            capture_date = datetime.strptime(capture_date_str, '%Y:%m:%d %H:%M:%S')
-                        else:
-                            capture_date = None
-                    else:
-                        capture_date = None
-                else:
-                    # Extract the capture date from the EXIF metadata
-                    capture_date = None
-                    capture_date_tag = 'EXIF DateTimeOriginal' if 'EXIF DateTimeOriginal' in tags else 'EXIF DateTimeDigitized'
-                    if capture_date_tag in tags:
-                        capture_date_str = str(tags[capture_date_tag])
-                        capture_date = datetime.strptime(capture_date_str, '%Y:%m:%d %H:%M:%S')
-           
-                # Fallback to modification date if capture date is not available
-                if capture_date is None:
-                    modification_time = os.path.getmtime(file_path)
-                    capture_date = datetime.fromtimestamp(modification_time)
-
-                # Get the camera model name and brand from the metadata (if available)
-                if filename.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):
-                    if '0th' in exif_dict:
-                        camera_model = exif_dict['0th'].get(piexif.ImageIFD.Model, b'').decode('utf-8')
-                        camera_brand = exif_dict['0th'].get(piexif.ImageIFD.Make, b'').decode('utf-8')
-                    else:
-                        camera_model = 'Unknown'
-                        camera_brand = 'Unknown'
-                else:
-                    # Get the camera model name and brand from the metadata (if available)
-                    camera_model = str(tags.get('Image Model', 'Unknown'))
-                    camera_brand = str(tags.get('Image Make', 'Unknown'))
-
-                # Get GPS coordinates from the image
-                lat, lon = get_gps_coordinates(file_path)
-
-                if lat is not None and lon is not None:
-                    # Reverse geocode the coordinates to get the city name
-                    city_name = reverse_geocode(lat, lon)
-
-                    if city_name:
-                        # Write the city name to the XMP metadata for JPEG files
-                        if filename.lower().endswith(('.jpg', '.jpeg','.tiff', '.tif')):
-                            write_city_to_metadata(file_path, city_name)
-                            print(f"City name '{city_name}' added to XMP metadata.")
-                        else:
-                            # For non-JPEG files, store city names in the temporary dictionary
-                            write_city_to_temp(file_path, city_name)
-                            print(f"City name '{city_name}' added to temporary dictionary.")
-                    else:
-                        print("City name not found.")
-                        city_name = None
-                else:
-                    print("GPS coordinates not found in the image metadata.")
-                    city_name = None
-
-                # Generate a new filename based on capture date, camera brand, camera model, city name, and photo count
-                file_extension = os.path.splitext(filename)[1]
-                new_filename = generate_new_filename(capture_date, camera_brand, camera_model, city_name, file_extension)
-                # Remove any invalid characters from the new filename
-                valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
-                new_filename = ''.join(c for c in new_filename if c in valid_chars)
-
-                # Extract year and month from the capture date
-                year = str(capture_date.year)
-                month = str(capture_date.month).zfill(2)  # Zero-padding for single-digit months (e.g., 01, 02)
-                day = str(capture_date.day).zfill(2)  # Zero-padding for single-digit days (e.g., 01, 02)
-
-                # Create the destination folder if it doesn't exist
-                destination_year_folder = os.path.join(destination_folder, year)
-                destination_month_folder = os.path.join(destination_year_folder, month)
-                os.makedirs(destination_month_folder, exist_ok=True)
+# Number of tries of a remote geocoder lookup that hits the rate limit, waiting exponentially longer between tries
+GEOCODE_MAX_TRIES = 6
 
-                # Determine the destination path and handle duplication of file names at the destination folder
-                destination_path = os.path.join(destination_month_folder, new_filename)
-                if os.path.exists(destination_path):
-                    new_filename = resolve_duplicate_filename(destination_month_folder, new_filename)
-                    destination_path = os.path.join(destination_month_folder, new_filename)
-                
-                # Skip if the destination path is invalid
-                if '\x00' in destination_path:
-                    print(f"Skipping file '{filename}' due to an invalid destination path.")
-                    continue
+# Seconds to wait for the answer of a remote geocoder
+GEOCODE_TIMEOUT = 30
 
-                # Move the file to the new location with the renamed file, or count and log as not moved
-                try:
-                    shutil.move(file_path, destination_path)
-                    print(f"Moved {filename} to {destination_path}")
-                except shutil.Error as e:
-                        reason = str(e)
-                        files_not_moved.append((filename, reason))
-                        files_not_moved_count += 1
-          
-        # If path is a folder, recursively process sub-folders. If the file doesn't have the specified extensions, log and count it as not moved.
+# Size of the buffer used to copy files between devices when the kernel can't copy them itself
+MOVE_BUFFER_SIZE = 8 * 1024 * 1024
+
+# How the copy of a file moved to another device is checked before the original is deleted: 'full' compares the hash of
+# the whole copy with the full hash of the original, 'partial' only its first and last PARTIAL_HASH_SIZE bytes
+VERIFY_MODES = ('full', 'partial')
+
+# Name of the SQLite file in the destination folder caching file hashes and metadata between runs
+CACHE_FILENAME = '.tidymyfiles_cache.sqlite'
+
+# Name of the file in the destination folder journaling the moves and removals of each run, to resume interrupted
+# runs and to audit or undo the removal of duplicates
+JOURNAL_FILENAME = '.tidymyfiles_journal.jsonl'
+
+# Name of the file in the destination folder the finished runs of the journal are moved to, keeping only the entries
+# needed to audit or restore removed duplicates
+JOURNAL_ARCHIVE_FILENAME = '.tidymyfiles_journal_archive.jsonl'
+
+# Operations of the journal kept in its archive: the runs, the moves done and the removals
+ARCHIVED_JOURNAL_OPS = ('run', 'moved', 'remove', 'end')
+
+# Extensions of the videos whose metadata is read from their QuickTime/MP4 atoms
+QUICKTIME_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.3gp')
+
+# Largest mvhd, udta or meta atom read for video metadata; they usually hold a few KB
+MAX_METADATA_ATOM_SIZE = 16 * 1024 * 1024
+
+# Start of the timestamps of QuickTime/MP4 files
+QUICKTIME_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+
+# Version of the metadata read by read_metadata, cached metadata of an older version is read again
+METADATA_VERSION = 3
+
+# Where city names can be written: 'exif' adds them to the EXIF UserComment of JPEG and TIFF files when it has room
+# and writes an XMP sidecar otherwise, 'sidecar' always writes a sidecar, 'none' writes nothing
+METADATA_MODES = ('exif', 'sidecar', 'none')
+
+# What is done with duplicates: 'delete' removes them, 'hardlink' and 'reflink' replace them with a hard link to the
+# kept copy or a copy sharing its data (on btrfs, XFS and other filesystems with copy-on-write)
+DUPLICATE_MODES = ('delete', 'hardlink', 'reflink')
+
+# ioctl request of Linux cloning a file into another, for reflinks
+FICLONE = 0x40049409
+
+# Algorithms of hashlib files can be hashed with. SHA-256 hashes are stored as plain hex digests, as by earlier
+# versions; hashes of the other algorithms are prefixed with the algorithm (e.g. 'blake2b:...'), so that they never
+# match a hash of another algorithm and cached hashes of another algorithm get computed again.
+HASH_ALGORITHMS = ('sha256', 'blake2b', 'blake2s', 'sha512')
+DEFAULT_HASH_ALGORITHM = 'sha256'
+
+# Size of the buffer files are read into for hashing, allocated once per thread
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Hashing buffer of each thread
+hash_buffers = threading.local()
+
+# Size of the write buffer of the report, which is flushed once per batch rather than once per file
+REPORT_BUFFER_SIZE = 1024 * 1024
+
+# Separator between the text of an EXIF comment and the city name added to it
+CITY_COMMENT_SEPARATOR = b'; '
+
+# Sizes of the values of each EXIF type, by type number (unknown types are counted as 1 byte)
+EXIF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+# XMP sidecar holding the city name of a file
+XMP_SIDECAR_TEMPLATE = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/"
+    xmp:CreatorTool="TidyMyFiles"
+    photoshop:City="{city}"/>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+#3 Function Definitions ------------------------------
+
+# Function to list the entries of a folder, closing it right away so that deep trees don't keep folders open
+def scan_folder(folder):
+    with os.scandir(folder) as entries:
+        return list(entries)
+
+# Function to format a number of seconds as e.g. '1h02m03s'
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+# Function to shut down the pools created by create_pools
+def shutdown_pools(thread_pool, process_pool):
+    if thread_pool is not None:
+        thread_pool.shutdown()
+        process_pool.shutdown()
+
+# Function to run a function over items in a pool, or in the calling thread when there is no pool
+def pool_map(pool, function, *items):
+    if pool is None:
+        return list(map(function, *items))
+    return list(pool.map(function, *items))
+
+# Function to copy a file to another device, check the copy and delete the original, returning the bytes copied. The
+# whole copy is checked against source_hash, the full hash of the original (see hash_file), when given, otherwise only
+# its first and last PARTIAL_HASH_SIZE bytes are.
+def copy_across_devices(file_path, destination_path, source_hash=None):
+    # Copy to a temporary name, so that an interrupted copy never looks like an organized file
+    temporary_path = get_temporary_path(destination_path)
+    try:
+        with open(file_path, 'rb') as source, open(temporary_path, 'wb') as destination:
+            file_size = os.fstat(source.fileno()).st_size
+            copy_file_data(source, destination, file_size)
+            destination.flush()
+            os.fsync(destination.fileno())
+
+        # Check the copy before deleting the original
+        if os.path.getsize(temporary_path) != file_size:
+            raise OSError(errno.EIO, "Copy has the wrong size", destination_path)
+        if source_hash is not None:
+            copy_matches = hash_file(temporary_path, get_hash_algorithm(source_hash)) == source_hash
+        else:
+            copy_matches = file_size == 0 or hash_file_partial(temporary_path, file_size) == hash_file_partial(file_path, file_size)
+        if not copy_matches:
+            raise OSError(errno.EIO, "Copy differs from the original", destination_path)
+
+        shutil.copystat(file_path, temporary_path)
+        rename_no_replace(temporary_path, destination_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    os.remove(file_path)
+    return file_size
+
+# Function to rename a file to a path on the same device, raising FileExistsError instead of replacing a file that is
+# already there. The file is hard linked to its new path and then unlinked, which fails atomically if the path exists;
+# filesystems without hard links (e.g. FAT) check the path right before renaming instead.
+def rename_no_replace(file_path, destination_path):
+    try:
+        # Links to a symbolic link link the link itself, as a rename moves it
+        if os.link in os.supports_follow_symlinks:
+            os.link(file_path, destination_path, follow_symlinks=False)
+        else:
+            os.link(file_path, destination_path)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        if os.path.lexists(destination_path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), destination_path)
+        os.rename(file_path, destination_path)
+        return
+    os.unlink(file_path)
+
+# Function to get the hidden name a file is copied to before being renamed to its path
+def get_temporary_path(file_path):
+    return os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.part")
+
+# Function to replace a duplicate file with a hard link or a reflink to its kept copy, through a temporary name so that
+# the duplicate is never missing. Reflinks keep the permissions and timestamps of the duplicate, hard links share those
+# of the kept copy. Raises OSError when the filesystem can't link the files (e.g. across devices).
+def link_duplicate(file_path, kept_path, mode):
+    temporary_path = get_temporary_path(file_path)
+    try:
+        if mode == 'hardlink':
+            os.link(kept_path, temporary_path)
         else:
-            if os.path.isdir(file_path):
-                process_files(file_path)
+            import fcntl
+            with open(kept_path, 'rb') as source, open(temporary_path, 'wb') as destination:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            shutil.copystat(file_path, temporary_path)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        if os.path.lexists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+# Function to copy the data of an open file to another, in the kernel when possible and in large blocks otherwise,
+# returning the bytes copied
+def copy_file_data(source, destination, file_size):
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < file_size:
+                count = os.copy_file_range(source.fileno(), destination.fileno(), file_size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return copied
+        except OSError as e:
+            # Older kernels and some filesystems don't support copying between them
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or copied:
+                raise
+
+    buffer = bytearray(MOVE_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        count = source.readinto(buffer)
+        if not count:
+            break
+        destination.write(view[:count])
+        copied += count
+    return copied
+
+# Function to parse the EXIF data of an open JPEG or TIFF file without reading the image data
+def load_exif(f):
+    magic_number = f.read(2)
+
+    # Walk the JPEG segments until the APP1 Exif segment, stopping at the start of the image data
+    if magic_number == b'\xff\xd8':
+        while True:
+            segment_header = f.read(4)
+            if len(segment_header) < 4 or segment_header[0] != 0xFF or segment_header[1] in (0xD9, 0xDA):
+                break
+            segment_length = int.from_bytes(segment_header[2:4], 'big')
+            if segment_header[1] == 0xE1:
+                segment = f.read(segment_length - 2)
+                if segment.startswith(b'Exif\x00\x00'):
+                    check_exif_sizes(segment[6:])
+                    return piexif.load(segment)
             else:
-                reason = "Not a media file-extension"
-                files_not_moved.append((filename, reason))
-                files_not_moved_count += 1            
-    
-# Function to generate the new filename based on capture date, camera brand, camera model, city name, and photo count
-def generate_new_filename(capture_date, camera_brand, camera_model, city_name, file_extension):
-        
-    # Separate the capture date into year, month, and day
-    year = capture_date.strftime('%Y')
-    month = capture_date.strftime('%m')
-    day = capture_date.strftime('%d')
-
-    # Construct the new filename with the desired format
-    new_filename = f"{year}_{month}_{day}_"
-
-    # Add the camera brand to the filename if available
-    if camera_brand != 'Unknown':
-        new_filename += f"{camera_brand}_"
-
-    # Add the camera model to the filename
-    new_filename += f"{camera_model}"
-
-    # Add the city name to the filename if available
-    if city_name:
-        new_filename += f"_{city_name}"
-
-    # Add the photo count for the camera and capture date
-    new_filename += f"_{get_photo_count(camera_model, capture_date)}{file_extension}"
-
-    # Remove any invalid characters from the filename
-    valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
-    new_filename = ''.join(c for c in new_filename if c in valid_chars)
-    
-    return new_filename
-
-# Function to get GPS coordinates from the metadata of the file
-def get_gps_coordinates(image_path):
-    if image_path.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):
-        with open(image_path, 'rb') as f:
+                f.seek(segment_length - 2, os.SEEK_CUR)
+
+    # TIFF directories can point anywhere in the file, so map it and let the parser touch only the pages it needs
+    if magic_number in (b'II', b'MM'):
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            check_exif_sizes(mapped_file)
+            return piexif.load(mapped_file)
+
+    return {'0th': {}, 'Exif': {}, 'GPS': {}, 'Interop': {}, '1st': {}, 'thumbnail': None}
+
+# Function to check that no entry of the IFDs read by piexif has more values than the TIFF data can hold, since
+# piexif allocates room for all the values of an entry before reading them. Raises ValueError or struct.error if one
+# has.
+def check_exif_sizes(tiff_data):
+    byte_order = '<' if tiff_data[:2] == b'II' else '>'
+    pending_ifds = [(struct.unpack_from(byte_order + 'I', tiff_data, 4)[0], True)]
+    visited_ifds = set()
+    while pending_ifds:
+        ifd_offset, is_first_ifd = pending_ifds.pop()
+        if ifd_offset in visited_ifds:
+            continue
+        visited_ifds.add(ifd_offset)
+
+        entry_count = struct.unpack_from(byte_order + 'H', tiff_data, ifd_offset)[0]
+        for i in range(entry_count):
+            tag, value_type, count, value = struct.unpack_from(byte_order + 'HHII', tiff_data, ifd_offset + 2 + 12 * i)
+            if count * EXIF_TYPE_SIZES.get(value_type, 1) > len(tiff_data):
+                raise ValueError(f"EXIF tag {tag} has more values than the EXIF data can hold")
+            # The Exif and GPS IFDs are pointed to by IFD0, and the Interoperability IFD by the Exif IFD
+            if tag in (piexif.ImageIFD.ExifTag, piexif.ImageIFD.GPSTag, piexif.ExifIFD.InteroperabilityTag):
+                pending_ifds.append((value, False))
+
+        # IFD0 is followed by IFD1, holding the thumbnail
+        if is_first_ifd:
+            next_ifd = struct.unpack_from(byte_order + 'I', tiff_data, ifd_offset + 2 + 12 * entry_count)[0]
+            if next_ifd:
+                pending_ifds.append((next_ifd, False))
+
+# Function to read the capture date, camera brand and model, and GPS coordinates from the metadata of the file, with
+# the number of bytes read from the file
+def read_metadata(file_path):
+    metadata = {
+        'capture_date': None,
+        'camera_brand': 'Unknown',
+        'camera_model': 'Unknown',
+        'lat': None,
+        'lon': None,
+        'bytes_read': 0,
+    }
+
+    if file_path.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif')):
+        # Parse the EXIF data without reading the image data
+        with open(file_path, 'rb') as f:
+            try:
+                exif_dict = load_exif(f)
+            except Exception:
+                # Malformed EXIF data is handled as missing, instead of stopping the run: piexif raises about any
+                # exception on it
+                exif_dict = {'0th': {}, 'Exif': {}, 'GPS': {}, 'Interop': {}, '1st': {}, 'thumbnail': None}
+            metadata['bytes_read'] = f.tell()
+
+        # Extract the capture date from the EXIF metadata
+        for capture_date_tag in (piexif.ExifIFD.DateTimeOriginal, piexif.ExifIFD.DateTimeDigitized):
+            metadata['capture_date'] = parse_exif_date(exif_dict['Exif'].get(capture_date_tag, b''))
+            if metadata['capture_date']:
+                break
+
+        # Get the camera model name and brand from the metadata (if available)
+        camera_model = get_exif_text(exif_dict['0th'], piexif.ImageIFD.Model)
+        camera_brand = get_exif_text(exif_dict['0th'], piexif.ImageIFD.Make)
+        metadata['camera_model'] = camera_model or 'Unknown'
+        metadata['camera_brand'] = camera_brand or 'Unknown'
+
+        # Get GPS coordinates from the image
+        metadata['lat'], metadata['lon'] = get_gps_coordinates(exif_dict)
+    elif file_path.lower().endswith(QUICKTIME_EXTENSIONS):
+        metadata.update(read_video_metadata(file_path))
+    else:
+        with open(file_path, 'rb') as f:
             tags = exifread.process_file(f, details=False)
-            latitude_ref = tags.get('GPS GPSLatitudeRef')
-            latitude = tags.get('GPS GPSLatitude')
-            longitude_ref = tags.get('GPS GPSLongitudeRef')
-            longitude = tags.get('GPS GPSLongitude')
-
-            if latitude and longitude and latitude_ref and longitude_ref:
-                lat_value = [float(x.num) / float(x.den) for x in latitude.values]
-                lon_value = [float(x.num) / float(x.den) for x in longitude.values]
-
-                lat = lat_value[0] + lat_value[1] / 60 + lat_value[2] / 3600
-                lon = lon_value[0] + lon_value[1] / 60 + lon_value[2] / 3600
+            metadata['bytes_read'] = f.tell()
+
+        # Extract the capture date from the EXIF metadata
+        capture_date_tag = 'EXIF DateTimeOriginal' if 'EXIF DateTimeOriginal' in tags else 'EXIF DateTimeDigitized'
+        if capture_date_tag in tags:
+            metadata['capture_date'] = parse_exif_date(str(tags[capture_date_tag]).encode('utf-8'))
+
+        # Get the camera model name and brand from the metadata (if available)
+        metadata['camera_model'] = str(tags.get('Image Model', 'Unknown'))
+        metadata['camera_brand'] = str(tags.get('Image Make', 'Unknown'))
+
+    return metadata
+
+# Function to read the capture date, camera and GPS coordinates of a QuickTime/MP4 video from the metadata atoms of its
+# moov atom, without reading the media data or the track atoms. Returns only the values found, with the bytes read.
+def read_video_metadata(file_path):
+    metadata = {}
+    moov_atoms = read_moov_atoms(file_path)
+    if moov_atoms is None:
+        return metadata
+    atoms, metadata['bytes_read'] = moov_atoms
+
+    for atom_type, data in atoms:
+        if atom_type == b'mvhd':
+            # Creation time in seconds since 1904 (UTC), 32-bit in version 0 and 64-bit in version 1; 0 means unset
+            if len(data) >= 12 and data[0] == 1:
+                creation_time = struct.unpack_from('>Q', data, 4)[0]
+            elif len(data) >= 8:
+                creation_time = struct.unpack_from('>I', data, 4)[0]
+            else:
+                creation_time = 0
+            if creation_time and 'capture_date' not in metadata:
+                try:
+                    # Like EXIF dates, capture dates are in local time
+                    metadata['capture_date'] = (QUICKTIME_EPOCH + timedelta(seconds=creation_time)).astimezone().replace(tzinfo=None)
+                except (OverflowError, ValueError, OSError):
+                    # Times past the year 9999 are garbage
+                    pass
+        elif atom_type == b'udta':
+            # Classic QuickTime user data, e.g. from Android phones and cameras
+            for child_type, child_start, child_end in iterate_atoms(data, 0, len(data)):
+                value = read_quicktime_string(data[child_start:child_end])
+                if child_type == b'\xa9xyz':
+                    set_video_location(metadata, value)
+                elif child_type == b'\xa9mak' and value:
+                    metadata['camera_brand'] = value
+                elif child_type == b'\xa9mod' and value:
+                    metadata['camera_model'] = value
+        elif atom_type == b'meta':
+            # Metadata keys written by Apple devices, which take precedence over the less precise mvhd time
+            for key, value in read_metadata_keys(data, 0, len(data)).items():
+                if key == 'com.apple.quicktime.location.ISO6709':
+                    set_video_location(metadata, value)
+                elif key == 'com.apple.quicktime.make' and value:
+                    metadata['camera_brand'] = value
+                elif key == 'com.apple.quicktime.model' and value:
+                    metadata['camera_model'] = value
+                elif key == 'com.apple.quicktime.creationdate':
+                    try:
+                        # e.g. '2023-07-14T18:02:11+0200', already in the local time of the capture
+                        metadata['capture_date'] = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+                    except ValueError:
+                        pass
+    return metadata
+
+# Function to read the mvhd, udta and meta atoms of the moov atom of a QuickTime/MP4 file, seeking over the other
+# top-level atoms (such as the media data, which can come first) and over the track atoms with their sample tables,
+# which are most of the moov atom of long videos. Returns the atoms as (type, content) pairs with the number of bytes
+# read, or None if the file has no readable moov atom.
+def read_moov_atoms(file_path):
+    # Unbuffered, so that reading an atom header reads only the header
+    with open(file_path, 'rb', buffering=0) as f:
+        bytes_read = 0
+        for atom_type, start, end, header_size in iterate_file_atoms(f, 0, os.fstat(f.fileno()).st_size):
+            bytes_read += header_size
+            if atom_type != b'moov':
+                continue
+
+            atoms = []
+            for child_type, child_start, child_end, child_header_size in iterate_file_atoms(f, start, end):
+                bytes_read += child_header_size
+                if child_type in (b'mvhd', b'udta', b'meta') and child_end - child_start <= MAX_METADATA_ATOM_SIZE:
+                    f.seek(child_start)
+                    atoms.append((child_type, f.read(child_end - child_start)))
+                    bytes_read += child_end - child_start
+            return atoms, bytes_read
+    return None
 
-                return lat, lon
+# Generator function to list the atoms between start and end of an open file from their headers, yielding their type,
+# the range of their content and the size of their header. Stops at the first atom that isn't valid.
+def iterate_file_atoms(f, start, end):
+    position = start
+    while position + 8 <= end:
+        f.seek(position)
+        header = f.read(16)
+        atom_size, atom_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if atom_size == 1 and len(header) == 16:
+            atom_size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = end - position
+        if atom_size < header_size or position + atom_size > end or not is_atom_type(atom_type):
+            return
+        yield atom_type, position + header_size, position + atom_size, header_size
+        position += atom_size
+
+# Generator function to list the atoms between start and end of a buffer, yielding their type and the range of
+# their content
+def iterate_atoms(data, start, end):
+    position = start
+    while position + 8 <= end:
+        atom_size, atom_type = struct.unpack_from('>I4s', data, position)
+        if atom_size < 8 or position + atom_size > end:
+            return
+        yield atom_type, position + 8, position + atom_size
+        position += atom_size
+
+# Function to check whether four bytes look like an atom type, so that other files aren't parsed as atoms
+def is_atom_type(atom_type):
+    return all(32 <= byte < 127 or byte == 0xa9 for byte in atom_type)
+
+# Function to read a QuickTime user data string: a 16-bit length and a 16-bit language code, then the text
+def read_quicktime_string(data):
+    if len(data) < 4:
+        return ''
+    length = struct.unpack_from('>H', data)[0]
+    return data[4:4 + length].decode('utf-8', 'replace').strip('\x00 ')
+
+# Function to read the values of a meta atom with keys (keys and ilst atoms), as a dictionary of strings
+def read_metadata_keys(data, start, end):
+    # The meta atom of QuickTime has no version and flags, the one of MP4 has
+    if data[start + 4:start + 8] not in (b'hdlr', b'keys'):
+        start += 4
+
+    keys = []
+    values = {}
+    for atom_type, atom_start, atom_end in iterate_atoms(data, start, end):
+        if atom_type == b'keys' and atom_end - atom_start >= 8:
+            position = atom_start + 8
+            for _ in range(struct.unpack_from('>I', data, atom_start + 4)[0]):
+                if position + 8 > atom_end:
+                    break
+                key_size = struct.unpack_from('>I', data, position)[0]
+                if key_size < 8:
+                    break
+                keys.append(data[position + 8:position + key_size].decode('utf-8', 'replace'))
+                position += key_size
+        elif atom_type == b'ilst':
+            # Items are numbered by the 1-based index of their key, and hold a data atom (type, locale, value)
+            for item_type, item_start, item_end in iterate_atoms(data, atom_start, atom_end):
+                key_index = struct.unpack('>I', item_type)[0]
+                for value_type, value_start, value_end in iterate_atoms(data, item_start, item_end):
+                    if value_type == b'data' and 0 < key_index <= len(keys):
+                        value = data[value_start + 8:value_end].decode('utf-8', 'replace').strip('\x00 ')
+                        values[keys[key_index - 1]] = value
+    return values
+
+# Function to set the GPS coordinates of a video from an ISO 6709 location such as '+48.8584+002.2945+035.000/'
+def set_video_location(metadata, location):
+    match = re.match(r'([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)', location)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            metadata['lat'], metadata['lon'] = lat, lon
+
+# Function to convert an EXIF date such as b'2023:07:14 18:02:11' to a datetime, or None if it is missing or invalid
+def parse_exif_date(exif_date):
+    try:
+        return datetime.strptime(exif_date.decode('utf-8').strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except (UnicodeDecodeError, ValueError, AttributeError):
+        return None
+
+# Function to get the text of an EXIF tag, or an empty string if it has none or the tag has another type in malformed
+# EXIF data
+def get_exif_text(ifd, tag):
+    value = ifd.get(tag, b'')
+    return value.decode('utf-8', 'replace').strip('\x00 ') if isinstance(value, bytes) else ''
+
+# Function to get GPS coordinates from the EXIF dictionary of the file
+def get_gps_coordinates(exif_dict):
+    gps = exif_dict.get('GPS', {})
+    latitude_ref = gps.get(piexif.GPSIFD.GPSLatitudeRef)
+    latitude = gps.get(piexif.GPSIFD.GPSLatitude)
+    longitude_ref = gps.get(piexif.GPSIFD.GPSLongitudeRef)
+    longitude = gps.get(piexif.GPSIFD.GPSLongitude)
+
+    # The references are bytes, unless the EXIF data is malformed
+    if latitude and longitude and isinstance(latitude_ref, bytes) and isinstance(longitude_ref, bytes):
+        try:
+            lat_value = [float(num) / float(den) for num, den in latitude]
+            lon_value = [float(num) / float(den) for num, den in longitude]
+            lat = lat_value[0] + lat_value[1] / 60 + lat_value[2] / 3600
+            lon = lon_value[0] + lon_value[1] / 60 + lon_value[2] / 3600
+        except (ValueError, TypeError, IndexError, ZeroDivisionError):
+            return None, None
+
+        # Southern latitudes and western longitudes are negative
+        if latitude_ref.startswith(b'S'):
+            lat = -lat
+        if longitude_ref.startswith(b'W'):
+            lon = -lon
+
+        return lat, lon
     return None, None
 
-# Function to get city name based on lat and lon data from GPS
-def reverse_geocode(lat, lon):
-    geocoder = OpenCageGeocode(opencage_api_key)
-    results = geocoder.reverse_geocode(lat, lon, language='en')
-    
-    if results and len(results) > 0:
-        components = results[0].get('components', {})
-        city_name = components.get('city', None)
-        if city_name:
-            return city_name
+# Geocoder backend asking the OpenCage API (or a server answering like it, at url) for the city of a location
+class OpenCageBackend:
+    def __init__(self, api_key, url=None, requests_per_second=1.0, concurrency=4):
+        import requests
+        from opencage.geocoder import OpenCageGeocode, UnknownError
+
+        self.name = 'opencage'
+        self.remote = True
+        self.requests_per_second = requests_per_second
+        self.concurrency = concurrency
+
+        self.api_key = api_key
+        self.url = url or OpenCageGeocode.url
+
+        # Requests share a session, so that connections are kept open and reused
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # Requests failing on the server or on the network are tried again, up to 5 times
+        self.request = backoff.on_exception(backoff.expo, (UnknownError, requests.exceptions.RequestException),
+                                            max_tries=5)(self.send_request)
+
+    # Function to send a request to the API, raising the errors of the opencage package as OpenCageGeocode does
+    def send_request(self, params):
+        from opencage.geocoder import NotAuthorizedError, ForbiddenError, RateLimitExceededError, UnknownError
+
+        response = self.session.get(self.url, params=params, timeout=GEOCODE_TIMEOUT)
+
+        try:
+            response_json = response.json()
+        except ValueError as excinfo:
+            raise UnknownError("Non-JSON result from server") from excinfo
+
+        if response.status_code == 401:
+            raise NotAuthorizedError()
+        if response.status_code == 403:
+            raise ForbiddenError()
+        if response.status_code in (402, 429):
+            rate = response_json.get('rate', {})
+            raise RateLimitExceededError(reset_to=int(rate.get('limit', 0)),
+                                         reset_time=datetime.utcfromtimestamp(rate.get('reset', 0)))
+        if response.status_code >= 500:
+            raise UnknownError(f"{response.status_code} status code from API")
+        if 'results' not in response_json:
+            raise UnknownError("JSON from API doesn't have a 'results' key")
+
+        return response_json
+
+    def reverse_geocode(self, lat, lon):
+        params = {'q': f"{lat:.6f},{lon:.6f}", 'key': self.api_key, 'language': 'en', 'no_annotations': 1}
+        results = self.request(params)['results']
+
+        if results and len(results) > 0:
+            components = results[0].get('components', {})
+            city_name = components.get('city', None)
+            if city_name:
+                return city_name
+
+        return None
+
+    # Coroutine returning the city names of several locations, or the exception raised for a location, in order
+    async def reverse_geocode_many(self, coordinates):
+        from opencage.geocoder import RateLimitExceededError
+
+        rate_limiter = RateLimiter(self.requests_per_second)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        @backoff.on_exception(backoff.expo, RateLimitExceededError, max_tries=GEOCODE_MAX_TRIES)
+        async def lookup(lat, lon):
+            async with semaphore:
+                await rate_limiter.wait()
+                return await asyncio.to_thread(self.reverse_geocode, lat, lon)
+
+        return await asyncio.gather(*(lookup(lat, lon) for lat, lon in coordinates), return_exceptions=True)
+
+# Class spacing out the start of requests so that at most requests_per_second start each second
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_time = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        delay = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Geocoder backend finding the nearest city in a GeoNames export (e.g. cities500.txt from
+# https://download.geonames.org/export/dump/) without network access. The cities are kept in an implicit KD-tree over
+# points on the unit sphere: the median of each range is its node, and the ranges left and right of it are its subtrees.
+class GeoNamesBackend:
+    # Ranges with at most this many cities are searched without splitting them further
+    LEAF_SIZE = 8
+
+    def __init__(self, cities_file, max_distance_km=MAX_CITY_DISTANCE_KM):
+        # Results depend on the cities and the distance, so cached results are kept apart for each of them (and from
+        # those of earlier versions, which named cities by their local name)
+        self.name = f"geonames:{os.path.abspath(cities_file)}:{max_distance_km}:asciiname"
+        self.remote = False
+
+        names = []
+        coordinates = []
+        with open(cities_file, encoding='utf-8') as f:
+            for line in f:
+                # Columns are geonameid, name, asciiname, alternatenames, latitude, longitude, ... File names keep only
+                # ASCII characters, so the ASCII name gives 'Zurich' where the local name would give 'Zrich'
+                fields = line.split('\t')
+                if len(fields) > 5:
+                    names.append(fields[2] or fields[1])
+                    coordinates.append((float(fields[4]), float(fields[5])))
+
+        points = np.array([to_unit_vector(lat, lon) for lat, lon in coordinates]).reshape(-1, 3)
+        order = np.arange(len(names))
+        self.build(points, order, 0, len(names), 0)
+
+        self.points = points[order].tolist()
+        self.names = [names[i] for i in order]
+        # Squared straight-line distance between two points on the unit sphere max_distance_km apart
+        self.max_distance = (2 * math.sin(max_distance_km / EARTH_RADIUS_KM / 2)) ** 2
+
+    # Recursive function to reorder a range of cities so that its median along the axis of the depth is in the middle
+    def build(self, points, order, lo, hi, depth):
+        if hi - lo <= self.LEAF_SIZE:
+            return
+        mid = (lo + hi) // 2
+        subset = order[lo:hi]
+        order[lo:hi] = subset[np.argpartition(points[subset, depth % 3], mid - lo)]
+        self.build(points, order, lo, mid, depth + 1)
+        self.build(points, order, mid + 1, hi, depth + 1)
+
+    def reverse_geocode(self, lat, lon):
+        point = to_unit_vector(lat, lon)
+        best = [self.max_distance, None]
+        self.search(point, 0, len(self.points), 0, best)
+        return best[1]
+
+    # Recursive function to update best with the nearest city of a range that is closer than best
+    def search(self, point, lo, hi, depth, best):
+        if hi - lo <= self.LEAF_SIZE:
+            candidates = range(lo, hi)
+        else:
+            candidates = ((lo + hi) // 2,)
+
+        for i in candidates:
+            x, y, z = self.points[i]
+            distance = (x - point[0]) ** 2 + (y - point[1]) ** 2 + (z - point[2]) ** 2
+            if distance < best[0]:
+                best[0] = distance
+                best[1] = self.names[i]
+
+        if hi - lo <= self.LEAF_SIZE:
+            return
+
+        # Search the side of the point first, and the other side only if it can hold a closer city
+        mid = (lo + hi) // 2
+        axis = depth % 3
+        offset = point[axis] - self.points[mid][axis]
+        if offset < 0:
+            self.search(point, lo, mid, depth + 1, best)
+            if offset * offset < best[0]:
+                self.search(point, mid + 1, hi, depth + 1, best)
+        else:
+            self.search(point, mid + 1, hi, depth + 1, best)
+            if offset * offset < best[0]:
+                self.search(point, lo, mid, depth + 1, best)
+
+# Function to convert a latitude and longitude in degrees to a point on the unit sphere
+def to_unit_vector(lat, lon):
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+# Function to add the city name to the EXIF UserComment of a JPEG or TIFF file, overwriting the comment in place
+# instead of rewriting the file. Returns the offset of the comment in the file and the comment it replaced (None when
+# it already had the city name), or None if the file has no UserComment with room for the city name.
+def write_city_to_metadata(image_path, city_name):
+    with open(image_path, 'r+b') as f:
+        user_comment = find_user_comment(f)
+        if user_comment is None:
+            return None
+
+        offset, length = user_comment
+        f.seek(offset)
+        comment = f.read(length)
+        new_comment = add_city_to_comment(comment, city_name.encode('utf-8'))
+        if new_comment is None or len(new_comment) > length:
+            return None
+
+        # Files that already have the city name are left untouched, so that running again changes nothing
+        if new_comment == comment:
+            return offset, None
+        f.seek(offset)
+        f.write(new_comment.ljust(length, b'\x00'))
+    return offset, comment
+
+# Function to append the city name to the text of a UserComment, after a separator if the comment has text, keeping
+# its 8-byte character code if it has one. Returns the comment unchanged if it already ends with the city name, or None
+# for UTF-16 and JIS comments.
+def add_city_to_comment(comment, city_name_bytes):
+    if comment[:8] in (b'UNICODE\x00', b'JIS\x00\x00\x00\x00\x00'):
+        return None
+    character_code = comment[:8] if comment[:8] in (b'ASCII\x00\x00\x00', b'\x00' * 8) else b''
+
+    # Cameras often fill the comment with spaces or null bytes, leaving room for the city name
+    text = comment[len(character_code):].rstrip(b'\x00 ')
+    if not text:
+        return character_code + city_name_bytes
+    if text == city_name_bytes or text.endswith(CITY_COMMENT_SEPARATOR + city_name_bytes):
+        return comment
+    return character_code + text + CITY_COMMENT_SEPARATOR + city_name_bytes
+
+# Function to find the UserComment of the EXIF data of an open JPEG or TIFF file, returning the offset and the length
+# of its value in the file, or None if the file has none
+def find_user_comment(f):
+    tiff_start = find_tiff_header(f)
+    if tiff_start is None:
+        return None
+
+    f.seek(tiff_start)
+    header = f.read(8)
+    byte_order = '<' if header[:2] == b'II' else '>'
+    ifd_offset = struct.unpack(byte_order + 'I', header[4:8])[0]
+
+    # The UserComment is in the Exif IFD, which IFD0 points to
+    exif_ifd = find_ifd_entry(f, tiff_start, ifd_offset, piexif.ImageIFD.ExifTag, byte_order)
+    if exif_ifd is None:
+        return None
+    user_comment = find_ifd_entry(f, tiff_start, struct.unpack(byte_order + 'I', exif_ifd[2])[0],
+                                  piexif.ExifIFD.UserComment, byte_order)
+    if user_comment is None:
+        return None
+
+    # Values of up to 4 bytes are stored in the entry itself, longer ones at the offset it holds
+    entry_offset, count, value = user_comment
+    if count <= 4:
+        return entry_offset + 8, count
+    return tiff_start + struct.unpack(byte_order + 'I', value)[0], count
+
+# Function to get the offset in the file of the TIFF header holding the EXIF data of a JPEG or TIFF file, or None
+def find_tiff_header(f):
+    f.seek(0)
+    magic_number = f.read(2)
+    if magic_number in (b'II', b'MM'):
+        return 0
+
+    # Walk the JPEG segments until the APP1 Exif segment, stopping at the start of the image data
+    if magic_number == b'\xff\xd8':
+        while True:
+            segment_header = f.read(4)
+            if len(segment_header) < 4 or segment_header[0] != 0xFF or segment_header[1] in (0xD9, 0xDA):
+                return None
+            segment_length = int.from_bytes(segment_header[2:4], 'big')
+            segment_start = f.tell()
+            if segment_header[1] == 0xE1 and f.read(6) == b'Exif\x00\x00':
+                return f.tell()
+            f.seek(segment_start + segment_length - 2)
+    return None
 
+# Function to find a tag in an IFD, returning the offset of its entry in the file, its count and its 4-byte value
+def find_ifd_entry(f, tiff_start, ifd_offset, tag, byte_order):
+    f.seek(tiff_start + ifd_offset)
+    entry_count_bytes = f.read(2)
+    if len(entry_count_bytes) < 2:
+        return None
+    entry_count = struct.unpack(byte_order + 'H', entry_count_bytes)[0]
+    entries = f.read(12 * entry_count)
+    for i in range(len(entries) // 12):
+        entry_tag, entry_type, count = struct.unpack_from(byte_order + 'HHI', entries, 12 * i)
+        if entry_tag == tag:
+            return tiff_start + ifd_offset + 2 + 12 * i, count, entries[12 * i + 8:12 * i + 12]
     return None
 
-# Function to write the cityname to the metadata of the file (XMP City)
-def write_city_to_metadata(image_path, city_name):
-    # Load the EXIF data using piexif
-    exif_dict = piexif.load(image_path)
-    
-    # Convert city_name to bytes for proper XMP encoding
-    city_name_bytes = city_name.encode('utf-8')
-    # Check if XMP data exists in the EXIF dictionary
-    
-    if exif_dict.get('Exif', {}).get(piexif.ExifIFD.UserComment):
-        # XMP data exists, update the city name
-        xmp_bytes = exif_dict['Exif'][piexif.ExifIFD.UserComment] + city_name_bytes
-    else:
-        # XMP data doesn't exist, create new XMP metadata
-        xmp_bytes = city_name_bytes
-    
-    # Update the EXIF data with the new/updated XMP metadata
-    exif_dict['Exif'][piexif.ExifIFD.UserComment] = xmp_bytes
-    
-    # Save the updated EXIF data back to the image
-    piexif.insert(piexif.dump(exif_dict), image_path)
-
-# Function to store the Metadata for the City name if the file type does not support XMP
-def write_city_to_temp(image_path, city_name):
-    city_names_temp[image_path] = city_name
-
-# Function to get the photo count for a specific camera on a given day
-def get_photo_count(camera_model, capture_date):
-    global photo_count
-
-    # Check if the camera is already in the dictionary
-    if camera_model in photo_count:
-        # Check if the capture date is already in the camera's dictionary
-        if capture_date.date() in photo_count[camera_model]:
-            photo_count[camera_model][capture_date.date()] += 1
-        else:
-            photo_count[camera_model][capture_date.date()] = 1
-    else:
-        photo_count[camera_model] = {capture_date.date(): 1}
+# Function to write the city name to an XMP sidecar next to a file (photo.jpg.xmp), which photo managers such as
+# darktable and digiKam read. Sidecars written by other programs are left alone: returns False for them.
+def write_city_to_sidecar(file_path, city_name):
+    sidecar_path = file_path + '.xmp'
+    sidecar = XMP_SIDECAR_TEMPLATE.format(city=escape(city_name, {'"': '&quot;'}))
+
+    if os.path.exists(sidecar_path):
+        with open(sidecar_path, encoding='utf-8', errors='replace') as f:
+            existing_sidecar = f.read()
+        if existing_sidecar == sidecar:
+            return True
+        if 'xmp:CreatorTool="TidyMyFiles"' not in existing_sidecar:
+            return False
 
-    # Return the photo count for the camera and capture date
-    return str(photo_count[camera_model][capture_date.date()]).zfill(3)
+    with open(sidecar_path, 'w', encoding='utf-8') as f:
+        f.write(sidecar)
+    return True
 
 # Function to delete empty folders after moving the files
 def delete_empty_folders(directory):
@@ -315,75 +901,2264 @@ def delete_empty_folders(directory):
                 # Delete the empty folder
                 os.rmdir(folder_path)
 
-# Function to resolve duplicate filenames by appending a suffix
-def resolve_duplicate_filename(destination_folder, filename):
-    file_name, file_extension = os.path.splitext(filename)
-    counter = 1
+# Function to check whether a folder ignores the case of file names, by looking up a temporary file in another case
+def is_case_insensitive(folder):
+    os.makedirs(folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=folder, prefix='.tidymyfiles_case_') as probe:
+        probe_path = os.path.join(folder, os.path.basename(probe.name).upper())
+        return os.path.exists(probe_path)
+
+# Function to calculate the hash of a file
+def hash_file(file_to_hash, algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = hashlib.new(algorithm)
+    with open(file_to_hash, 'rb', buffering=0) as f:
+        # The file is read once from start to end, so the kernel can read further ahead
+        advise_read(f, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        update_hash(hasher, f)
+    return format_hash(hasher)
+
+# Function to calculate the hash of a file with the bytes at an offset replaced by a comment, given as the offset and
+# the comment (or None to hash the file as it is)
+def hash_file_with_comment(file_to_hash, algorithm, replaced_comment):
+    if replaced_comment is None:
+        return hash_file(file_to_hash, algorithm)
+
+    comment_offset, comment = replaced_comment
+    hasher = hashlib.new(algorithm)
+    with open(file_to_hash, 'rb', buffering=0) as f:
+        update_hash(hasher, f, comment_offset)
+        hasher.update(comment)
+        f.seek(comment_offset + len(comment))
+        update_hash(hasher, f)
+    return format_hash(hasher)
+
+# Function to calculate the hash of the first and last PARTIAL_HASH_SIZE bytes of a file
+def hash_file_partial(file_to_hash, file_size, algorithm=DEFAULT_HASH_ALGORITHM):
+    hasher = hashlib.new(algorithm)
+    # Files of up to 2 * PARTIAL_HASH_SIZE bytes are covered by the first read and the start of the tail
+    tail_start = max(file_size - PARTIAL_HASH_SIZE, PARTIAL_HASH_SIZE)
+    with open(file_to_hash, 'rb', buffering=0) as f:
+        # Ask for the head and the tail at once, so that the tail is read while the head is hashed
+        advise_read(f, 0, PARTIAL_HASH_SIZE, 'POSIX_FADV_WILLNEED')
+        if file_size > tail_start:
+            advise_read(f, tail_start, PARTIAL_HASH_SIZE, 'POSIX_FADV_WILLNEED')
+        update_hash(hasher, f, PARTIAL_HASH_SIZE)
+        f.seek(tail_start)
+        update_hash(hasher, f, PARTIAL_HASH_SIZE)
+    return format_hash(hasher)
+
+# Function to add up to length bytes of an open file (all of them when None) to a hasher, read into the buffer of the
+# thread. readinto and hashlib release the GIL on large blocks, so the worker threads hash files in parallel.
+def update_hash(hasher, f, length=None):
+    buffer = getattr(hash_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = hash_buffers.buffer = memoryview(bytearray(HASH_BUFFER_SIZE))
+
+    while length is None or length > 0:
+        count = f.readinto(buffer if length is None or length >= len(buffer) else buffer[:length])
+        if not count:
+            break
+        hasher.update(buffer[:count])
+        if length is not None:
+            length -= count
+
+# Function to tell the kernel how a range of an open file will be read (a length of 0 meaning up to the end), on the
+# systems that have posix_fadvise
+def advise_read(f, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(f.fileno(), offset, length, getattr(os, advice))
+
+# Function to get the hash of a hasher as stored, prefixed with its algorithm unless it is SHA-256
+def format_hash(hasher):
+    if hasher.name == 'sha256':
+        return hasher.hexdigest()
+    return f"{hasher.name}:{hasher.hexdigest()}"
+
+# Function to get the algorithm of a hash made by format_hash
+def get_hash_algorithm(file_hash):
+    return file_hash.split(':', 1)[0] if ':' in file_hash else 'sha256'
+
+# Function to open the cache in a folder, creating it if needed, and return the connection
+def open_cache(folder):
+    os.makedirs(folder, exist_ok=True)
+    cache_db = sqlite3.connect(os.path.join(folder, CACHE_FILENAME), check_same_thread=False)
+    cache_db.row_factory = sqlite3.Row
+    cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+        "partial_hash TEXT, full_hash TEXT, has_metadata INTEGER DEFAULT 0, "
+        "capture_date TEXT, camera_brand TEXT, camera_model TEXT, lat REAL, lon REAL, dhash TEXT, "
+        "source_partial_hash TEXT, source_hash TEXT)"
+    )
+    # Caches created before the near-duplicate check have no dhash column, and caches created before city names were
+    # written into the files have no hashes of the content before it was written
+    columns = [row['name'] for row in cache_db.execute("PRAGMA table_info(files)")]
+    for column in ('dhash', 'source_partial_hash', 'source_hash'):
+        if column not in columns:
+            cache_db.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+    cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS geocodes ("
+        "backend TEXT, grid REAL, lat_cell INTEGER, lon_cell INTEGER, city TEXT, "
+        "PRIMARY KEY (backend, grid, lat_cell, lon_cell))"
+    )
+    return cache_db
+
+# Function to remove the cache entries of files that no longer exist or changed since they were cached
+def compact_cache(cache_db):
+    stale_paths = []
+    for row in cache_db.execute("SELECT path, size, mtime_ns, inode FROM files"):
+        try:
+            stat = os.stat(row['path'])
+        except OSError:
+            stale_paths.append(row['path'])
+            continue
+        if (row['size'], row['mtime_ns'], row['inode']) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            stale_paths.append(row['path'])
+
+    cache_db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in stale_paths])
+    cache_db.commit()
+    cache_db.execute("VACUUM")
+    return len(stale_paths)
+
+# Function to compute the difference hash of an image: a 9x8 grayscale thumbnail, with one bit per pair of
+# neighbouring pixels set when the left one is brighter. Returns None if the image can't be decoded.
+def compute_dhash(image_path):
+    import cv2
+
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+    # Small images lose too much detail at 1/8 of their size, and are quick to decode in full anyway
+    if min(image.shape) < 64:
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+    thumbnail = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (thumbnail[:, :-1] > thumbnail[:, 1:]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+# Class of a BK-tree of 64-bit hashes, finding a hash within a Hamming distance without comparing it to all hashes.
+# Each node keeps its children by their distance to it, so by the triangle inequality a search within max_distance of
+# a hash at distance d from a node only needs the children at distances d - max_distance to d + max_distance.
+class BKTree:
+    def __init__(self):
+        # Nodes are [hash, path, {distance: child node}]
+        self.root = None
+
+    def add(self, dhash, path):
+        node = [dhash, path, {}]
+        if self.root is None:
+            self.root = node
+            return
+
+        parent = self.root
+        while True:
+            distance = hamming_distance(dhash, parent[0])
+            if distance not in parent[2]:
+                parent[2][distance] = node
+                return
+            parent = parent[2][distance]
+
+    # Returns the path of the closest hash within max_distance, or None if there is none
+    def find(self, dhash, max_distance):
+        best_path = None
+        best_distance = max_distance + 1
+        pending_nodes = [self.root] if self.root is not None else []
+
+        while pending_nodes:
+            node = pending_nodes.pop()
+            distance = hamming_distance(dhash, node[0])
+            if distance < best_distance:
+                best_path = node[1]
+                best_distance = distance
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    pending_nodes.append(child)
+        return best_path
+
+# Function to count the bits that differ between two hashes
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+# Function to decode an image as a small grayscale image for the quality check, without decoding it at full
+# resolution: the EXIF thumbnail if allowed and it shows the whole image, or a decode at 1/8 of the size.
+# Returns None if the image can't be decoded.
+def load_quality_image(image_path, use_thumbnail=True):
+    import cv2
+
+    # Use the embedded EXIF thumbnail when it shows the whole image, i.e. has the aspect ratio of the image
+    if use_thumbnail and image_path.lower().endswith(('.jpg', '.jpeg')):
+        try:
+            with open(image_path, 'rb') as f:
+                exif_dict = load_exif(f)
+        except Exception:
+            # Malformed EXIF data, on which piexif raises about any exception, means no thumbnail
+            exif_dict = None
+
+        if exif_dict and exif_dict['thumbnail']:
+            width = exif_dict['Exif'].get(piexif.ExifIFD.PixelXDimension)
+            height = exif_dict['Exif'].get(piexif.ExifIFD.PixelYDimension)
+            thumbnail = cv2.imdecode(np.frombuffer(exif_dict['thumbnail'], np.uint8), cv2.IMREAD_GRAYSCALE)
+            if thumbnail is not None and isinstance(width, int) and isinstance(height, int) and width > 0 and height > 0:
+                if abs(thumbnail.shape[1] / thumbnail.shape[0] - width / height) < 0.01 * width / height:
+                    return thumbnail
+
+    # Otherwise let the decoder produce a grayscale image at 1/8 of the size (JPEG skips most of the work)
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+    # Decode smaller images at a larger size again, since scaling them up to QUALITY_IMAGE_SIZE would blur them
+    if image is not None and image.shape[1] < QUALITY_IMAGE_SIZE[0]:
+        for reduction, flag in ((4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2), (1, cv2.IMREAD_GRAYSCALE)):
+            if image.shape[1] * 8 // reduction >= QUALITY_IMAGE_SIZE[0] or reduction == 1:
+                return cv2.imread(image_path, flag)
+    return image
+
+# Function to score the brightness, sharpness and clipping of a chunk of images, returning a tuple for each image.
+# The images are scaled into one array, so that the scores of the whole chunk come from a few NumPy operations.
+# Scores of images that can't be decoded are NaN.
+def score_images(image_paths, fast=True, use_thumbnail=True, brightness_threshold=DEFAULT_BRIGHTNESS_THRESHOLD):
+    import cv2
+
+    images = np.empty((len(image_paths), QUALITY_IMAGE_SIZE[1], QUALITY_IMAGE_SIZE[0]), np.float32)
+    readable = np.zeros(len(image_paths), bool)
+    for i, image_path in enumerate(image_paths):
+        image = load_quality_image(image_path, use_thumbnail)
+        if image is not None:
+            images[i] = cv2.resize(image, QUALITY_IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+            readable[i] = True
+
+    # Mean gray level (lower value indicates darker image)
+    brightness = images.mean(axis=(1, 2))
+
+    # Variance of the Laplacian (lower value indicates blurrier image)
+    laplacian = (images[:, :-2, 1:-1] + images[:, 2:, 1:-1] + images[:, 1:-1, :-2] + images[:, 1:-1, 2:]
+                 - 4 * images[:, 1:-1, 1:-1])
+    sharpness = laplacian.var(axis=(1, 2))
+
+    # Fraction of black or white pixels (higher value indicates under- or overexposed image)
+    clipping = ((images <= 2) | (images >= 253)).mean(axis=(1, 2))
+
+    brightness[~readable] = np.nan
+    sharpness[~readable] = np.nan
+    clipping[~readable] = np.nan
+
+    # Trust the reduced-size brightness unless it is too close to the threshold to give the full-resolution verdict
+    for i in np.flatnonzero(readable):
+        if brightness_threshold is None:
+            break
+        if not fast or abs(brightness[i] - brightness_threshold) <= BRIGHTNESS_TOLERANCE:
+            image = cv2.imread(image_paths[i])
+            if image is not None:
+                brightness[i] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).mean()
+
+    return list(zip(brightness.tolist(), sharpness.tolist(), clipping.tolist()))
+
+# Function to caputure low quality files
+def is_low_quality_image(image_path, fast=True, brightness_threshold=DEFAULT_BRIGHTNESS_THRESHOLD):
+    brightness = score_images([image_path], fast, True, brightness_threshold)[0][0]
+    return brightness < brightness_threshold
+
+# Class appending the files that are not organized to a report as they are processed, as CSV if the name of the report
+# ends with .csv and as JSON lines otherwise. Writes are buffered and never synced, so the report costs no disk sync
+# per file; the buffer is written out after each batch, so a crash loses at most the current batch.
+class ReportWriter:
+    FIELDS = ('path', 'reason', 'size', 'hash')
+
+    def __init__(self, report_path):
+        self.is_csv = report_path.lower().endswith('.csv')
+        self.file = open(report_path, 'a', encoding='utf-8', newline='' if self.is_csv else None,
+                         buffering=REPORT_BUFFER_SIZE)
+        if self.is_csv:
+            self.writer = csv.writer(self.file)
+            # Reports appended to by later runs keep their header
+            if self.file.tell() == 0:
+                self.writer.writerow(self.FIELDS)
+
+    def write(self, file_path, reason, file_size=None, file_hash=None):
+        if self.is_csv:
+            self.writer.writerow((os.path.abspath(file_path), reason, '' if file_size is None else file_size,
+                                  file_hash or ''))
+        else:
+            self.file.write(json.dumps({'path': os.path.abspath(file_path), 'reason': reason, 'size': file_size,
+                                        'hash': file_hash}) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Class appending the runs, moves and removals of the organizer to the journal of a destination folder, as JSON lines.
+# Moves and removals are written before they are carried out and synced to disk once per batch (sync), so that after
+# a crash the journal lists every file that may have been moved or removed.
+class Journal:
+    def __init__(self, journal_path):
+        self.file = open(journal_path, 'a', encoding='utf-8')
+        # The last line is cut short when a run is killed while writing it: start the next entry on a line of its own
+        if self.file.tell() > 0:
+            with open(journal_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+# Function to read the entries of the journal of a destination folder, skipping lines cut short by a crash. With
+# archived, the entries of the archived runs come first.
+def read_journal(folder, archived=False):
+    filenames = (JOURNAL_ARCHIVE_FILENAME, JOURNAL_FILENAME) if archived else (JOURNAL_FILENAME,)
+
+    entries = []
+    for filename in filenames:
+        journal_path = os.path.join(folder, filename)
+        if not os.path.exists(journal_path):
+            continue
+        with open(journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    return entries
+
+# Function to read the last entry of a journal file from its end, or None if it has none
+def read_last_journal_entry(journal_path):
+    try:
+        with open(journal_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 65536, 0))
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+# Function to move the finished runs of the journal of a destination folder, given its entries, to the archive of the
+# folder, so that the journal only holds the run that may be resumed and starting a run doesn't read the whole history.
+# Only the entries needed by check_removals are archived: the files left in place are checked again by the next run.
+def archive_journal(folder, entries):
+    unfinished_entries = find_interrupted_run(entries) or []
+    finished_entries = entries[:len(entries) - len(unfinished_entries)]
+    if not finished_entries:
+        return
+
+    # A crash after archiving the runs but before trimming the journal leaves them in both: their last archived entry is
+    # then the last entry of the archive
+    archived_entries = [entry for entry in finished_entries if entry['op'] in ARCHIVED_JOURNAL_OPS]
+    if archived_entries and read_last_journal_entry(os.path.join(folder, JOURNAL_ARCHIVE_FILENAME)) != archived_entries[-1]:
+        archive = Journal(os.path.join(folder, JOURNAL_ARCHIVE_FILENAME))
+        for entry in archived_entries:
+            archive.write(entry)
+        archive.close()
+
+    journal_path = os.path.join(folder, JOURNAL_FILENAME)
+    if not unfinished_entries:
+        os.remove(journal_path)
+        return
+
+    # Replace the journal with the unfinished run, written to a temporary file first so that a crash keeps the old one
+    temporary_path = get_temporary_path(journal_path)
+    with open(temporary_path, 'w', encoding='utf-8') as f:
+        for entry in unfinished_entries:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, journal_path)
+
+# Function to get the entries of the last run of a journal when it never finished, or None
+def find_interrupted_run(entries):
+    run_start = None
+    for i, entry in enumerate(entries):
+        if entry['op'] == 'run':
+            run_start = i
+    if run_start is None or any(entry['op'] == 'end' for entry in entries[run_start:]):
+        return None
+    return entries[run_start:]
+
+# Function to check the duplicates removed by the runs journaled in a destination folder: each one should still have
+# its kept copy, found through the moves of the journal, with the same size and hash. Kept copies the city name was
+# written into are hashed with the comment it replaced, as journaled. With restore, the missing duplicates are copied
+# back from their kept copy, with that comment. Returns the removal entries with their kept copy and status.
+def check_removals(folder, restore=False):
+    entries = read_journal(folder, archived=True)
+    moved = {entry['source']: entry['destination'] for entry in entries if entry['op'] == 'moved'}
+    replaced_comments = {entry['destination']: (entry['comment_offset'], bytes.fromhex(entry['comment']))
+                         for entry in entries if entry['op'] == 'moved' and 'comment' in entry}
+
+    results = []
+    for entry in entries:
+        # Duplicates replaced by links are still in place
+        if entry['op'] != 'remove' or entry.get('mode', 'delete') != 'delete':
+            continue
+
+        # Follow the kept copy to where it was moved, possibly by a later run
+        kept_path = entry['kept']
+        for _ in range(len(moved)):
+            if kept_path not in moved:
+                break
+            kept_path = moved[kept_path]
+
+        if os.path.exists(entry['source']):
+            status = 'present'
+        elif not os.path.exists(kept_path):
+            status = 'missing'
+        elif os.path.getsize(kept_path) != entry['size'] or (entry.get('hash') and hash_file_with_comment(
+                kept_path, get_hash_algorithm(entry['hash']), replaced_comments.get(kept_path)) != entry['hash']):
+            status = 'changed'
+        elif restore:
+            # Copy to a temporary name first, so that an interrupted copy is never taken for the duplicate
+            os.makedirs(os.path.dirname(entry['source']), exist_ok=True)
+            temporary_path = get_temporary_path(entry['source'])
+            shutil.copy2(kept_path, temporary_path)
+            if kept_path in replaced_comments:
+                comment_offset, comment = replaced_comments[kept_path]
+                with open(temporary_path, 'r+b') as f:
+                    f.seek(comment_offset)
+                    f.write(comment)
+            os.replace(temporary_path, entry['source'])
+            status = 'restored'
+        else:
+            status = 'ok'
+        results.append((entry, kept_path, status))
+    return results
+
+# Class organizing the photos and videos of a source folder into the year/month tree of a destination folder. All the
+# state of a run (hashes seen, photo counts, destination index, cache connection, statistics) belongs to the instance,
+# so that several organizers can run in the same process; create one per run.
+class Organizer:
+    def __init__(self, source_folder, destination_folder, geocoder=None, workers=1, include_patterns=(),
+                 exclude_patterns=(), fast_quality_check=True, brightness_threshold=DEFAULT_BRIGHTNESS_THRESHOLD,
+                 sharpness_threshold=None, clipping_threshold=None, near_duplicate_threshold=None,
+                 geocode_grid=DEFAULT_GEOCODE_GRID, metadata_mode='exif', use_cache=True, plan_path=None, report_path=None,
+                 use_journal=True, resume=False, duplicate_mode='delete', hash_algorithm=DEFAULT_HASH_ALGORITHM,
+                 verify_copies='full', verbose=True):
+        if metadata_mode not in METADATA_MODES:
+            raise ValueError(f"Unknown metadata mode: {metadata_mode}")
+        if duplicate_mode not in DUPLICATE_MODES:
+            raise ValueError(f"Unknown duplicate mode: {duplicate_mode}")
+        if hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm: {hash_algorithm}")
+        if verify_copies not in VERIFY_MODES:
+            raise ValueError(f"Unknown copy verification: {verify_copies}")
+        if resume and (plan_path is not None or not use_journal):
+            raise ValueError("Resuming needs the journal, which isn't kept when planning")
 
-    # Check if there are existing files with similar naming pattern
-    existing_files = [f for f in os.listdir(destination_folder) if f.startswith(f"{file_name}_")]
-    existing_counters = [int(f.split('_')[-1].split('.')[0]) for f in existing_files if f.split('_')[-1].split('.')[0].isdigit()]
+        # Folder containing unstructured photos/videos (taken from the plan by apply_plan when None)
+        self.source_folder = source_folder
 
-    if existing_counters:
-        # If there are existing counters, find the highest one and start the counter from the next number
-        counter = max(existing_counters) + 1
+        # Folder where the organized tree will be created (taken from the plan by apply_plan when None)
+        self.destination_folder = destination_folder
 
-    while os.path.exists(os.path.join(destination_folder, f"{file_name}_{counter}{file_extension}")):
-        counter += 1
+        # Geocoder backend used by reverse_geocode (an OpenCageBackend or a GeoNamesBackend), None to skip city names
+        self.geocoder = geocoder
 
-    new_filename = f"{file_name}_{counter}{file_extension}"
-    return new_filename
+        # Number of worker threads and processes used for hashing, EXIF parsing and quality checks
+        self.workers = max(1, workers)
 
-# Function to calculate the hash of a file
-def hash_file(file_to_hash):
-    BLOCK_SIZE = 65536
-    hasher = hashlib.sha256()
-    with open(file_to_hash, 'rb') as f:
-        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
-            hasher.update(block)
-    return hasher.hexdigest()
+        # File name patterns to organize (all files when empty) and file or folder name patterns to skip
+        self.include_patterns = list(include_patterns)
+        self.exclude_patterns = list(exclude_patterns)
 
-# Function to caputure low quality files
-def is_low_quality_image(image_path):
-    # Load the image using OpenCV
-    image = cv2.imread(image_path)
+        # Whether the quality check estimates brightness from a reduced-size decode or the EXIF thumbnail
+        self.fast_quality_check = fast_quality_check
 
-    # Assess image brightness (lower value indicates darker image)
-    brightness = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).mean()
+        # Quality thresholds: images darker than brightness_threshold (mean gray level from 0 to 255), blurrier than
+        # sharpness_threshold (variance of the Laplacian) or with more than clipping_threshold of their pixels black
+        # or white are low quality. Each check is off when its threshold is None, and images aren't decoded at all
+        # when all of them are.
+        self.brightness_threshold = brightness_threshold
+        self.sharpness_threshold = sharpness_threshold
+        self.clipping_threshold = clipping_threshold
 
-    # Assess image sharpness (lower value indicates blurrier image)
-    # sharpness = cv2.Laplacian(image, cv2.CV_64F).var()
+        # Largest number of differing bits between the difference hashes of two images considered near duplicates
+        # (None turns the near-duplicate check off)
+        self.near_duplicate_threshold = near_duplicate_threshold
 
-    # Assess image stability (higher value indicates more stable image)
-    # stability = cv2.Laplacian(image, cv2.CV_64F).mean()
+        # Size in degrees of the grid cells sharing a geocoding result
+        self.geocode_grid = geocode_grid
 
-    # You can define specific thresholds for brightness, sharpness, and stability
-    brightness_threshold = 25  # Adjust this value according to your preference
-    # sharpness_threshold = 50  # Adjust this value according to your preference
-    # stability_threshold = 20  # Adjust this value according to your preference
+        # Where city names are written, one of METADATA_MODES
+        self.metadata_mode = metadata_mode
 
-    # Return True if the image is considered low quality based on the thresholds
-    return brightness < brightness_threshold # or sharpness < sharpness_threshold
+        # Whether hashes, metadata and city names are cached in CACHE_FILENAME in the destination folder
+        self.use_cache = use_cache
 
-#4 Script Execution ------------------------------
+        # File the moves are written to instead of being carried out, when planning
+        self.plan_path = plan_path
+
+        # CSV or JSON lines file the files that are not organized are appended to, with their path, reason, size and hash
+        self.report_path = report_path
+
+        # Whether moves and removals are journaled in JOURNAL_FILENAME in the destination folder, and whether the
+        # interrupted run of the journal is resumed instead of starting a new one
+        self.use_journal = use_journal
+        self.resume = resume
 
-# Start processing files in the source folder and its sub-folders
-process_files(source_folder)
+        # What is done with duplicates, one of DUPLICATE_MODES
+        self.duplicate_mode = duplicate_mode
 
-# Delete empty folders after moving the files
-delete_empty_folders(source_folder)
+        # Algorithm files are hashed with to find duplicates, one of HASH_ALGORITHMS
+        self.hash_algorithm = hash_algorithm
 
-# After moving files, remove the temporary dictionary for city names
-def delete_temp_data():
-    global city_names_temp
-    city_names_temp = {}
+        # How files copied to another device are checked before the original is deleted, one of VERIFY_MODES
+        self.verify_copies = verify_copies
 
-# Print the list of files that were not moved and the reasons for the failure
-print("Files that were not moved:")
-for filename, reason in files_not_moved:
-    print(f"File: {filename}, Reason: {reason}")
+        # Whether a message is printed for every file, otherwise a progress line is shown
+        self.verbose = verbose
 
-# Print the total count of files that were not moved
-print(f"Total files not moved: {files_not_moved_count}")
+        # Dictionary to keep track of the photo count for each camera on a given day
+        self.photo_count = {}
 
-# The End!!!
\ No newline at end of file
+        # Number of files that were not organized by reason, the files themselves being listed in the report
+        self.not_moved_reasons = {}
+
+        # Count of files that were not moved
+        self.files_not_moved_count = 0
+
+        # Create a dictionary of file hashes that will be used to handle file duplications
+        self.file_hashes = {}
+
+        # Dictionary of media file paths grouped by size, used to skip hashing files that cannot have a duplicate
+        self.file_sizes = {}
+
+        # Dictionary of content keys for files whose size is shared with at least one other file
+        self.content_keys = {}
+
+        # Set of file sizes whose files have already been hashed
+        self.resolved_sizes = set()
+
+        # Wall time, CPU time, bytes read and number of files of each stage of the pipeline, added up by timed_stage
+        # and add_stage_bytes. CPU time is the time of the main process and its threads, not of the worker processes.
+        self.stage_stats = {stage: {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_read': 0, 'calls': 0} for stage in STAGES}
+        self.stage_lock = threading.Lock()
+
+        # Number of media files to process (when known), processed and moved, and when processing started, for the
+        # progress line and the summary
+        self.progress = {'total': None, 'processed': 0, 'moved': 0, 'start_time': time.perf_counter()}
+
+        # BK-tree of the difference hashes of the images kept so far
+        self.near_duplicate_tree = None
+
+        # City names of recently used grid cells, stored in the cache file as well so they are kept between runs
+        self.geocode_cache = OrderedDict()
+
+        # Counts of geocoding results found in memory, found in the cache file, and looked up by the geocoder backend
+        self.geocode_stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+        # Grid cells looked up ahead of naming by prefetch_geocodes, already counted as misses
+        self.prefetched_cells = set()
+
+        # Dictionary of the file names of each destination folder, listed once when the folder is first used
+        self.destination_names = {}
+
+        # Dictionary of the highest numeric suffix of the file names starting with each prefix, for each destination
+        # folder
+        self.destination_counters = {}
+
+        # Whether the destination folder ignores the case of file names (e.g. on macOS or Windows), checked once per run
+        self.destination_case_insensitive = None
+
+        # Dictionary of the media files already in the destination folder by size, to find files that were organized
+        # before. Each size has the files not hashed yet ('new') and the hashed files by partial hash ('partial'), so
+        # that only the destination files with the size of an incoming file get hashed, once.
+        self.destination_sizes = {}
+
+        # Device and inode of the media files already in the destination folder, to leave alone the source files that
+        # are one of them under another path (a hard link, or a folder reached through a link or a bind mount)
+        self.destination_inodes = set()
+
+        # Set of destination folders created (or found to exist) during this run
+        self.created_folders = set()
+
+        # Dictionary of the device of each source and destination folder, to rename files when they stay on the same
+        # device
+        self.folder_devices = {}
+
+        # Open plan file while planning
+        self.plan_file = None
+
+        # ReportWriter of the report, while running with a report
+        self.report = None
+
+        # Journal of the destination folder while running with a journal, and the id of the run in it
+        self.journal = None
+        self.run_id = None
+
+        # Size and modification time of files left in place that don't need to be checked again, by path, skipped when
+        # found unchanged: the files of the interrupted run being resumed, and the duplicates replaced by links
+        self.settled_files = {}
+
+        # Size and modification time of the files left in place journaled by the run, by path, so that each is journaled
+        # once while it is unchanged
+        self.journaled_skips = {}
+
+        # Connection to the cache, left as None when the cache is disabled
+        self.cache_db = None
+
+        # Number of cache writes not yet committed, committed in batches to avoid one disk sync per file
+        self.cache_pending_writes = 0
+
+        # Lock serializing the use of the cache connection by the worker threads
+        self.cache_lock = threading.RLock()
+
+    # Function to organize the files of the source folder once, returning the summary of the run
+    def run(self):
+        self.start_run()
+        try:
+            # Group the media files by size so that only files which may be duplicates get hashed
+            self.index_file_sizes(self.source_folder)
+            self.progress['total'] = sum(len(paths) for paths in self.file_sizes.values())
+
+            # Start processing files in the source folder and its sub-folders
+            self.process_files(self.source_folder)
+            self.end_journal()
+        finally:
+            self.finish_run()
+
+        # Delete empty folders after moving the files
+        if self.plan_path is None:
+            delete_empty_folders(self.source_folder)
+        return self.get_summary()
+
+    # Function to keep organizing the files arriving in the source folder, polling it every interval seconds until
+    # interrupted with Ctrl+C, and return the summary of the run
+    def watch(self, interval):
+        if self.plan_path is not None:
+            raise ValueError("Watching can't be combined with a plan")
+
+        self.start_run()
+        try:
+            # Keep the photo counts and destination index in memory between polls. The files of each poll are grouped
+            # by size like those of a run, and files organized by earlier polls are found in the destination index.
+            print(f"Watching {self.source_folder} for new files, press Ctrl+C to stop.")
+            self.watch_folder(self.source_folder, max(interval, 0.1))
+            self.end_journal()
+        except KeyboardInterrupt:
+            # The run isn't finished when stopped while files were being processed
+            print("Stopped while organizing files, run again with --resume to finish them.")
+        finally:
+            self.finish_run()
+        return self.get_summary()
+
+    # Function to open the journal, the cache, the plan file and the report, and index the destination folder, before
+    # processing files
+    def start_run(self):
+        # Journal the moves and removals, unless planning, which changes no file
+        if self.use_journal and self.plan_path is None:
+            self.open_journal()
+
+        # Open the cache of file hashes and metadata kept in the destination folder
+        if self.use_cache:
+            self.cache_db = open_cache(self.destination_folder)
+
+        if self.report_path is not None:
+            self.report = ReportWriter(self.report_path)
+
+        # Write the plan to a file instead of moving the files, starting with the folders and the metadata mode it was
+        # made for
+        if self.plan_path is not None:
+            self.plan_file = open(self.plan_path, 'w', encoding='utf-8')
+            self.write_plan_entry({'plan': 1, 'source': os.path.abspath(self.source_folder),
+                                   'destination': os.path.abspath(self.destination_folder),
+                                   'metadata_mode': self.metadata_mode})
+
+        self.progress['start_time'] = time.perf_counter()
+
+        # List the files organized by earlier runs, to remove incoming files already in the destination folder
+        self.index_destination_folder()
+
+    # Function to save the cache and close the journal, the plan file and the report after processing files
+    def finish_run(self):
+        self.report_progress(final=True)
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            archive_journal(self.destination_folder, read_journal(self.destination_folder))
+
+        # Save the cache for the next run
+        self.close_cache()
+
+        if self.report is not None:
+            self.report.close()
+            self.report = None
+
+        if self.plan_file is not None:
+            self.plan_file.close()
+            self.plan_file = None
+
+    # Function to open the journal of the destination folder and start a run in it, or resume its interrupted run
+    def open_journal(self):
+        entries = read_journal(self.destination_folder)
+        archive_journal(self.destination_folder, entries)
+        interrupted_run = find_interrupted_run(entries)
+        if self.resume and interrupted_run is None:
+            raise ValueError(f"No interrupted run to resume in {self.destination_folder}")
+        if not self.resume and interrupted_run is not None:
+            print(f"The last run in {self.destination_folder} was interrupted, run with --resume to continue it.")
+
+        os.makedirs(self.destination_folder, exist_ok=True)
+        self.journal = Journal(os.path.join(self.destination_folder, JOURNAL_FILENAME))
+        if self.resume:
+            self.restore_run(interrupted_run)
+            self.journal.write({'op': 'resume', 'run': self.run_id})
+        else:
+            # Runs started within the same second get their own id, which tells their archived entries apart
+            self.run_id = datetime.now().isoformat(timespec='microseconds')
+            self.journal.write({'op': 'run', 'run': self.run_id, 'source': os.path.abspath(self.source_folder),
+                                'destination': os.path.abspath(self.destination_folder)})
+        self.journal.sync()
+
+    # Function to pick up the state of an interrupted run from its journal entries: the photo counts of the moved files, the
+    # files left in place, and the temporary copies of the moves it didn't finish. Moved and removed files are no
+    # longer in the source folder, and a file copied but not yet removed is found as a duplicate in the destination.
+    # Moves done but not journaled as such before the crash are journaled now, for check_removals.
+    def restore_run(self, entries):
+        self.run_id = entries[0]['run']
+        moved_paths = {entry['source'] for entry in entries if entry['op'] == 'moved'}
+
+        for entry in entries:
+            if entry['op'] != 'move':
+                if entry['op'] == 'skip':
+                    self.settled_files[entry['source']] = (entry['size'], entry['mtime_ns'])
+                    self.journaled_skips[entry['source']] = (entry['size'], entry['mtime_ns'])
+                continue
+
+            # A file linked to its destination but not unlinked from its source yet only needs the unlink
+            if entry['source'] not in moved_paths and os.path.exists(entry['destination']) \
+                    and os.path.exists(entry['source']) and os.path.samefile(entry['source'], entry['destination']):
+                os.unlink(entry['source'])
+
+            # A move is done when it was journaled as such, or when its file reached the destination before the crash
+            if entry['source'] not in moved_paths and os.path.exists(entry['destination']) \
+                    and not os.path.exists(entry['source']):
+                self.journal.write({'op': 'moved', 'source': entry['source'], 'destination': entry['destination']})
+                moved_paths.add(entry['source'])
+
+            if entry['source'] in moved_paths or os.path.exists(entry['destination']):
+                # Number the next photos of a camera and day after the highest count of the files moved
+                if entry.get('count') is not None:
+                    counts = self.photo_count.setdefault(entry['camera'], {})
+                    capture_date = datetime.fromisoformat(entry['date']).date()
+                    counts[capture_date] = max(counts.get(capture_date, 0), entry['count'])
+            elif os.path.exists(get_temporary_path(entry['destination'])):
+                os.remove(get_temporary_path(entry['destination']))
+
+    # Function to mark the run as finished in the journal, so that it isn't offered for resuming
+    def end_journal(self):
+        if self.journal is not None:
+            self.journal.write({'op': 'end', 'run': self.run_id})
+
+    # Generator function to list the files of a directory and its sub-directories with os.scandir, without recursion.
+    # Files come in the order a recursive os.listdir walk gives them, and pruned or excluded folders aren't entered.
+    # Symbolic links to folders are followed, but each folder is entered only once, so that a link to a parent folder
+    # doesn't loop and a linked tree isn't listed twice.
+    def discover_files(self, directory):
+        pruned_paths = {os.path.abspath(self.destination_folder)} if self.destination_folder else set()
+        root_stat = os.stat(directory)
+        visited_folders = {(root_stat.st_dev, root_stat.st_ino)}
+        pending_entries = [iter(scan_folder(directory))]
+
+        while pending_entries:
+            entry = next(pending_entries[-1], None)
+            if entry is None:
+                pending_entries.pop()
+            elif entry.is_dir():
+                if self.is_pruned_folder(entry.name) or os.path.abspath(entry.path) in pruned_paths:
+                    continue
+                folder_stat = entry.stat()
+                if (folder_stat.st_dev, folder_stat.st_ino) not in visited_folders:
+                    visited_folders.add((folder_stat.st_dev, folder_stat.st_ino))
+                    pending_entries.append(iter(scan_folder(entry.path)))
+            elif self.is_selected_file(entry.name):
+                yield entry
+
+    # Function to check whether a folder is skipped, being a thumbnail/system folder or matching an --exclude pattern
+    def is_pruned_folder(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in PRUNED_FOLDERS + self.exclude_patterns)
+
+    # Function to check whether a file name matches the --include patterns (if any) and none of the --exclude patterns
+    def is_selected_file(self, name):
+        if self.include_patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in self.include_patterns):
+            return False
+        return not any(fnmatch.fnmatch(name, pattern) for pattern in self.exclude_patterns)
+
+    # Function to print a message about a file, unless verbose is off (--quiet)
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    # Function to time a stage of the pipeline that handles a number of files, adding up its wall and CPU time
+    @contextlib.contextmanager
+    def timed_stage(self, name, calls=1):
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            yield
+        finally:
+            self.record_stage_time(name, start_time, start_cpu_time, calls)
+
+    # Function to add the time since a start time to a stage
+    def record_stage_time(self, name, start_time, start_cpu_time, calls):
+        with self.stage_lock:
+            stats = self.stage_stats[name]
+            stats['wall_seconds'] += time.perf_counter() - start_time
+            stats['cpu_seconds'] += time.process_time() - start_cpu_time
+            stats['calls'] += calls
+
+    # Function to add bytes read (or copied, for moves) to a stage; called from the worker threads too
+    def add_stage_bytes(self, name, count):
+        with self.stage_lock:
+            self.stage_stats[name]['bytes_read'] += count
+
+    # Generator function to time the walk of a folder, which is interleaved with the processing of the files it finds,
+    # as a stage
+    def timed_walk(self, entries, stage='walk'):
+        iterator = iter(entries)
+        while True:
+            start_time = time.perf_counter()
+            start_cpu_time = time.process_time()
+            entry = next(iterator, None)
+            self.record_stage_time(stage, start_time, start_cpu_time, 0 if entry is None else 1)
+            if entry is None:
+                return
+            yield entry
+
+    # Function to show the number of processed files, the files/s and the time left on a line that is rewritten after
+    # each batch, with --quiet
+    def report_progress(self, final=False):
+        if self.verbose:
+            return
+
+        elapsed = time.perf_counter() - self.progress['start_time']
+        rate = self.progress['processed'] / elapsed if elapsed > 0 else 0
+        line = f"{self.progress['processed']}"
+        if self.progress['total']:
+            line += f"/{self.progress['total']}"
+        line += f" files, {self.progress['moved']} moved, {rate:.1f} files/s"
+        if self.progress['total'] and rate > 0 and not final:
+            line += f", ETA {format_duration(max(self.progress['total'] - self.progress['processed'], 0) / rate)}"
+        sys.stderr.write('\r' + line.ljust(70) + ('\n' if final else ''))
+        sys.stderr.flush()
+
+    # Function to get the summary of the run: the files processed, moved and left, and the statistics of each stage
+    def get_summary(self):
+        elapsed = time.perf_counter() - self.progress['start_time']
+        return {
+            'seconds': round(elapsed, 3),
+            'files_processed': self.progress['processed'],
+            'files_moved': self.progress['moved'],
+            'files_not_moved': self.files_not_moved_count,
+            'reasons': dict(self.not_moved_reasons),
+            'files_per_second': round(self.progress['processed'] / elapsed, 1) if elapsed > 0 else None,
+            'stages': {name: dict(stats, wall_seconds=round(stats['wall_seconds'], 3),
+                                  cpu_seconds=round(stats['cpu_seconds'], 3)) for name, stats in self.stage_stats.items()},
+            'geocode_cache': dict(self.geocode_stats),
+        }
+
+    # Function to write the summary of the run to a JSON file
+    def write_summary(self, summary_path):
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_summary(), f, indent=2)
+
+    # Function to print the time, bytes read and files of each stage
+    def print_stage_report(self):
+        print("Stage times:")
+        for name, stats in self.stage_stats.items():
+            print(f"{name:>10}: {stats['wall_seconds']:8.2f} s wall, {stats['cpu_seconds']:8.2f} s CPU, "
+                  f"{stats['bytes_read'] / 1e6:10.1f} MB read, {stats['calls']} files")
+
+    # Function to process files in a directory and its sub-directories, in batches that go through the pipeline stages
+    def process_files(self, directory):
+        thread_pool, process_pool = self.create_pools()
+        try:
+            self.process_entries(self.timed_walk(self.discover_files(directory)), thread_pool, process_pool)
+        finally:
+            shutdown_pools(thread_pool, process_pool)
+
+    # Function to create the pools of the pipeline, or none when everything runs in the main thread
+    def create_pools(self):
+        # Hashing and EXIF parsing wait on the disk and run in threads, the quality check needs CPU and runs in processes
+        if self.workers > 1:
+            return ThreadPoolExecutor(max_workers=self.workers), ProcessPoolExecutor(max_workers=self.workers)
+        return None, None
+
+    # Function to process files found by discover_files in batches
+    def process_entries(self, entries, thread_pool, process_pool):
+        batch = []
+        for entry in entries:
+            # Check if the file is a photo or video file. If it isn't, log and count it as not moved.
+            if entry.name.lower().endswith(MEDIA_EXTENSIONS):
+                # The size comes from the stat kept by the DirEntry
+                stat = entry.stat()
+
+                # Files that are already in the destination folder under another path are left as they are
+                if (stat.st_dev, stat.st_ino) in self.destination_inodes:
+                    self.skip_file(entry.path, "Already in the destination folder", stat.st_size)
+                    self.progress['processed'] += 1
+                    continue
+
+                # Files left in place by the interrupted run or replaced by links are skipped when unchanged
+                if self.settled_files and \
+                        self.settled_files.pop(os.path.abspath(entry.path), None) == (stat.st_size, stat.st_mtime_ns):
+                    self.progress['processed'] += 1
+                    continue
+
+                batch.append((entry.path, stat.st_size))
+                if len(batch) >= BATCH_SIZE:
+                    self.process_batch(batch, thread_pool, process_pool)
+                    batch = []
+            else:
+                self.skip_file(entry.path, "Not a media file-extension")
+
+        if batch:
+            self.process_batch(batch, thread_pool, process_pool)
+
+    # Function to keep processing the files arriving in a folder, polling it every interval seconds until interrupted
+    def watch_folder(self, directory, interval):
+        # Files changed after the high-water mark are new. Files stamped exactly at the mark are remembered, since a
+        # file arriving right after a poll can get the same timestamp on filesystems with coarse timestamps.
+        high_water = 0
+        high_water_paths = set()
+        # Size and timestamp of the new files that may still be being written
+        pending = {}
+
+        processing = False
+        thread_pool, process_pool = self.create_pools()
+        try:
+            while True:
+                poll_start = time.time_ns()
+                arrived = []
+                still_pending = {}
+                newest = high_water
+                newest_paths = set(high_water_paths)
+
+                for entry in self.timed_walk(self.discover_files(directory)):
+                    stat = entry.stat()
+                    # The change time also covers files moved into the folder, which keep their modification time
+                    stamp = max(stat.st_mtime_ns, stat.st_ctime_ns)
+                    if entry.path not in pending and (stamp < high_water or (stamp == high_water and entry.path in high_water_paths)):
+                        continue
+
+                    if stamp > newest:
+                        newest = stamp
+                        newest_paths = set()
+                    if stamp == newest:
+                        newest_paths.add(entry.path)
+
+                    # A file is fully written once it didn't change for a whole interval
+                    if pending.get(entry.path) == (stat.st_size, stamp) or poll_start - stamp >= interval * 1e9:
+                        arrived.append(entry)
+                    else:
+                        still_pending[entry.path] = (stat.st_size, stamp)
+
+                high_water = newest
+                high_water_paths = newest_paths
+                pending = still_pending
+
+                if arrived:
+                    # Group the arrived files by size, so that only those which may be duplicates of each other get
+                    # hashed. The keys of earlier polls are dropped, since a size seen alone then may come again.
+                    processing = True
+                    self.file_hashes = {}
+                    self.file_sizes = {}
+                    self.content_keys = {}
+                    self.resolved_sizes = set()
+                    self.index_entry_sizes(arrived)
+                    self.process_entries(arrived, thread_pool, process_pool)
+                    self.cache_commit()
+                    processing = False
+
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            # Stopping between polls leaves no file half organized, and ends the watch like a finished run
+            if processing:
+                raise
+        finally:
+            shutdown_pools(thread_pool, process_pool)
+
+    # Function to run a batch of media files through hashing, duplicate removal, quality check, EXIF parsing and moving
+    def process_batch(self, batch, thread_pool, process_pool):
+        file_paths = [file_path for file_path, file_size in batch]
+        batch_sizes = [file_size for file_path, file_size in batch]
+
+        with self.timed_stage('hash', len(batch)):
+            # Hash the size groups reached for the first time in this batch, before any of their files is modified
+            new_sizes = []
+            for file_path, file_size in batch:
+                paths = self.file_sizes.get(file_size, [])
+                if len(paths) > 1 and file_size not in self.resolved_sizes and file_path in paths:
+                    self.resolved_sizes.add(file_size)
+                    new_sizes.append(file_size)
+            pool_map(thread_pool, self.resolve_size_bucket, new_sizes)
+
+            # Get a key identifying the content of each file, hashing only when another file has the same size
+            file_keys = pool_map(thread_pool, self.get_content_key, file_paths, batch_sizes)
+
+            # Check which files are duplicates based on content, in the order the files were found
+            duplicates = []
+            new_paths = []
+            new_path_sizes = []
+            for file_path, file_size, file_hash in zip(file_paths, batch_sizes, file_keys):
+                if file_hash in self.file_hashes:
+                    duplicates.append((file_path, file_size, self.file_hashes[file_hash][0], file_hash))
+                else:
+                    # Add the file to the dictionary with its hash as the key
+                    self.file_hashes[file_hash] = [file_path]
+                    new_paths.append(file_path)
+                    new_path_sizes.append(file_size)
+
+            # Check which of the remaining files were organized by an earlier run
+            self.hash_destination_sizes(thread_pool, new_path_sizes)
+            organized_paths = pool_map(thread_pool, self.find_in_destination, new_paths, new_path_sizes)
+            unique_paths = []
+            for file_path, file_size, (organized_path, file_hash) in zip(new_paths, new_path_sizes, organized_paths):
+                if organized_path is not None:
+                    duplicates.append((file_path, file_size, organized_path, file_hash))
+                else:
+                    unique_paths.append(file_path)
+            self.remove_duplicates(duplicates)
+
+        # Assess image quality and leave low-quality images out, scoring the images in chunks of QUALITY_CHUNK_SIZE.
+        # Images aren't decoded at all when every quality check is off.
+        image_paths = [file_path for file_path in unique_paths if file_path.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif'))]
+        if (self.brightness_threshold, self.sharpness_threshold, self.clipping_threshold) == (None, None, None):
+            image_paths = []
+        with self.timed_stage('quality', len(image_paths)):
+            chunks = [image_paths[i:i + QUALITY_CHUNK_SIZE] for i in range(0, len(image_paths), QUALITY_CHUNK_SIZE)]
+            # The EXIF thumbnail is too small to tell how sharp the image is
+            quality_check = partial(score_images, fast=self.fast_quality_check,
+                                    use_thumbnail=self.sharpness_threshold is None,
+                                    brightness_threshold=self.brightness_threshold)
+            image_scores = [scores for chunk_scores in pool_map(process_pool, quality_check, chunks) for scores in chunk_scores]
+            # The images are read by the worker processes, which can't count their bytes: count the files they decode
+            self.add_stage_bytes('quality', sum(os.path.getsize(file_path) for file_path in image_paths))
+            low_quality_reasons = {}
+            for file_path, scores in zip(image_paths, image_scores):
+                reason = self.get_low_quality_reason(*scores)
+                if reason is not None:
+                    low_quality_reasons[file_path] = reason
+
+            kept_paths = []
+            for file_path in unique_paths:
+                if file_path in low_quality_reasons:
+                    self.skip_file(file_path, low_quality_reasons[file_path])
+                else:
+                    kept_paths.append(file_path)
+
+            # Leave out resized, recompressed or re-exported copies of the images kept so far
+            if self.near_duplicate_threshold is not None:
+                kept_paths = self.remove_near_duplicates(kept_paths, process_pool)
+
+        # Read the capture date, camera and GPS coordinates, from the cache if the file is unchanged
+        with self.timed_stage('exif', len(kept_paths)):
+            kept_metadata = pool_map(thread_pool, self.get_metadata, kept_paths)
+
+        # Look up the city names of the batch concurrently, instead of one request at a time while moving
+        coordinates = [(metadata['lat'], metadata['lon']) for metadata in kept_metadata
+                       if metadata['lat'] is not None and metadata['lon'] is not None]
+        with self.timed_stage('geocode', len(coordinates)):
+            self.prefetch_geocodes(coordinates)
+
+        # Name the files one at a time, so that photo counts and duplicate names don't depend on timing
+        with self.timed_stage('rename', len(kept_paths)):
+            moves = []
+            for file_path, metadata in zip(kept_paths, kept_metadata):
+                move = self.organize_file(file_path, metadata)
+                if move is not None:
+                    moves.append(move)
+
+        # Move the files of the batch, grouped by destination folder, or write the moves to the plan
+        with self.timed_stage('move', len(moves)):
+            if self.plan_file is not None:
+                for move in moves:
+                    self.write_plan_entry({'action': 'move', 'source': self.plan_source_path(move['source']),
+                                           'destination': os.path.relpath(move['destination'], self.destination_folder),
+                                           'size': os.path.getsize(move['source']), 'city': move['city']})
+            else:
+                self.execute_moves(moves)
+
+        self.progress['processed'] += len(batch)
+        self.report_progress()
+        if self.report is not None:
+            self.report.flush()
+
+    # Function to count a file that isn't organized by its reason, and append it to the report if there is one
+    def record_not_moved(self, file_path, reason, file_size=None, file_hash=None):
+        self.not_moved_reasons[reason] = self.not_moved_reasons.get(reason, 0) + 1
+        if self.report is not None:
+            if file_size is None:
+                try:
+                    file_size = os.path.getsize(file_path)
+                except OSError:
+                    pass
+            self.report.write(file_path, reason, file_size, file_hash)
+
+    # Function to log a file that is left where it is, and note it in the plan when planning
+    def skip_file(self, file_path, reason, file_size=None):
+        self.log(f"File: {file_path}, Reason: {reason}")
+        self.record_not_moved(file_path, reason, file_size)
+        self.files_not_moved_count += 1
+        if self.plan_file is not None:
+            self.write_plan_entry({'action': 'skip', 'source': self.plan_source_path(file_path), 'reason': reason})
+
+        # Journal the media files left in place, so that a resumed run doesn't check them again
+        if self.journal is not None and file_path.lower().endswith(MEDIA_EXTENSIONS):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return
+            source = os.path.abspath(file_path)
+            if self.journaled_skips.get(source) == (stat.st_size, stat.st_mtime_ns):
+                return
+            self.journaled_skips[source] = (stat.st_size, stat.st_mtime_ns)
+            self.journal.write({'op': 'skip', 'source': source, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                'reason': reason})
+
+    # Function to remove duplicate files, journaling all the removals and syncing the journal once before any of them
+    # is carried out, so that each removed file can be audited or restored from its kept copy
+    def remove_duplicates(self, duplicates):
+        if self.journal is not None and duplicates:
+            for file_path, file_size, kept_path, file_hash in duplicates:
+                self.journal.write({'op': 'remove', 'source': os.path.abspath(file_path), 'size': file_size,
+                                    'hash': file_hash, 'kept': os.path.abspath(kept_path), 'mode': self.duplicate_mode})
+            self.journal.sync()
+
+        for file_path, file_size, kept_path, file_hash in duplicates:
+            self.remove_duplicate(file_path, file_size, kept_path, file_hash)
+
+    # Function to remove a duplicate file or replace it with a link to its kept copy, or note its removal in the plan
+    # when planning
+    def remove_duplicate(self, file_path, file_size, kept_path, file_hash=None):
+        if self.plan_file is not None:
+            entry = {'action': 'remove', 'source': self.plan_source_path(file_path), 'size': file_size}
+            if file_hash is not None:
+                entry['hash'] = file_hash
+            if self.is_in_destination(kept_path):
+                entry['duplicate_in_destination'] = os.path.relpath(kept_path, self.destination_folder)
+            else:
+                entry['duplicate_of'] = self.plan_source_path(kept_path)
+            self.write_plan_entry(entry)
+            self.record_not_moved(file_path, "Duplicate - Removed", file_size, file_hash)
+            return
+
+        if self.duplicate_mode != 'delete':
+            self.link_duplicate(file_path, file_size, kept_path, file_hash)
+            return
+
+        # Remove the duplicate file
+        try:
+            os.remove(file_path)
+            self.log(f"Removed duplicate file: {file_path}")
+            self.cache_forget(file_path)
+            # Log the deleted file in the report
+            self.record_not_moved(file_path, "Duplicate - Removed", file_size, file_hash)
+        except FileNotFoundError:
+            # If the file was already deleted (e.g., by a previous iteration), just continue to the next file
+            pass
+
+    # Function to replace a duplicate file with a hard link or a reflink to its kept copy, leaving it in place
+    def link_duplicate(self, file_path, file_size, kept_path, file_hash=None):
+        reason = "Duplicate - Hardlinked" if self.duplicate_mode == 'hardlink' else "Duplicate - Reflinked"
+        try:
+            # Duplicates hard linked by an earlier run are left as they are
+            if not (self.duplicate_mode == 'hardlink' and os.path.samefile(file_path, kept_path)):
+                link_duplicate(file_path, kept_path, self.duplicate_mode)
+                self.log(f"Replaced duplicate file {file_path} with a {self.duplicate_mode} to {kept_path}")
+                self.cache_forget(file_path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # The duplicate is kept as it is when the filesystem can't link it, e.g. across devices
+            self.log(f"File: {file_path}, Reason: {e.strerror or e}")
+            reason = "Duplicate - Not linked"
+
+        self.record_not_moved(file_path, reason, file_size, file_hash)
+        # The link changes the change time of the file, which would make a watched folder report it as new
+        stat = os.stat(file_path)
+        self.settled_files[os.path.abspath(file_path)] = (stat.st_size, stat.st_mtime_ns)
+
+    # Function to rename a file from its metadata and plan its move to the year/month folder of the destination folder
+    def organize_file(self, file_path, metadata):
+        filename = os.path.basename(file_path)
+        capture_date = metadata['capture_date']
+        camera_brand = metadata['camera_brand']
+        camera_model = metadata['camera_model']
+        lat, lon = metadata['lat'], metadata['lon']
+
+        # Fallback to modification date if capture date is not available
+        if capture_date is None:
+            modification_time = os.path.getmtime(file_path)
+            capture_date = datetime.fromtimestamp(modification_time)
+
+        if self.geocoder is None:
+            # City names are left out when there is no geocoder
+            city_name = None
+        elif lat is not None and lon is not None:
+            # Reverse geocode the coordinates to get the city name
+            city_name = self.reverse_geocode(lat, lon)
+
+            # The city name is written to the file's metadata by execute_moves, right before the file is moved
+            if not city_name:
+                self.log("City name not found.")
+                city_name = None
+        else:
+            self.log("GPS coordinates not found in the image metadata.")
+            city_name = None
+
+        # Generate a new filename based on capture date, camera brand, camera model, city name, and photo count
+        file_extension = os.path.splitext(filename)[1]
+        new_filename = self.generate_new_filename(capture_date, camera_brand, camera_model, city_name, file_extension)
+        # Remove any invalid characters from the new filename
+        valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
+        new_filename = ''.join(c for c in new_filename if c in valid_chars)
+
+        # Extract year and month from the capture date
+        year = str(capture_date.year)
+        month = str(capture_date.month).zfill(2)  # Zero-padding for single-digit months (e.g., 01, 02)
+        day = str(capture_date.day).zfill(2)  # Zero-padding for single-digit days (e.g., 01, 02)
+
+        # Determine the destination path and handle duplication of file names at the destination folder
+        destination_year_folder = os.path.join(self.destination_folder, year)
+        destination_month_folder = os.path.join(destination_year_folder, month)
+        if self.destination_name_exists(destination_month_folder, new_filename):
+            new_filename = self.resolve_duplicate_filename(destination_month_folder, new_filename)
+        destination_path = os.path.join(destination_month_folder, new_filename)
+
+        # Skip if the destination path is invalid
+        if '\x00' in destination_path:
+            self.log(f"Skipping file '{filename}' due to an invalid destination path.")
+            return None
+
+        # Reserve the name, so that the next files don't pick it before the move is done
+        self.add_destination_name(destination_month_folder, new_filename)
+        # The photo count given out is journaled with the move, so that a resumed run numbers on from it
+        return {'source': file_path, 'destination': destination_path, 'city': city_name, 'camera': camera_model,
+                'date': capture_date.date().isoformat(), 'count': self.photo_count[camera_model][capture_date.date()]}
+
+    # Function to write the city names of files to their metadata and move the files, folder by folder, creating each
+    # destination folder only once per run
+    def execute_moves(self, moves):
+        # Journal the moves before carrying them out, syncing the journal once for the whole batch
+        if self.journal is not None and moves:
+            for move in moves:
+                self.journal.write({'op': 'move', 'source': os.path.abspath(move['source']),
+                                    'destination': os.path.abspath(move['destination']), 'camera': move.get('camera'),
+                                    'date': move.get('date'), 'count': move.get('count')})
+            self.journal.sync()
+
+        moves_by_folder = {}
+        for move in moves:
+            moves_by_folder.setdefault(os.path.dirname(move['destination']), []).append(move)
+
+        for destination_month_folder, folder_moves in moves_by_folder.items():
+            # Create the destination folder if it doesn't exist
+            if destination_month_folder not in self.created_folders:
+                os.makedirs(destination_month_folder, exist_ok=True)
+                self.created_folders.add(destination_month_folder)
+
+            # Move the files to the new location with the renamed file, or count and log as not moved
+            for move in folder_moves:
+                file_path = move['source']
+                destination_path = move['destination']
+                filename = os.path.basename(file_path)
+
+                # Write the city name into the EXIF data of JPEG and TIFF files when it fits, otherwise to a sidecar.
+                # It is written into the moved file, so that the source file is left as it was if the move fails.
+                exif_city = None
+                sidecar_city = None
+                if move['city'] and self.metadata_mode != 'none':
+                    if self.metadata_mode == 'exif' and filename.lower().endswith(('.jpg', '.jpeg','.tiff', '.tif')):
+                        exif_city = move['city']
+                    else:
+                        sidecar_city = move['city']
+
+                try:
+                    # A file hard linked by other paths (e.g. duplicates replaced with a hard link to it) would have
+                    # the city name written into all of them, so it goes to a sidecar instead
+                    if exif_city and os.stat(file_path).st_nlink > 1:
+                        sidecar_city = exif_city
+                        exif_city = None
+
+
+                    # The hashes of the content before the city name is written let later runs find copies of the
+                    # original in the destination folder. They are worked out from the written file and the comment
+                    # it replaced, except for the partial hash of files larger than 2 * PARTIAL_HASH_SIZE bytes.
+                    source_hashes = None
+                    if exif_city and os.path.getsize(file_path) > 2 * PARTIAL_HASH_SIZE:
+                        source_hashes = (self.get_partial_hash(file_path, os.path.getsize(file_path)),
+                                         self.get_full_hash(file_path))
+                    destination_path = self.move_to_free_path(file_path, destination_path, folder_moves)
+                    self.log(f"Moved {filename} to {destination_path}")
+
+                    replaced_comment = None
+                    if exif_city:
+                        written_comment = self.write_city_to_exif(destination_path, exif_city)
+                        if written_comment is None:
+                            sidecar_city = exif_city
+                        elif written_comment[1] is not None:
+                            self.log(f"City name '{exif_city}' added to EXIF metadata.")
+                            replaced_comment = written_comment
+                            if source_hashes is None:
+                                source_hash = hash_file_with_comment(destination_path, self.hash_algorithm, replaced_comment)
+                                self.add_stage_bytes('hash', os.path.getsize(destination_path))
+                                source_hashes = (source_hash, source_hash)
+
+                    # The comment the city name replaced lets audits check the file as a kept copy, and restores
+                    # bring back the original content
+                    if self.journal is not None:
+                        moved_entry = {'op': 'moved', 'source': os.path.abspath(file_path),
+                                       'destination': os.path.abspath(destination_path)}
+                        if replaced_comment is not None:
+                            moved_entry['comment_offset'] = replaced_comment[0]
+                            moved_entry['comment'] = replaced_comment[1].hex()
+                        self.journal.write(moved_entry)
+                    self.progress['moved'] += 1
+                    self.cache_rename(file_path, destination_path)
+                    if replaced_comment is not None:
+                        self.cache_store(destination_path, source_partial_hash=source_hashes[0],
+                                         source_hash=source_hashes[1])
+                    self.add_destination_file(destination_path, os.path.getsize(destination_path))
+                    if sidecar_city:
+                        if write_city_to_sidecar(destination_path, sidecar_city):
+                            self.log(f"City name '{sidecar_city}' written to {destination_path}.xmp.")
+                        else:
+                            self.log(f"Sidecar {destination_path}.xmp already exists, "
+                                     f"city name '{sidecar_city}' not written.")
+                except (shutil.Error, OSError) as e:
+                    # The reason leaves out the paths, which are in the report, so that failures are counted together
+                    reason = getattr(e, 'strerror', None) or str(e)
+                    self.log(f"File: {file_path}, Reason: {reason}")
+                    self.record_not_moved(file_path, reason)
+                    self.files_not_moved_count += 1
+                    self.remove_destination_name(destination_month_folder, os.path.basename(destination_path))
+
+    # Function to move a file to its destination path, or to the next free name when a file was created at that path
+    # since the destination folder was indexed (e.g. by another program while watching). The names of the moves of the
+    # folder are kept in its index when it is listed again. Returns the path the file was moved to.
+    def move_to_free_path(self, file_path, destination_path, folder_moves):
+        destination_month_folder, filename = os.path.split(destination_path)
+        while True:
+            try:
+                self.add_stage_bytes('move', self.move_file(file_path, destination_path))
+                return destination_path
+            except FileExistsError:
+                self.destination_names.pop(destination_month_folder, None)
+                self.destination_counters.pop(destination_month_folder, None)
+                for move in folder_moves:
+                    self.add_destination_name(destination_month_folder, os.path.basename(move['destination']))
+                new_filename = self.resolve_duplicate_filename(destination_month_folder, filename)
+                self.add_destination_name(destination_month_folder, new_filename)
+                self.log(f"File: {destination_path}, Reason: Created since the folder was listed, moving to {new_filename}")
+                destination_path = os.path.join(destination_month_folder, new_filename)
+
+                if self.journal is not None:
+                    self.journal.write({'op': 'move', 'source': os.path.abspath(file_path),
+                                        'destination': os.path.abspath(destination_path)})
+                    self.journal.sync()
+
+    # Function to write the city name into the EXIF data of a file, returning the offset and the comment it replaced (see
+    # write_city_to_metadata), or None if it has no room for it or can't be written (e.g. read-only)
+    def write_city_to_exif(self, file_path, city_name):
+        try:
+            return write_city_to_metadata(file_path, city_name)
+        except OSError as e:
+            self.log(f"File: {file_path}, Reason: {e.strerror or e}")
+            return None
+
+    # Function to move a file, renaming it when it stays on the same device and copying it otherwise, returning the
+    # bytes copied. Raises FileExistsError if the destination path is taken.
+    def move_file(self, file_path, destination_path):
+        if self.get_device(os.path.dirname(file_path)) == self.get_device(os.path.dirname(destination_path)):
+            try:
+                rename_no_replace(file_path, destination_path)
+                return 0
+            except OSError as e:
+                # Bind mounts report the same device but can't rename across each other
+                if e.errno != errno.EXDEV:
+                    raise
+
+        # The full hash comes from the cache when the file is unchanged since it was hashed
+        source_hash = self.get_full_hash(file_path) if self.verify_copies == 'full' else None
+        return copy_across_devices(file_path, destination_path, source_hash)
+
+    # Function to get the device of a folder, looked up once per folder
+    def get_device(self, folder):
+        if folder not in self.folder_devices:
+            self.folder_devices[folder] = os.stat(folder).st_dev
+        return self.folder_devices[folder]
+
+    # Function to write an entry of the plan as a line of JSON
+    def write_plan_entry(self, entry):
+        self.plan_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    # Function to get the path of a source file relative to the source folder, as stored in the plan
+    def plan_source_path(self, file_path):
+        return os.path.relpath(file_path, self.source_folder)
+
+    # Function to carry out a plan written by --plan, possibly on another machine with other source and destination
+    # paths (the planned ones are used when the organizer has none) and with the metadata mode of the plan, and return
+    # the summary of the run
+    def apply_plan(self, plan_path):
+        with open(plan_path, encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            self.source_folder = self.source_folder or header['source']
+            self.destination_folder = self.destination_folder or header['destination']
+            # City names are written as planned (plans made before the mode was recorded keep the organizer's mode)
+            self.metadata_mode = header.get('metadata_mode', self.metadata_mode)
+            entries = [json.loads(line) for line in f]
+
+        if self.use_journal:
+            self.open_journal()
+        if self.use_cache:
+            self.cache_db = open_cache(self.destination_folder)
+        if self.report_path is not None:
+            self.report = ReportWriter(self.report_path)
+        try:
+            self.apply_plan_entries(entries)
+            self.end_journal()
+        finally:
+            self.finish_run()
+
+        delete_empty_folders(self.source_folder)
+        return self.get_summary()
+
+    # Function to carry out the entries of a plan: skips, then removals, then moves
+    def apply_plan_entries(self, entries):
+        removals = [entry for entry in entries if entry['action'] == 'remove']
+        moves = [entry for entry in entries if entry['action'] == 'move']
+
+        for entry in entries:
+            if entry['action'] == 'skip':
+                self.skip_file(os.path.join(self.source_folder, entry['source']), entry['reason'])
+
+        # Remove the duplicates, unless they or their kept copy changed since the plan was made
+        duplicates = []
+        for entry in removals:
+            file_path = os.path.join(self.source_folder, entry['source'])
+            if 'duplicate_in_destination' in entry:
+                kept_path = os.path.join(self.destination_folder, entry['duplicate_in_destination'])
+            else:
+                kept_path = os.path.join(self.source_folder, entry['duplicate_of'])
+            if os.path.exists(file_path) and not (self.has_planned_content(file_path, entry)
+                                                  and self.has_planned_content(kept_path, entry)):
+                self.skip_file(file_path, "Changed since the plan was made")
+            else:
+                duplicates.append((file_path, entry['size'], kept_path, entry.get('hash')))
+        self.remove_duplicates(duplicates)
+
+        # Move the files, all files of a destination folder together
+        planned_moves = []
+        for entry in moves:
+            file_path = os.path.join(self.source_folder, entry['source'])
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != entry['size']:
+                self.skip_file(file_path, "Changed since the plan was made")
+                continue
+
+            # Names taken at the destination since the plan was made get a suffix, as during a normal run
+            destination_month_folder, new_filename = os.path.split(os.path.join(self.destination_folder, entry['destination']))
+            if self.destination_name_exists(destination_month_folder, new_filename):
+                new_filename = self.resolve_duplicate_filename(destination_month_folder, new_filename)
+            self.add_destination_name(destination_month_folder, new_filename)
+
+            planned_moves.append({'source': file_path, 'destination': os.path.join(destination_month_folder, new_filename),
+                                  'city': entry['city']})
+
+        with self.timed_stage('move', len(planned_moves)):
+            self.execute_moves(planned_moves)
+        self.progress['processed'] += len(entries)
+
+    # Function to check that a file still has the size and hash of a removal of a plan. Kept copies in the destination
+    # folder also match by their content before the city name was written into them.
+    def has_planned_content(self, file_path, entry):
+        try:
+            if os.path.getsize(file_path) != entry['size'] or not entry.get('hash'):
+                return False
+            if get_hash_algorithm(entry['hash']) != self.hash_algorithm:
+                return hash_file(file_path, get_hash_algorithm(entry['hash'])) == entry['hash']
+            return entry['hash'] in (self.get_full_hash(file_path), self.get_source_hashes(file_path)[1])
+        except OSError:
+            return False
+
+    # Function to generate the new filename based on capture date, camera brand, camera model, city name, and photo count
+    def generate_new_filename(self, capture_date, camera_brand, camera_model, city_name, file_extension):
+        # Separate the capture date into year, month, and day
+        year = capture_date.strftime('%Y')
+        month = capture_date.strftime('%m')
+        day = capture_date.strftime('%d')
+
+        # Construct the new filename with the desired format
+        new_filename = f"{year}_{month}_{day}_"
+
+        # Add the camera brand to the filename if available
+        if camera_brand != 'Unknown':
+            new_filename += f"{camera_brand}_"
+
+        # Add the camera model to the filename
+        new_filename += f"{camera_model}"
+
+        # Add the city name to the filename if available
+        if city_name:
+            new_filename += f"_{city_name}"
+
+        # Add the photo count for the camera and capture date
+        new_filename += f"_{self.get_photo_count(camera_model, capture_date)}{file_extension}"
+
+        # Remove any invalid characters from the filename
+        valid_chars = "-_.() %s%s" % (string.ascii_letters, string.digits)
+        new_filename = ''.join(c for c in new_filename if c in valid_chars)
+
+        return new_filename
+
+    # Function to get the geocoding grid cell of a location
+    def geocode_cell(self, lat, lon):
+        return (self.geocoder.name, self.geocode_grid, round(lat / self.geocode_grid), round(lon / self.geocode_grid))
+
+    # Function to keep the city name of a grid cell in memory, forgetting the least recently used cell when full
+    def remember_geocode(self, cell, city_name):
+        self.geocode_cache[cell] = city_name
+        if len(self.geocode_cache) > GEOCODE_CACHE_SIZE:
+            self.geocode_cache.popitem(last=False)
+
+    # Function to get city name based on lat and lon data from GPS, looking up each grid cell only once
+    def reverse_geocode(self, lat, lon):
+        cell = self.geocode_cell(lat, lon)
+
+        if cell in self.geocode_cache:
+            self.geocode_cache.move_to_end(cell)
+            if cell in self.prefetched_cells:
+                self.prefetched_cells.discard(cell)
+            else:
+                self.geocode_stats['memory_hits'] += 1
+            return self.geocode_cache[cell]
+
+        found, city_name = self.cache_lookup_geocode(cell)
+        if found:
+            self.geocode_stats['disk_hits'] += 1
+        else:
+            # Look up the centre of the cell, so that the result doesn't depend on which photo of the cell came first
+            self.geocode_stats['misses'] += 1
+            city_name = self.geocoder.reverse_geocode(cell[2] * self.geocode_grid, cell[3] * self.geocode_grid)
+            self.cache_store_geocode(cell, city_name)
+
+        self.remember_geocode(cell, city_name)
+        return city_name
+
+    # Function to look up the city names of the grid cells of several locations at once with a remote geocoder backend
+    def prefetch_geocodes(self, coordinates):
+        if self.geocoder is None or not self.geocoder.remote:
+            return
+
+        # Only cells that are neither in memory nor in the cache file need a request
+        cells = []
+        for lat, lon in coordinates:
+            cell = self.geocode_cell(lat, lon)
+            if cell not in self.geocode_cache and cell not in cells and not self.cache_lookup_geocode(cell)[0]:
+                cells.append(cell)
+        if not cells:
+            return
+
+        results = asyncio.run(self.geocoder.reverse_geocode_many([(cell[2] * self.geocode_grid, cell[3] * self.geocode_grid)
+                                                                  for cell in cells]))
+
+        # Cells whose lookup failed are left to reverse_geocode, which reports the error
+        for cell, city_name in zip(cells, results):
+            if not isinstance(city_name, Exception):
+                self.geocode_stats['misses'] += 1
+                self.cache_store_geocode(cell, city_name)
+                self.remember_geocode(cell, city_name)
+                self.prefetched_cells.add(cell)
+
+    # Function to get the photo count for a specific camera on a given day
+    def get_photo_count(self, camera_model, capture_date):
+        # Check if the camera is already in the dictionary
+        if camera_model in self.photo_count:
+            # Check if the capture date is already in the camera's dictionary
+            if capture_date.date() in self.photo_count[camera_model]:
+                self.photo_count[camera_model][capture_date.date()] += 1
+            else:
+                self.photo_count[camera_model][capture_date.date()] = 1
+        else:
+            self.photo_count[camera_model] = {capture_date.date(): 1}
+
+        # Return the photo count for the camera and capture date
+        return str(self.photo_count[camera_model][capture_date.date()]).zfill(3)
+
+    # Function to resolve duplicate filenames by appending a suffix
+    def resolve_duplicate_filename(self, folder, filename):
+        file_name, file_extension = os.path.splitext(filename)
+        self.load_destination_folder(folder)
+
+        # Start from the number after the highest suffix of the existing files named f"{file_name}_<number>..."
+        counter = self.destination_counters[folder].get(file_name, 0) + 1
+
+        while self.destination_name_exists(folder, f"{file_name}_{counter}{file_extension}"):
+            counter += 1
+
+        new_filename = f"{file_name}_{counter}{file_extension}"
+        return new_filename
+
+    # Function to list the files of a destination folder into the name index, the first time the folder is used
+    def load_destination_folder(self, folder):
+        if folder in self.destination_names:
+            return
+
+        if self.destination_case_insensitive is None:
+            self.destination_case_insensitive = is_case_insensitive(self.destination_folder)
+
+        self.destination_names[folder] = set()
+        self.destination_counters[folder] = {}
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                self.add_destination_name(folder, name)
+
+    # Function to add a file name to the name index of a destination folder
+    def add_destination_name(self, folder, name):
+        self.load_destination_folder(folder)
+        self.destination_names[folder].add(name.lower() if self.destination_case_insensitive else name)
+
+        # Record the numeric suffix of the name for every prefix that resolve_duplicate_filename can ask for,
+        # i.e. every part of the name before an underscore
+        suffix = name.split('_')[-1].split('.')[0]
+        if not suffix.isdigit():
+            return
+        try:
+            counter = int(suffix)
+        except ValueError:
+            return
+
+        counters = self.destination_counters[folder]
+        position = name.find('_')
+        while position != -1:
+            prefix = name[:position]
+            if counters.get(prefix, -1) < counter:
+                counters[prefix] = counter
+            position = name.find('_', position + 1)
+
+    # Function to release a file name reserved in the name index of a destination folder
+    def remove_destination_name(self, folder, name):
+        self.destination_names[folder].discard(name.lower() if self.destination_case_insensitive else name)
+
+    # Function to check whether a file name is taken in a destination folder, using the name index
+    def destination_name_exists(self, folder, name):
+        self.load_destination_folder(folder)
+        return (name.lower() if self.destination_case_insensitive else name) in self.destination_names[folder]
+
+    # Function to list the sizes of the media files already in the destination folder, without hashing any of them.
+    # The source folder is left out when it is the destination folder or inside it, since its files aren't organized
+    # yet and each of them would match itself.
+    def index_destination_folder(self):
+        self.destination_sizes.clear()
+        self.destination_inodes.clear()
+        if not os.path.isdir(self.destination_folder):
+            return
+
+        source_stat = os.stat(self.source_folder) if os.path.isdir(self.source_folder) else None
+        pending_folders = [self.destination_folder]
+        while pending_folders:
+            folder = pending_folders.pop()
+            folder_stat = os.stat(folder)
+            if source_stat is not None and (folder_stat.st_dev, folder_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+                continue
+            for entry in scan_folder(folder):
+                if entry.is_dir(follow_symlinks=False):
+                    pending_folders.append(entry.path)
+                elif entry.name.lower().endswith(MEDIA_EXTENSIONS) and not entry.name.startswith('.') and entry.is_file():
+                    file_stat = entry.stat()
+                    self.add_destination_file(entry.path, file_stat.st_size)
+                    self.destination_inodes.add((file_stat.st_dev, file_stat.st_ino))
+
+    # Function to add a file to the index of the destination folder, to be hashed when a file of its size comes in
+    def add_destination_file(self, file_path, file_size):
+        if file_size not in self.destination_sizes:
+            self.destination_sizes[file_size] = {'new': [], 'partial': {}}
+        self.destination_sizes[file_size]['new'].append(file_path)
+
+    # Function to check whether a path is inside the destination folder
+    def is_in_destination(self, file_path):
+        return os.path.abspath(file_path).startswith(os.path.join(os.path.abspath(self.destination_folder), ''))
+
+    # Function to hash the destination files added since the last time a file of one of the given sizes came in
+    def hash_destination_sizes(self, pool, file_sizes_to_check):
+        new_files = []
+        for file_size in set(file_sizes_to_check):
+            if file_size in self.destination_sizes:
+                new_files += [(file_path, file_size) for file_path in self.destination_sizes[file_size]['new']]
+                self.destination_sizes[file_size]['new'] = []
+        if not new_files:
+            return
+
+        partial_hashes = pool_map(pool, self.get_destination_partial_hashes, *zip(*new_files))
+        for (file_path, file_size), file_partial_hashes in zip(new_files, partial_hashes):
+            for partial_hash in file_partial_hashes:
+                self.destination_sizes[file_size]['partial'].setdefault(partial_hash, []).append(file_path)
+
+    # Function to get the partial hashes of a destination file: of its content, and of its content before the city name
+    # was written into it if it was. Returns none if the file was removed since the folder was indexed.
+    def get_destination_partial_hashes(self, file_path, file_size):
+        try:
+            partial_hashes = {self.get_partial_hash(file_path, file_size)}
+            source_partial_hash, source_hash = self.get_source_hashes(file_path)
+        except OSError:
+            return set()
+        if source_partial_hash is not None:
+            partial_hashes.add(source_partial_hash)
+        return partial_hashes
+
+    # Function to get the partial and full hashes of the content of a destination file before the city name was written
+    # into it, from the cache, or None and None if it wasn't written or the file changed since
+    def get_source_hashes(self, file_path):
+        row = self.cache_lookup(file_path)
+        if row is None or not row['source_hash'] or get_hash_algorithm(row['source_hash']) != self.hash_algorithm:
+            return None, None
+        return row['source_partial_hash'], row['source_hash']
+
+    # Function to find a file with the same content as a file in the destination folder, returning it with the hash of
+    # the whole content, or None and None if there is none
+    def find_in_destination(self, file_path, file_size):
+        if file_size not in self.destination_sizes:
+            return None, None
+
+        partial_hash = self.get_partial_hash(file_path, file_size)
+        for candidate in self.destination_sizes[file_size]['partial'].get(partial_hash, []):
+            # Check the candidate again (from the cache if it is unchanged), since it may have been changed or removed
+            # since it was indexed, and the source file is removed when it matches
+            try:
+                # A file is never a duplicate of itself, even when reached through another path
+                if os.path.getsize(candidate) != file_size or os.path.samefile(candidate, file_path):
+                    continue
+                # Candidates the city name was written into are compared by their content before it was written
+                source_partial_hash, source_hash = self.get_source_hashes(candidate)
+                if source_partial_hash != partial_hash:
+                    source_hash = None
+                    if self.get_partial_hash(candidate, file_size) != partial_hash:
+                        continue
+                # The partial hash covers files of up to 2 * PARTIAL_HASH_SIZE bytes entirely
+                if file_size <= 2 * PARTIAL_HASH_SIZE:
+                    return candidate, partial_hash
+                full_hash = self.get_full_hash(file_path)
+                if (source_hash or self.get_full_hash(candidate)) == full_hash:
+                    return candidate, full_hash
+            except OSError:
+                continue
+        return None, None
+
+    # Function to group the media files of a directory and its sub-directories by size
+    def index_file_sizes(self, directory):
+        self.index_entry_sizes(self.timed_walk(self.discover_files(directory), 'size_index'))
+
+    # Function to group the media files among entries found by discover_files by size
+    def index_entry_sizes(self, entries):
+        for entry in entries:
+            if entry.name.lower().endswith(MEDIA_EXTENSIONS):
+                file_size = entry.stat().st_size
+                if file_size in self.file_sizes:
+                    self.file_sizes[file_size].append(entry.path)
+                else:
+                    self.file_sizes[file_size] = [entry.path]
+
+    # Function to compute the content keys of all files sharing a size, before any of them is moved or modified
+    def resolve_size_bucket(self, file_size):
+        # Files covered entirely by the partial hash don't need a second read
+        if file_size <= 2 * PARTIAL_HASH_SIZE:
+            for file_path in self.file_sizes[file_size]:
+                self.content_keys[file_path] = self.get_full_hash(file_path)
+            return
+
+        # Group the files by the hash of their first and last bytes
+        partial_groups = {}
+        for file_path in self.file_sizes[file_size]:
+            partial_hash = self.get_partial_hash(file_path, file_size)
+            if partial_hash in partial_groups:
+                partial_groups[partial_hash].append(file_path)
+            else:
+                partial_groups[partial_hash] = [file_path]
+
+        # Only files whose partial hashes match need a full hash to tell them apart
+        for partial_hash, paths in partial_groups.items():
+            for file_path in paths:
+                if len(paths) == 1:
+                    self.content_keys[file_path] = f"partial:{file_size}:{partial_hash}"
+                else:
+                    self.content_keys[file_path] = self.get_full_hash(file_path)
+
+    # Function to get a key that is equal for two files only if their content is equal
+    def get_content_key(self, file_path, file_size=None):
+        if file_path in self.content_keys:
+            return self.content_keys.pop(file_path)
+
+        if file_size is None:
+            file_size = os.stat(file_path).st_size
+        paths = self.file_sizes.get(file_size, [])
+
+        # A file with a unique size cannot have a duplicate
+        if paths == [file_path]:
+            return f"size:{file_size}"
+
+        # Hash all files of the size the first time one of them is processed
+        if file_size not in self.resolved_sizes and file_path in paths:
+            self.resolved_sizes.add(file_size)
+            self.resolve_size_bucket(file_size)
+            return self.content_keys.pop(file_path)
+
+        # Files not seen by index_file_sizes (e.g. modified since) are hashed in full
+        return self.get_full_hash(file_path)
+
+    # Function to commit the pending cache writes and close the cache
+    def close_cache(self):
+        if self.cache_db is not None:
+            self.cache_db.commit()
+            self.cache_db.close()
+            self.cache_db = None
+
+    # Function to write the pending changes of the cache to disk
+    def cache_commit(self):
+        if self.cache_db is None:
+            return
+
+        with self.cache_lock:
+            self.cache_db.commit()
+            self.cache_pending_writes = 0
+
+    # Function to get the cache entry of a file, or None if there is none or the file changed since it was cached
+    def cache_lookup(self, file_path):
+        if self.cache_db is None:
+            return None
+
+        with self.cache_lock:
+            row = self.cache_db.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(file_path),)).fetchone()
+        if row is None:
+            return None
+
+        stat = os.stat(file_path)
+        if (row['size'], row['mtime_ns'], row['inode']) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        return row
+
+    # Function to store values in the cache entry of a file, replacing the entry if the file changed since it was cached
+    def cache_store(self, file_path, **values):
+        if self.cache_db is None:
+            return
+
+        path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self.cache_lock:
+            if self.cache_lookup(file_path) is None:
+                self.cache_db.execute("DELETE FROM files WHERE path = ?", (path,))
+                self.cache_db.execute(
+                    "INSERT INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, stat.st_ino),
+                )
+
+            columns = ', '.join(f"{column} = ?" for column in values)
+            self.cache_db.execute(f"UPDATE files SET {columns} WHERE path = ?", (*values.values(), path))
+
+            self.cache_pending_writes += 1
+            if self.cache_pending_writes >= 1000:
+                self.cache_db.commit()
+                self.cache_pending_writes = 0
+
+    # Function to move the cache entry of a file to its new location
+    def cache_rename(self, old_path, new_path):
+        if self.cache_db is None:
+            return
+
+        with self.cache_lock:
+            row = self.cache_db.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(old_path),)).fetchone()
+            self.cache_db.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(new_path),))
+            if row is None:
+                return
+
+            # The metadata stays valid, but the hashes are dropped if the content was rewritten (e.g. by write_city_to_metadata)
+            stat = os.stat(new_path)
+            content_changed = (row['size'], row['mtime_ns']) != (stat.st_size, stat.st_mtime_ns)
+            self.cache_db.execute(
+                "UPDATE files SET path = ?, size = ?, mtime_ns = ?, inode = ?, "
+                "partial_hash = CASE WHEN ? THEN NULL ELSE partial_hash END, "
+                "full_hash = CASE WHEN ? THEN NULL ELSE full_hash END WHERE path = ?",
+                (os.path.abspath(new_path), stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                 content_changed, content_changed, os.path.abspath(old_path)),
+            )
+
+    # Function to get the cached city name of a geocoding grid cell, returning whether it was found and the city name
+    def cache_lookup_geocode(self, cell):
+        if self.cache_db is None:
+            return False, None
+
+        with self.cache_lock:
+            row = self.cache_db.execute(
+                "SELECT city FROM geocodes WHERE backend = ? AND grid = ? AND lat_cell = ? AND lon_cell = ?", cell
+            ).fetchone()
+        if row is None:
+            return False, None
+        return True, row['city']
+
+    # Function to store the city name of a geocoding grid cell in the cache, None meaning that there is no city
+    def cache_store_geocode(self, cell, city_name):
+        if self.cache_db is not None:
+            with self.cache_lock:
+                self.cache_db.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)", (*cell, city_name))
+
+    # Function to remove the cache entry of a file that was deleted
+    def cache_forget(self, file_path):
+        if self.cache_db is not None:
+            with self.cache_lock:
+                self.cache_db.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(file_path),))
+
+    # Function to get the full hash of a file, from the cache if the file is unchanged and was hashed with the same
+    # algorithm
+    def get_full_hash(self, file_path):
+        row = self.cache_lookup(file_path)
+        if row is not None and row['full_hash'] and get_hash_algorithm(row['full_hash']) == self.hash_algorithm:
+            return row['full_hash']
+
+        full_hash = hash_file(file_path, self.hash_algorithm)
+        self.add_stage_bytes('hash', os.path.getsize(file_path))
+        self.cache_store(file_path, full_hash=full_hash)
+        return full_hash
+
+    # Function to get the partial hash of a file, from the cache if the file is unchanged and was hashed with the same
+    # algorithm
+    def get_partial_hash(self, file_path, file_size):
+        row = self.cache_lookup(file_path)
+        if row is not None and row['partial_hash'] and get_hash_algorithm(row['partial_hash']) == self.hash_algorithm:
+            return row['partial_hash']
+
+        partial_hash = hash_file_partial(file_path, file_size, self.hash_algorithm)
+        self.add_stage_bytes('hash', min(file_size, 2 * PARTIAL_HASH_SIZE))
+        self.cache_store(file_path, partial_hash=partial_hash)
+        return partial_hash
+
+    # Function to get the metadata of a file, from the cache if the file is unchanged
+    def get_metadata(self, file_path):
+        row = self.cache_lookup(file_path)
+        if row is not None and row['has_metadata'] == METADATA_VERSION:
+            return {
+                'capture_date': datetime.fromisoformat(row['capture_date']) if row['capture_date'] else None,
+                'camera_brand': row['camera_brand'],
+                'camera_model': row['camera_model'],
+                'lat': row['lat'],
+                'lon': row['lon'],
+            }
+
+        metadata = read_metadata(file_path)
+        self.add_stage_bytes('exif', metadata.pop('bytes_read', 0))
+        self.cache_store(
+            file_path,
+            has_metadata=METADATA_VERSION,
+            capture_date=metadata['capture_date'].isoformat() if metadata['capture_date'] else None,
+            camera_brand=metadata['camera_brand'],
+            camera_model=metadata['camera_model'],
+            lat=metadata['lat'],
+            lon=metadata['lon'],
+        )
+        return metadata
+
+    # Function to get the difference hash of an image, from the cache if the file is unchanged
+    def get_cached_dhash(self, image_path):
+        row = self.cache_lookup(image_path)
+        if row is not None and row['dhash']:
+            return int(row['dhash'], 16)
+        return None
+
+    # Function to leave the near duplicates of the kept images where they are, returning the other images
+    def remove_near_duplicates(self, file_paths, process_pool):
+        if self.near_duplicate_tree is None:
+            self.near_duplicate_tree = BKTree()
+
+        image_paths = [file_path for file_path in file_paths if file_path.lower().endswith(('.jpg', '.jpeg', '.tiff', '.tif'))]
+        image_hashes = {file_path: self.get_cached_dhash(file_path) for file_path in image_paths}
+
+        # The hashes are computed in processes, and cached by the main thread which owns the cache
+        missing_paths = [file_path for file_path, dhash in image_hashes.items() if dhash is None]
+        for file_path, dhash in zip(missing_paths, pool_map(process_pool, compute_dhash, missing_paths)):
+            image_hashes[file_path] = dhash
+            if dhash is not None:
+                self.cache_store(file_path, dhash=f"{dhash:016x}")
+
+        # Within a batch the largest file of a group of near duplicates is kept, usually the one with the highest quality
+        near_duplicate_paths = set()
+        for file_path in sorted(image_paths, key=os.path.getsize, reverse=True):
+            dhash = image_hashes[file_path]
+            if dhash is None:
+                continue
+            match = self.near_duplicate_tree.find(dhash, self.near_duplicate_threshold)
+            if match is not None:
+                self.log(f"{file_path} is a near duplicate of {match}")
+                near_duplicate_paths.add(file_path)
+            else:
+                self.near_duplicate_tree.add(dhash, file_path)
+
+        kept_paths = []
+        for file_path in file_paths:
+            if file_path in near_duplicate_paths:
+                self.skip_file(file_path, "Near duplicate")
+            else:
+                kept_paths.append(file_path)
+        return kept_paths
+
+    # Function to get why an image is low quality from its scores, or None if it isn't
+    def get_low_quality_reason(self, brightness, sharpness, clipping):
+        # Comparisons with the NaN scores of images that can't be decoded are false, so these images are kept
+        if self.brightness_threshold is not None and brightness < self.brightness_threshold:
+            return "Low Quality"
+        if self.sharpness_threshold is not None and sharpness < self.sharpness_threshold:
+            return "Low Quality - Blurry"
+        if self.clipping_threshold is not None and clipping > self.clipping_threshold:
+            return "Low Quality - Clipped"
+        return None
+
+#4 Script Execution ------------------------------
+
+# Function to run TidyMyFiles from the command line, with the arguments of argv (those of the command line when None).
+# Missing source and destination folders and API key are prompted for only when the input is a terminal.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Organize photos and videos into a year/month folder tree.")
+    parser.add_argument("source", nargs="?", help="folder containing unstructured photos/videos")
+    parser.add_argument("destination", nargs="?", help="folder where the organized tree will be created")
+    parser.add_argument("--api-key", help="OpenCage API key used to look up city names")
+    parser.add_argument("--geocoder", choices=("opencage", "geonames", "none"), default="opencage",
+                        help="look up city names with the OpenCage API, offline in a GeoNames export (--cities-file), "
+                             "or not at all")
+    parser.add_argument("--cities-file", help="GeoNames cities export, such as cities500.txt, used by --geocoder geonames")
+    parser.add_argument("--max-city-distance", type=float, default=MAX_CITY_DISTANCE_KM,
+                        help=f"distance in km beyond which --geocoder geonames finds no city (default: {MAX_CITY_DISTANCE_KM})")
+    parser.add_argument("--geocode-url", help="URL of the OpenCage API, e.g. of a local server for testing")
+    parser.add_argument("--geocode-rate", type=float, default=1.0,
+                        help="most OpenCage requests started per second (default: 1, the free plan limit)")
+    parser.add_argument("--geocode-concurrency", type=int, default=4,
+                        help="most OpenCage requests in flight at once (default: 4)")
+    parser.add_argument("--geocode-grid", type=float, default=DEFAULT_GEOCODE_GRID,
+                        help=f"size in degrees of the grid cells sharing a city name lookup (default: {DEFAULT_GEOCODE_GRID}, "
+                             f"about 1 km)")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="only organize files whose name matches this glob pattern, e.g. '*.jpg' (can be repeated)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="skip files and folders whose name matches this glob pattern (can be repeated)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of threads and processes used for hashing, EXIF parsing and quality checks "
+                             "(default: number of CPUs, 1 processes everything in the main thread)")
+    parser.add_argument("--full-quality-check", action="store_true",
+                        help="decode images at full resolution for the quality check instead of estimating brightness "
+                             "from a reduced-size decode or the EXIF thumbnail")
+    parser.add_argument("--no-cache", action="store_true", help=f"don't read or write the {CACHE_FILENAME} cache")
+    parser.add_argument("--compact-cache", metavar="FOLDER",
+                        help="remove the entries of files that no longer exist or changed from the cache in FOLDER, then exit")
+    parser.add_argument("--duplicates", choices=DUPLICATE_MODES, default="delete",
+                        help="what to do with duplicates: delete them, or replace them with a hard link or a reflink "
+                             "(btrfs, XFS) to the kept copy, leaving the folders they are in as they are (default: delete)")
+    parser.add_argument("--hash-algorithm", choices=HASH_ALGORITHMS, default=DEFAULT_HASH_ALGORITHM,
+                        help="hashlib algorithm used to find duplicates, e.g. blake2b, faster than sha256 on CPUs "
+                             f"without SHA instructions (default: {DEFAULT_HASH_ALGORITHM})")
+    parser.add_argument("--verify-copies", choices=VERIFY_MODES, default="full",
+                        help="how files moved to another device are checked before the original is deleted: 'full' "
+                             "hashes the whole copy, 'partial' only its first and last 4 MiB (default: full)")
+    parser.add_argument("--no-journal", action="store_true",
+                        help=f"don't journal the moves and removals in {JOURNAL_FILENAME} in the destination folder")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the interrupted run journaled in the destination folder, numbering photos on "
+                             "from where it stopped and skipping the files it already left in place")
+    parser.add_argument("--audit-removals", metavar="FOLDER",
+                        help="check that every duplicate removed by the runs journaled in FOLDER still has an "
+                             "identical kept copy, then exit")
+    parser.add_argument("--restore-removals", metavar="FOLDER",
+                        help="copy the duplicates removed by the runs journaled in FOLDER back from their kept copy, "
+                             "then exit")
+    parser.add_argument("--plan", metavar="FILE",
+                        help="write the moves and removals to FILE as JSON lines instead of carrying them out")
+    parser.add_argument("--apply", metavar="FILE",
+                        help="carry out the moves and removals planned in FILE by --plan, without hashing or geocoding "
+                             "again (the source and destination default to the planned ones)")
+    parser.add_argument("--watch", type=float, nargs="?", const=10.0, metavar="SECONDS",
+                        help="keep running and organize the files arriving in the source folder, looking for new files "
+                             "every SECONDS seconds (default: 10) until interrupted with Ctrl+C")
+    parser.add_argument("--near-duplicate-threshold", type=int, metavar="BITS",
+                        help="leave images in the source folder when their difference hash differs in at most BITS of "
+                             "64 bits from an image already kept, e.g. resized or recompressed copies (try 6 to 10)")
+    parser.add_argument("--min-brightness", type=float, default=DEFAULT_BRIGHTNESS_THRESHOLD,
+                        help=f"leave images darker than this mean gray level (0-255) in the source folder "
+                             f"(default: {DEFAULT_BRIGHTNESS_THRESHOLD})")
+    parser.add_argument("--min-sharpness", type=float,
+                        help="leave images blurrier than this variance of the Laplacian in the source folder, measured "
+                             f"at {QUALITY_IMAGE_SIZE[0]}x{QUALITY_IMAGE_SIZE[1]} pixels (e.g. 50, default: no sharpness check)")
+    parser.add_argument("--max-clipping", type=float,
+                        help="leave images with more than this fraction of black or white pixels in the source folder "
+                             "(e.g. 0.5, default: no clipping check)")
+    parser.add_argument("--no-quality-check", action="store_true",
+                        help="don't check the brightness, sharpness or clipping of images, which then aren't decoded")
+    parser.add_argument("--metadata-mode", choices=METADATA_MODES, default="exif",
+                        help="where city names are written: 'exif' adds them in place to the EXIF comment of JPEG/TIFF "
+                             "files when it has room and to a .xmp sidecar otherwise, 'sidecar' always writes a sidecar, "
+                             "'none' writes nothing (default: exif)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="don't print a message for every file, show a line with the progress, files/s and time left")
+    parser.add_argument("--report", metavar="FILE",
+                        help="append the files that are not organized to FILE as they are processed, with their path, "
+                             "reason, size and hash: as CSV if FILE ends with .csv, as JSON lines otherwise")
+    parser.add_argument("--summary", metavar="FILE",
+                        help="write a JSON summary of the run to FILE: files moved and not moved by reason, and the wall "
+                             "time, CPU time, bytes read and files of each stage")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="profile the run with cProfile (main thread only), save the statistics to FILE for pstats "
+                             "or snakeviz and print the slowest functions")
+    args = parser.parse_args(argv)
+
+    if args.watch is not None and args.plan:
+        parser.error("--watch can't be combined with --plan")
+    if args.resume and (args.plan or args.apply or args.no_journal):
+        parser.error("--resume can't be combined with --plan, --apply or --no-journal")
+
+    # Compact the cache of a destination folder without organizing any files
+    if args.compact_cache:
+        cache_db = open_cache(args.compact_cache)
+        removed_count = compact_cache(cache_db)
+        cache_db.close()
+        print(f"Removed {removed_count} stale cache entries.")
+        return 0
+
+    # Check, or restore, the duplicates removed by the runs journaled in a destination folder
+    if args.audit_removals or args.restore_removals:
+        results = check_removals(args.restore_removals or args.audit_removals, restore=bool(args.restore_removals))
+        status_counts = {}
+        for entry, kept_path, status in results:
+            status_counts[status] = status_counts.get(status, 0) + 1
+            if status in ('missing', 'changed'):
+                print(f"File: {entry['source']}, Kept copy {status}: {kept_path}")
+        print(f"Removed duplicates: {len(results)}, " + ", ".join(f"{status}: {count}" for status, count in status_counts.items()))
+        return 1 if 'missing' in status_counts or 'changed' in status_counts else 0
+
+    # Carry out a plan written by an earlier run with --plan
+    if args.apply:
+        organizer = Organizer(args.source, args.destination, use_cache=not args.no_cache, report_path=args.report,
+                              use_journal=not args.no_journal, duplicate_mode=args.duplicates,
+                              hash_algorithm=args.hash_algorithm, verify_copies=args.verify_copies, verbose=not args.quiet)
+        organizer.apply_plan(args.apply)
+        print_files_not_moved(organizer)
+        if args.summary:
+            organizer.write_summary(args.summary)
+        return 0
+
+    # Prompt the user to enter the source folder
+    source_folder = args.source or prompt(parser, "source", "Enter the path to the folder containing unstructured photos/videos: ")
+    # source_folder = "xyz" # set a fixed source folder if convenient
+
+    # Prompt the user to enter the destination folder
+    destination_folder = args.destination or prompt(parser, "destination", "Enter the path to the folder where the organized tree will be created: ")
+    # destination_folder = "xyz" # set a fixed destination folder if convenient
+
+    if args.resume and find_interrupted_run(read_journal(destination_folder)) is None:
+        parser.error(f"--resume found no interrupted run in {destination_folder}")
+
+    # Load the GeoNames export, or prompt the user to enter the OpenCage API key
+    if args.geocoder == "geonames":
+        if not args.cities_file:
+            parser.error("--geocoder geonames requires --cities-file")
+        geocoder = GeoNamesBackend(args.cities_file, args.max_city_distance)
+    elif args.geocoder == "opencage":
+        opencage_api_key = args.api_key or prompt(parser, "--api-key", "Enter your OpenCage API Key. Visit https://opencagedata.com/ to create one: ")
+        # opencage_api_key = 'xyz' # set a fixed opencage API if convinient
+        geocoder = OpenCageBackend(opencage_api_key, args.geocode_url, args.geocode_rate, max(1, args.geocode_concurrency))
+    else:
+        geocoder = None
+
+    # Images are only decoded for the quality check when one of its thresholds is set
+    if args.no_quality_check:
+        args.min_brightness = args.min_sharpness = args.max_clipping = None
+
+    organizer = Organizer(
+        source_folder,
+        destination_folder,
+        geocoder=geocoder,
+        workers=args.workers,
+        include_patterns=args.include,
+        exclude_patterns=args.exclude,
+        fast_quality_check=not args.full_quality_check,
+        brightness_threshold=args.min_brightness,
+        sharpness_threshold=args.min_sharpness,
+        clipping_threshold=args.max_clipping,
+        near_duplicate_threshold=args.near_duplicate_threshold,
+        geocode_grid=args.geocode_grid,
+        metadata_mode=args.metadata_mode,
+        use_cache=not args.no_cache,
+        plan_path=args.plan,
+        report_path=args.report,
+        use_journal=not args.no_journal,
+        resume=args.resume,
+        duplicate_mode=args.duplicates,
+        hash_algorithm=args.hash_algorithm,
+        verify_copies=args.verify_copies,
+        verbose=not args.quiet,
+    )
+
+    # Profile the processing of the files if asked
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    if args.watch is not None:
+        organizer.watch(args.watch)
+    else:
+        organizer.run()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    if args.plan:
+        print(f"Plan written to {args.plan}, carry it out with --apply {args.plan}")
+
+    # Print the list of files that were not moved and the reasons for the failure
+    print_files_not_moved(organizer)
+
+    # Print how many geocoder lookups the geocode cache saved
+    geocode_stats = organizer.geocode_stats
+    geocode_hits = geocode_stats['memory_hits'] + geocode_stats['disk_hits']
+    print(f"Geocode cache: {geocode_hits} hits ({geocode_stats['disk_hits']} from the cache file), "
+          f"{geocode_stats['misses']} lookups by the geocoder")
+
+    # Print where the time went, and write it as JSON if asked
+    organizer.print_stage_report()
+    if args.summary:
+        organizer.write_summary(args.summary)
+        print(f"Summary written to {args.summary}")
+
+    if profiler is not None:
+        print(f"Profile written to {args.profile}, slowest functions:")
+        pstats.Stats(args.profile).sort_stats('cumulative').print_stats(20)
+    return 0
+
+# Function to ask for a missing argument when the input is a terminal, and to stop with a usage error otherwise (e.g.
+# when running from cron or another program)
+def prompt(parser, name, message):
+    if not sys.stdin.isatty():
+        parser.error(f"{name} is required when the input isn't a terminal")
+    return input(message)
+
+# Function to print how many files an organizer didn't organize for each reason, the files being listed in the report
+def print_files_not_moved(organizer):
+    print("Files that were not moved:")
+    for reason, count in organizer.not_moved_reasons.items():
+        print(f"Reason: {reason}, Files: {count}")
+
+    # Print the total count of files that were not moved
+    print(f"Total files not moved: {organizer.files_not_moved_count}")
+    if organizer.report_path is not None:
+        print(f"Files listed in {organizer.report_path}")
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# The End!!!
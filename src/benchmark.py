@@ -0,0 +1,422 @@
+#1 Import Statements ------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+import piexif
+import cv2
+import numpy as np
+from datetime import datetime, timedelta
+from functools import partial
+
+# Benchmark the functions of TidyMyFiles.py, next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import TidyMyFiles
+
+#2 Constants and Global Variables ------------------------------
+
+# Version of the JSON results, increased when their layout changes
+RESULTS_VERSION = 2
+
+# Cities the GPS coordinates of the corpus are taken around, as (name, latitude, longitude)
+CITIES = [
+    ("Paris", 48.8566, 2.3522),
+    ("Sydney", -33.8688, 151.2093),
+    ("New York", 40.7128, -74.0060),
+    ("Tokyo", 35.6762, 139.6503),
+    ("Cape Town", -33.9249, 18.4241),
+    ("Rio de Janeiro", -22.9068, -43.1729),
+]
+
+# Number of random cities added to the GeoNames file of the corpus, so that the lookups search a realistic tree
+RANDOM_CITIES = 50000
+
+# Cameras the photos of the corpus are taken with, as (make, model)
+CAMERAS = [
+    (b"Canon", b"Canon EOS 5D"),
+    (b"NIKON CORPORATION", b"NIKON D750"),
+    (b"Apple", b"iPhone 12"),
+    (b"samsung", b"SM-G991B"),
+]
+
+#3 Function Definitions ------------------------------
+
+# Function to generate a corpus of photos and videos in a folder, returning a description of it. The corpus has
+# photos with EXIF dates, cameras and GPS coordinates, exact copies, dark photos, videos with QuickTime metadata and
+# non-media files, spread over a folder tree of the given depth.
+def generate_corpus(folder, photos=500, image_size=(1600, 1200), duplicate_ratio=0.1, dark_ratio=0.05,
+                    gps_ratio=0.5, videos=20, video_size=8 * 1024 * 1024, depth=4, seed=1):
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    # Folders of a tree with up to depth levels, such as cloud backups and phone dumps produce
+    folders = [""]
+    for i in range(max(1, photos // 50)):
+        parent = rng.choice([f for f in folders if (f.count(os.sep) + 1 if f else 0) < depth])
+        folders.append(os.path.join(parent, f"folder{i}"))
+
+    scenes = [generate_scene(np_rng, image_size) for _ in range(8)]
+    photo_paths = []
+    for i in range(photos):
+        # Every photo gets a mark of its own, so that only the copies below are exact duplicates
+        image = scenes[i % len(scenes)].copy()
+        center = (int(np_rng.integers(image_size[0])), int(np_rng.integers(image_size[1])))
+        cv2.circle(image, center, int(np_rng.integers(20, 200)), tuple(int(c) for c in np_rng.integers(0, 255, 3)), -1)
+        if rng.random() < dark_ratio:
+            image = (image * 0.05).astype(np.uint8)
+
+        path = os.path.join(folder, rng.choice(folders), f"IMG_{i:05d}.jpg")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        piexif.insert(generate_exif(rng, rng.random() < gps_ratio), path)
+        photo_paths.append(path)
+
+    # Exact copies in other folders, as left by repeated backups
+    for i, path in enumerate(rng.sample(photo_paths, int(photos * duplicate_ratio))):
+        copy_path = os.path.join(folder, rng.choice(folders), f"copy_{i:05d}.jpg")
+        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+        shutil.copyfile(path, copy_path)
+
+    for i in range(videos):
+        path = os.path.join(folder, rng.choice(folders), f"VID_{i:05d}.mp4")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_video(path, rng, np_rng, video_size)
+
+    for i in range(max(1, photos // 100)):
+        with open(os.path.join(folder, rng.choice(folders), f"notes{i}.txt"), "w") as f:
+            f.write("not a media file\n")
+
+    return {
+        "photos": photos,
+        "image_size": list(image_size),
+        "duplicate_ratio": duplicate_ratio,
+        "dark_ratio": dark_ratio,
+        "gps_ratio": gps_ratio,
+        "videos": videos,
+        "video_size": video_size,
+        "depth": depth,
+        "seed": seed,
+    }
+
+# Function to generate a smooth synthetic scene, which compresses and scales like a photo unlike random noise
+def generate_scene(np_rng, image_size):
+    width, height = image_size
+    image = np.zeros((height, width, 3), np.uint8)
+    image[:] = np_rng.integers(60, 200, 3)
+    for _ in range(40):
+        center = (int(np_rng.integers(width)), int(np_rng.integers(height)))
+        radius = int(np_rng.integers(width // 40, width // 4))
+        cv2.circle(image, center, radius, tuple(int(c) for c in np_rng.integers(0, 255, 3)), -1)
+    return cv2.GaussianBlur(image, (0, 0), 3)
+
+# Function to generate the EXIF data of a photo of the corpus, with GPS coordinates near one of CITIES if asked
+def generate_exif(rng, with_gps):
+    make, model = rng.choice(CAMERAS)
+    capture_date = datetime(2015, 1, 1) + timedelta(seconds=rng.randrange(10 * 365 * 24 * 3600))
+    exif_dict = {
+        "0th": {piexif.ImageIFD.Make: make, piexif.ImageIFD.Model: model},
+        "Exif": {piexif.ExifIFD.DateTimeOriginal: capture_date.strftime("%Y:%m:%d %H:%M:%S").encode()},
+        "GPS": {},
+        "1st": {},
+        "thumbnail": None,
+    }
+    if with_gps:
+        name, lat, lon = rng.choice(CITIES)
+        lat += rng.uniform(-0.05, 0.05)
+        lon += rng.uniform(-0.05, 0.05)
+        exif_dict["GPS"] = {
+            piexif.GPSIFD.GPSLatitudeRef: b"N" if lat >= 0 else b"S",
+            piexif.GPSIFD.GPSLatitude: to_exif_degrees(abs(lat)),
+            piexif.GPSIFD.GPSLongitudeRef: b"E" if lon >= 0 else b"W",
+            piexif.GPSIFD.GPSLongitude: to_exif_degrees(abs(lon)),
+        }
+    return piexif.dump(exif_dict)
+
+# Function to convert decimal degrees to the EXIF degrees, minutes and seconds rationals
+def to_exif_degrees(value):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round(((value - degrees) * 60 - minutes) * 60 * 1000)
+    return ((degrees, 1), (minutes, 1), (seconds, 1000))
+
+# Function to write an MP4 file with a creation time, make, model and location in its moov atom, and random media data
+def write_video(path, rng, np_rng, video_size):
+    creation_time = int((datetime(2015, 1, 1) - datetime(1904, 1, 1)).total_seconds()) + rng.randrange(10 * 365 * 24 * 3600)
+    name, lat, lon = rng.choice(CITIES)
+    make, model = rng.choice(CAMERAS)
+
+    mvhd = make_atom(b"mvhd", bytes(4) + struct.pack(">II", creation_time, creation_time) + bytes(88))
+    udta = make_atom(b"udta", make_atom(b"\xa9xyz", make_quicktime_string(f"{lat:+.4f}{lon:+09.4f}/".encode()))
+                     + make_atom(b"\xa9mak", make_quicktime_string(make))
+                     + make_atom(b"\xa9mod", make_quicktime_string(model)))
+    with open(path, "wb") as f:
+        f.write(make_atom(b"ftyp", b"isom\x00\x00\x00\x00isom"))
+        # The media data comes before the moov atom, as cameras write it
+        f.write(struct.pack(">I4s", 8 + video_size, b"mdat"))
+        f.write(np_rng.bytes(video_size))
+        f.write(make_atom(b"moov", mvhd + udta))
+
+# Function to make a QuickTime/MP4 atom
+def make_atom(atom_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), atom_type) + payload
+
+# Function to make a QuickTime user data string, with its length and language code
+def make_quicktime_string(text):
+    return struct.pack(">HH", len(text), 0x15c7) + text
+
+# Function to write a GeoNames cities file with CITIES and random cities, in the columns of cities500.txt
+def write_cities_file(path, seed=1):
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        for i, (name, lat, lon) in enumerate(CITIES):
+            f.write(f"{i}\t{name}\t{name}\t\t{lat}\t{lon}\n")
+        for i in range(RANDOM_CITIES):
+            lat, lon = rng.uniform(-60, 70), rng.uniform(-180, 180)
+            f.write(f"{len(CITIES) + i}\tCity{i}\tCity{i}\t\t{lat:.5f}\t{lon:.5f}\n")
+
+# Function to list the files of a folder with their sizes
+def list_files(folder):
+    files = []
+    for root, dirs, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            files.append((path, os.path.getsize(path)))
+    return files
+
+# Function to get the peak resident memory of this process (or of its finished children) in MB
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return round(peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# Function to get the bytes an organizer read (or copied, for moves) so far in a stage
+def get_stage_bytes(organizer, name):
+    return organizer.stage_stats[name]["bytes_read"]
+
+# Function to record the time of a stage and how many files and bytes it processed. The peak memory is of the whole
+# process up to the end of the stage, not of the stage alone.
+def record_stage(results, name, start_time, files, size):
+    seconds = time.perf_counter() - start_time
+    results[name] = {
+        "seconds": round(seconds, 4),
+        "files": files,
+        "bytes": size,
+        "files_per_second": round(files / seconds, 1) if seconds > 0 else None,
+        "mb_per_second": round(size / seconds / 1e6, 1) if seconds > 0 else None,
+        "process_peak_rss_mb": get_peak_rss_mb(),
+    }
+
+# Function to run the stages of TidyMyFiles over a copy of the corpus one after the other, timing each of them.
+# The stages call the same functions as TidyMyFiles.process_batch, but over the whole corpus at once.
+def run_stages(source, destination, cities_file, workers, hash_algorithm):
+    T = TidyMyFiles
+    organizer = T.Organizer(source, destination, geocoder=T.GeoNamesBackend(cities_file), workers=workers,
+                            use_cache=False, hash_algorithm=hash_algorithm)
+    organizer.index_destination_folder()
+    thread_pool, process_pool = organizer.create_pools()
+    results = {}
+
+    # The messages TidyMyFiles prints for every file would be timed too
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            start_time = time.perf_counter()
+            entries = list(organizer.discover_files(source))
+            media = [(entry.path, entry.stat().st_size) for entry in entries if entry.name.lower().endswith(T.MEDIA_EXTENSIONS)]
+            record_stage(results, "walk", start_time, len(entries), 0)
+
+            start_time = time.perf_counter()
+            organizer.index_file_sizes(source)
+            record_stage(results, "size_index", start_time, len(media), 0)
+
+            # The bytes of the hash, EXIF and move stages are the ones TidyMyFiles counts: only the files with the
+            # size of another one are hashed, only the metadata of videos is read, and renames copy nothing
+            start_time, start_bytes = time.perf_counter(), get_stage_bytes(organizer, "hash")
+            paths = [path for path, size in media]
+            sizes = [size for path, size in media]
+            new_sizes = [size for size in set(sizes) if len(organizer.file_sizes.get(size, [])) > 1]
+            organizer.resolved_sizes.update(new_sizes)
+            T.pool_map(thread_pool, organizer.resolve_size_bucket, new_sizes)
+            keys = T.pool_map(thread_pool, organizer.get_content_key, paths, sizes)
+            unique = {}
+            for path, size, key in zip(paths, sizes, keys):
+                unique.setdefault(key, (path, size))
+            record_stage(results, "hash", start_time, len(media), get_stage_bytes(organizer, "hash") - start_bytes)
+            unique_files = list(unique.values())
+
+            start_time, start_bytes = time.perf_counter(), get_stage_bytes(organizer, "exif")
+            unique_paths = [path for path, size in unique_files]
+            metadata = T.pool_map(thread_pool, organizer.get_metadata, unique_paths)
+            record_stage(results, "exif", start_time, len(unique_files), get_stage_bytes(organizer, "exif") - start_bytes)
+
+            start_time = time.perf_counter()
+            images = [(path, size) for path, size in unique_files if path.lower().endswith((".jpg", ".jpeg", ".tiff", ".tif"))]
+            image_paths = [path for path, size in images]
+            chunks = [image_paths[i:i + T.QUALITY_CHUNK_SIZE] for i in range(0, len(image_paths), T.QUALITY_CHUNK_SIZE)]
+            quality_check = partial(T.score_images, fast=True, use_thumbnail=True, brightness_threshold=organizer.brightness_threshold)
+            scores = [score for chunk_scores in T.pool_map(process_pool, quality_check, chunks) for score in chunk_scores]
+            low_quality = {path for path, score in zip(image_paths, scores) if organizer.get_low_quality_reason(*score)}
+            record_stage(results, "quality", start_time, len(images), sum(size for path, size in images))
+
+            start_time = time.perf_counter()
+            coordinates = [(m["lat"], m["lon"]) for m in metadata if m["lat"] is not None and m["lon"] is not None]
+            organizer.prefetch_geocodes(coordinates)
+            for lat, lon in coordinates:
+                organizer.reverse_geocode(lat, lon)
+            record_stage(results, "geocode", start_time, len(coordinates), 0)
+
+            start_time = time.perf_counter()
+            moves = []
+            for path, m in zip(unique_paths, metadata):
+                if path not in low_quality:
+                    move = organizer.organize_file(path, m)
+                    if move is not None:
+                        moves.append(move)
+            record_stage(results, "rename", start_time, len(moves), 0)
+
+            start_time, start_bytes = time.perf_counter(), get_stage_bytes(organizer, "move")
+            organizer.execute_moves(moves)
+            record_stage(results, "move", start_time, len(moves), get_stage_bytes(organizer, "move") - start_bytes)
+        finally:
+            T.shutdown_pools(thread_pool, process_pool)
+
+    return results
+
+# Function to run TidyMyFiles.py from start to end in a separate process, timing it
+def run_end_to_end(source, destination, cities_file, workers, hash_algorithm):
+    files = list_files(source)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "TidyMyFiles.py"),
+               source, destination, "--geocoder", "geonames", "--cities-file", cities_file, "--no-cache",
+               "--workers", str(workers), "--hash-algorithm", hash_algorithm]
+    start_time = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    seconds = time.perf_counter() - start_time
+    size = sum(size for path, size in files)
+    return {
+        "seconds": round(seconds, 4),
+        "files": len(files),
+        "bytes": size,
+        "files_per_second": round(len(files) / seconds, 1),
+        "mb_per_second": round(size / seconds / 1e6, 1),
+        "process_peak_rss_mb": get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+# Function to run the benchmark on a corpus, on fresh copies of it since the files get moved
+def run_benchmark(corpus_folder, workers, hash_algorithm):
+    cities_file = os.path.join(corpus_folder, "cities.txt")
+    results = {
+        "version": RESULTS_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "workers": workers,
+        "hash_algorithm": hash_algorithm,
+    }
+    with open(os.path.join(corpus_folder, "corpus.json")) as f:
+        results["corpus"] = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="tidymyfiles_benchmark_") as work_folder:
+        for name in ("stages", "end_to_end"):
+            source = os.path.join(work_folder, name, "source")
+            destination = os.path.join(work_folder, name, "destination")
+            shutil.copytree(os.path.join(corpus_folder, "source"), source)
+            if name == "stages":
+                results["stages"] = run_stages(source, destination, cities_file, workers, hash_algorithm)
+            else:
+                results["end_to_end"] = run_end_to_end(source, destination, cities_file, workers, hash_algorithm)
+    return results
+
+# Function to print the results of a run as a table
+def print_results(results):
+    print(f"{'stage':<12}{'seconds':>10}{'files':>8}{'files/s':>10}{'MB/s':>8}{'process peak RSS MB':>21}")
+    for name, stage in list(results["stages"].items()) + [("end to end", results["end_to_end"])]:
+        print(f"{name:<12}{stage['seconds']:>10.3f}{stage['files']:>8}{stage['files_per_second'] or 0:>10.1f}"
+              f"{stage['mb_per_second'] or 0:>8.1f}{stage['process_peak_rss_mb']:>21.1f}")
+    print("The peak RSS of a stage is the peak of the benchmark process up to its end, and the end to end one the peak "
+          "of TidyMyFiles.py.")
+
+# Function to print how the times of a run compare to the times of an earlier run
+def compare_results(old_results, new_results):
+    print(f"{'stage':<12}{'old s':>10}{'new s':>10}{'change':>9}")
+    old_stages = dict(old_results["stages"], end_to_end=old_results["end_to_end"])
+    new_stages = dict(new_results["stages"], end_to_end=new_results["end_to_end"])
+    for name, new_stage in new_stages.items():
+        old_stage = old_stages.get(name)
+        if old_stage is None:
+            continue
+        change = (new_stage["seconds"] - old_stage["seconds"]) / old_stage["seconds"] * 100 if old_stage["seconds"] else 0
+        print(f"{name:<12}{old_stage['seconds']:>10.3f}{new_stage['seconds']:>10.3f}{change:>+8.1f}%")
+    if old_results.get("corpus") != new_results.get("corpus"):
+        print("Note: the runs used different corpora.")
+    if old_results.get("hash_algorithm", "sha256") != new_results.get("hash_algorithm", "sha256"):
+        print("Note: the runs used different hash algorithms.")
+
+#4 Script Execution ------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark TidyMyFiles.py on a synthetic corpus of photos and videos.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="generate a corpus in a folder")
+    generate_parser.add_argument("corpus", help="folder to generate the corpus in")
+    generate_parser.add_argument("--photos", type=int, default=500, help="number of photos (default: 500)")
+    generate_parser.add_argument("--image-size", type=int, nargs=2, default=(1600, 1200), metavar=("WIDTH", "HEIGHT"),
+                                 help="size of the photos in pixels (default: 1600 1200)")
+    generate_parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of photos copied (default: 0.1)")
+    generate_parser.add_argument("--dark", type=float, default=0.05, help="fraction of dark photos (default: 0.05)")
+    generate_parser.add_argument("--gps", type=float, default=0.5, help="fraction of photos with GPS (default: 0.5)")
+    generate_parser.add_argument("--videos", type=int, default=20, help="number of videos (default: 20)")
+    generate_parser.add_argument("--video-mb", type=float, default=8, help="size of each video in MB (default: 8)")
+    generate_parser.add_argument("--depth", type=int, default=4, help="depth of the folder tree (default: 4)")
+    generate_parser.add_argument("--seed", type=int, default=1, help="seed of the random generator (default: 1)")
+
+    run_parser = subparsers.add_parser("run", help="time TidyMyFiles.py on a corpus")
+    run_parser.add_argument("corpus", help="folder of a corpus made by the generate command")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="number of threads and processes TidyMyFiles.py uses (default: number of CPUs)")
+    run_parser.add_argument("--hash-algorithm", choices=TidyMyFiles.HASH_ALGORITHMS,
+                            default=TidyMyFiles.DEFAULT_HASH_ALGORITHM,
+                            help=f"hash algorithm TidyMyFiles.py uses (default: {TidyMyFiles.DEFAULT_HASH_ALGORITHM})")
+    run_parser.add_argument("--output", help="JSON file to write the results to")
+
+    compare_parser = subparsers.add_parser("compare", help="compare the results of two runs")
+    compare_parser.add_argument("old", help="JSON results of the earlier run")
+    compare_parser.add_argument("new", help="JSON results of the later run")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        corpus = generate_corpus(
+            os.path.join(args.corpus, "source"), args.photos, tuple(args.image_size), args.duplicates, args.dark,
+            args.gps, args.videos, int(args.video_mb * 1024 * 1024), args.depth, args.seed,
+        )
+        write_cities_file(os.path.join(args.corpus, "cities.txt"), args.seed)
+        with open(os.path.join(args.corpus, "corpus.json"), "w") as f:
+            json.dump(corpus, f, indent=2)
+        print(f"Corpus generated in {args.corpus}")
+
+    elif args.command == "run":
+        results = run_benchmark(args.corpus, max(1, args.workers), args.hash_algorithm)
+        print_results(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+
+    else:
+        with open(args.old) as f:
+            old_results = json.load(f)
+        with open(args.new) as f:
+            new_results = json.load(f)
+        compare_results(old_results, new_results)
+
+# The End!!!
@@ -0,0 +1,153 @@
+import os
+
+import numpy as np
+import piexif
+import pytest
+
+import TidyMyFiles
+
+cv2 = pytest.importorskip('cv2')
+
+
+# Function to write a JPEG photo taken in Paris, with an EXIF comment leaving room for the city name
+def write_paris_photo(path):
+    ok, data = cv2.imencode('.jpg', np.random.default_rng(1).integers(0, 255, (64, 64, 3), dtype=np.uint8))
+    path.write_bytes(data.tobytes())
+    exif = {'0th': {piexif.ImageIFD.Make: b'Canon', piexif.ImageIFD.Model: b'EOS 5D'},
+            'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2022:07:01 10:00:00',
+                     piexif.ExifIFD.UserComment: b'ASCII\x00\x00\x00Holiday' + b' ' * 32},
+            'GPS': {piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (0, 1)),
+                    piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((2, 1), (21, 1), (0, 1))}}
+    piexif.insert(piexif.dump(exif), str(path))
+
+
+@pytest.fixture
+def geocoder(tmp_path):
+    cities_file = tmp_path / 'cities.txt'
+    cities_file.write_text("1\tParis\tParis\t\t48.85341\t2.3488\tP\tPPLC\tFR\t\t\t\t\t\t2138551\t\t0\tEurope/Paris\t"
+                           "2020-01-01\n", encoding='utf-8')
+    return TidyMyFiles.GeoNamesBackend(str(cities_file))
+
+
+# Test that cities are named by their ASCII name, which file names can keep whole
+def test_geonames_uses_ascii_name(tmp_path):
+    cities_file = tmp_path / 'cities.txt'
+    cities_file.write_text("2\tZürich\tZurich\t\t47.36667\t8.55\tP\tPPLA\tCH\t\t\t\t\t\t341730\t\t0\t"
+                           "Europe/Zurich\t2020-01-01\n", encoding='utf-8')
+
+    assert TidyMyFiles.GeoNamesBackend(str(cities_file)).reverse_geocode(47.37, 8.54) == 'Zurich'
+
+
+# Function to organize a source folder into a destination folder, writing city names into the EXIF data
+def organize(source, destination, geocoder):
+    return TidyMyFiles.Organizer(str(source), str(destination), geocoder=geocoder, brightness_threshold=None,
+                                 metadata_mode='exif', verbose=False).run()
+
+
+# Test that the city name is added after the text of the comment once, even when the text contains it
+def test_add_city_to_comment():
+    comment = b'ASCII\x00\x00\x00Parisian' + b' ' * 16
+
+    new_comment = TidyMyFiles.add_city_to_comment(comment, b'Paris')
+
+    assert new_comment == b'ASCII\x00\x00\x00Parisian; Paris'
+    assert TidyMyFiles.add_city_to_comment(new_comment.ljust(len(comment), b'\x00'), b'Paris') \
+        == new_comment.ljust(len(comment), b'\x00')
+
+
+# Test that the city name is written into the organized photo, and that a copy of the original photo is found as a
+# duplicate of it by a later run
+def test_copy_of_geotagged_photo_is_duplicate(tmp_path, geocoder):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_paris_photo(source / 'photo.jpg')
+    original = (source / 'photo.jpg').read_bytes()
+    destination = tmp_path / 'destination'
+
+    organize(source, destination, geocoder)
+    organized = next(destination.rglob('*.jpg'))
+    assert b'Holiday; Paris' in organized.read_bytes()
+    assert not list(destination.rglob('*.xmp'))
+
+    (source / 'photo.jpg').write_bytes(original)
+    summary = organize(source, destination, geocoder)
+
+    assert summary['files_moved'] == 0
+    assert summary['reasons']["Duplicate - Removed"] == 1
+    assert list(destination.rglob('*.jpg')) == [organized]
+
+
+# Test that a photo that can't be moved is left as it was, without the city name
+def test_failed_move_leaves_source_unchanged(tmp_path, geocoder, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_paris_photo(source / 'photo.jpg')
+    original = (source / 'photo.jpg').read_bytes()
+
+    def fail_move(self, file_path, destination_path):
+        raise PermissionError(13, "Permission denied")
+    monkeypatch.setattr(TidyMyFiles.Organizer, 'move_file', fail_move)
+    summary = organize(source, tmp_path / 'destination', geocoder)
+
+    assert summary['files_moved'] == 0
+    assert (source / 'photo.jpg').read_bytes() == original
+
+
+# Test that the city name of a photo that can't be written goes to a sidecar
+def test_unwritable_photo_gets_sidecar(tmp_path, geocoder, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_paris_photo(source / 'photo.jpg')
+
+    def fail_write(image_path, city_name):
+        raise PermissionError(13, "Permission denied")
+    monkeypatch.setattr(TidyMyFiles, 'write_city_to_metadata', fail_write)
+    summary = organize(source, tmp_path / 'destination', geocoder)
+
+    assert summary['files_moved'] == 1
+    organized = next((tmp_path / 'destination').rglob('*.jpg'))
+    assert os.path.exists(f"{organized}.xmp")
+
+
+# Test that removed duplicates of a photo whose kept copy got the city name are audited as ok, whether the copy was
+# kept by the same run or an earlier one, and are restored as they were
+def test_audit_accepts_kept_copy_with_city(tmp_path, geocoder):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_paris_photo(source / 'photo.jpg')
+    original = (source / 'photo.jpg').read_bytes()
+    (source / 'copy.jpg').write_bytes(original)
+    destination = tmp_path / 'destination'
+
+    organize(source, destination, geocoder)
+    (source / 'again.jpg').write_bytes(original)
+    organize(source, destination, geocoder)
+
+    results = TidyMyFiles.check_removals(str(destination))
+    assert [status for entry, kept_path, status in results] == ['ok', 'ok']
+
+    # Restored duplicates get the comment the city name replaced back
+    results = TidyMyFiles.check_removals(str(destination), restore=True)
+    assert [status for entry, kept_path, status in results] == ['restored', 'restored']
+    assert [(source / entry['source']).read_bytes() for entry, kept_path, status in results] == [original, original]
+
+
+# Test that the city name of a photo whose duplicates were replaced with hard links to it goes to a sidecar, leaving
+# the duplicates as they were
+def test_hardlinked_photo_gets_sidecar(tmp_path, geocoder):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_paris_photo(source / 'photo.jpg')
+    original = (source / 'photo.jpg').read_bytes()
+    (source / 'copy.jpg').write_bytes(original)
+    destination = tmp_path / 'destination'
+
+    summary = TidyMyFiles.Organizer(str(source), str(destination), geocoder=geocoder, brightness_threshold=None,
+                                    metadata_mode='exif', duplicate_mode='hardlink', verbose=False).run()
+
+    assert summary['files_moved'] == 1
+    organized = next(destination.rglob('*.jpg'))
+    duplicate = next(source.glob('*.jpg'))
+    assert os.path.samefile(organized, duplicate)
+    assert duplicate.read_bytes() == original
+    assert os.path.exists(f"{organized}.xmp")
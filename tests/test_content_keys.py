@@ -0,0 +1,44 @@
+import hashlib
+import itertools
+
+import pytest
+
+import TidyMyFiles
+
+# Smaller partial hashes, so that files around 2 * PARTIAL_HASH_SIZE bytes stay small
+PARTIAL_HASH_SIZE = 1024
+
+
+# Function to write a file of a size, its copy, and copies of it with one byte changed at the head, in the middle and
+# at the tail, with a second copy of the one changed in the middle
+def write_variants(folder, file_size):
+    content = bytes(i % 251 for i in range(file_size))
+    variants = {'base': content, 'copy': content}
+    if file_size:
+        for name, offset in (('head', 0), ('middle', file_size // 2), ('tail', file_size - 1)):
+            changed = bytearray(content)
+            changed[offset] ^= 0xff
+            variants[name] = bytes(changed)
+        variants['middle_copy'] = variants['middle']
+
+    for name, variant in variants.items():
+        (folder / f"{file_size}_{name}.mp4").write_bytes(variant)
+
+
+# Test that the content keys staged by size, partial hash and full hash tell files apart exactly like their SHA-256
+@pytest.mark.parametrize('file_size', [0, 1, 2 * PARTIAL_HASH_SIZE - 1, 2 * PARTIAL_HASH_SIZE,
+                                       2 * PARTIAL_HASH_SIZE + 1, 3 * PARTIAL_HASH_SIZE])
+def test_content_keys_match_sha256(tmp_path, monkeypatch, file_size):
+    monkeypatch.setattr(TidyMyFiles, 'PARTIAL_HASH_SIZE', PARTIAL_HASH_SIZE)
+    write_variants(tmp_path, file_size)
+    # A file of unique size
+    (tmp_path / 'unique.mp4').write_bytes(b'u' * (file_size + 7))
+    organizer = TidyMyFiles.Organizer(str(tmp_path), str(tmp_path / 'destination'), use_cache=False, verbose=False)
+    organizer.index_file_sizes(str(tmp_path))
+
+    paths = sorted(tmp_path.glob('*.mp4'))
+    keys = {path: organizer.get_content_key(str(path), path.stat().st_size) for path in paths}
+    sha256s = {path: hashlib.sha256(path.read_bytes()).hexdigest() for path in paths}
+
+    for path, other_path in itertools.combinations(paths, 2):
+        assert (keys[path] == keys[other_path]) == (sha256s[path] == sha256s[other_path]), (path.name, other_path.name)
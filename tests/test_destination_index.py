@@ -0,0 +1,92 @@
+import hashlib
+import os
+import random
+
+import pytest
+
+import TidyMyFiles
+
+
+# Function to get the hashes of the contents of the media files in a folder and its sub-folders
+def media_contents(folder):
+    contents = set()
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            if name.lower().endswith(TidyMyFiles.MEDIA_EXTENSIONS):
+                with open(os.path.join(root, name), 'rb') as f:
+                    contents.add(hashlib.sha256(f.read()).hexdigest())
+    return contents
+
+
+# Test that organizing a source folder that is the destination folder, or inside it, removes no file as a duplicate
+# of itself, while a copy of a file organized earlier is still removed
+@pytest.mark.parametrize('layout', ['inside', 'same'])
+def test_source_in_destination_keeps_every_file(tmp_path, layout):
+    destination = tmp_path / 'photos'
+    source = destination / 'inbox' if layout == 'inside' else destination
+    (source / 'trip').mkdir(parents=True)
+    for i in range(3):
+        (source / 'trip' / f"video{i}.mp4").write_bytes(os.urandom(1000 + i))
+    (source / 'trip' / 'copy.mp4').write_bytes((source / 'trip' / 'video0.mp4').read_bytes())
+    contents = media_contents(destination)
+
+    organizer = TidyMyFiles.Organizer(str(source), str(destination), workers=1, brightness_threshold=None,
+                                      verbose=False)
+    summary = organizer.run()
+
+    assert media_contents(destination) == contents
+    assert summary['files_moved'] == 3
+    assert summary['reasons']["Duplicate - Removed"] == 1
+
+    # Running again with a new copy of an organized file never removes the organized file
+    organized = next(destination.rglob('*.mp4'))
+    (source / 'again').mkdir(parents=True, exist_ok=True)
+    (source / 'again' / 'copy.mp4').write_bytes(organized.read_bytes())
+    TidyMyFiles.Organizer(str(source), str(destination), workers=1, brightness_threshold=None, verbose=False).run()
+
+    assert media_contents(destination) == contents
+    assert organized.exists()
+
+
+# Function to pick a new file name the way it was picked before the name index, by listing the folder each time
+def listdir_resolve_duplicate_filename(destination_folder, filename):
+    file_name, file_extension = os.path.splitext(filename)
+    counter = 1
+
+    existing_files = [f for f in os.listdir(destination_folder) if f.startswith(f"{file_name}_")]
+    existing_counters = [int(f.split('_')[-1].split('.')[0]) for f in existing_files if f.split('_')[-1].split('.')[0].isdigit()]
+    if existing_counters:
+        counter = max(existing_counters) + 1
+
+    while os.path.exists(os.path.join(destination_folder, f"{file_name}_{counter}{file_extension}")):
+        counter += 1
+    return f"{file_name}_{counter}{file_extension}"
+
+
+# Function to make a random file name out of a few characters, so that prefixes, suffixes and extensions collide
+def random_filename(rng):
+    stem = ''.join(rng.choice('ab_12.') for _ in range(rng.randint(1, 6)))
+    return stem + rng.choice(['', '.jpg', '.JPG', '.mp4', '.tar.gz'])
+
+
+# Test that the name index picks the same new file names as listing the folder, on random folders, including after
+# the names it picked are taken
+@pytest.mark.parametrize('seed', range(20))
+def test_resolve_duplicate_filename_matches_listdir(tmp_path, seed):
+    rng = random.Random(seed)
+    destination = tmp_path / 'photos'
+    folder = destination / '2021' / '05'
+    folder.mkdir(parents=True)
+    for _ in range(rng.randint(0, 40)):
+        name = random_filename(rng)
+        if name not in ('.', '..'):
+            (folder / name).write_bytes(b'')
+    organizer = TidyMyFiles.Organizer(str(tmp_path / 'source'), str(destination), verbose=False)
+
+    for _ in range(30):
+        filename = random_filename(rng)
+        new_filename = organizer.resolve_duplicate_filename(str(folder), filename)
+        assert new_filename == listdir_resolve_duplicate_filename(str(folder), filename), filename
+
+        (folder / new_filename).write_bytes(b'')
+        organizer.add_destination_name(str(folder), new_filename)
@@ -0,0 +1,21 @@
+import os
+
+import pytest
+
+import TidyMyFiles
+
+
+# Test that a link to a parent folder doesn't loop and that a linked tree is listed only once
+@pytest.mark.skipif(not hasattr(os, 'symlink') or os.name == 'nt', reason="needs symbolic links")
+def test_discover_files_follows_folder_links_once(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'a' / 'b').mkdir(parents=True)
+    (source / 'a' / 'photo.jpg').write_bytes(b'photo')
+    (source / 'a' / 'b' / 'video.mp4').write_bytes(b'video')
+    os.symlink('..', source / 'a' / 'b' / 'loop')
+    os.symlink(source / 'a', source / 'alias')
+
+    organizer = TidyMyFiles.Organizer(str(source), str(tmp_path / 'destination'))
+    names = sorted(entry.name for entry in organizer.discover_files(str(source)))
+
+    assert names == ['photo.jpg', 'video.mp4']
@@ -0,0 +1,62 @@
+import random
+import struct
+
+import numpy as np
+import piexif
+import pytest
+
+import TidyMyFiles
+
+cv2 = pytest.importorskip('cv2')
+
+
+# Function to write a JPEG photo with EXIF data holding a capture date, a camera, GPS coordinates and a thumbnail
+def write_photo(path):
+    ok, data = cv2.imencode('.jpg', np.random.default_rng(1).integers(0, 255, (64, 64, 3), dtype=np.uint8))
+    ok, thumbnail = cv2.imencode('.jpg', np.zeros((8, 8, 3), np.uint8))
+    path.write_bytes(data.tobytes())
+    exif = {'0th': {piexif.ImageIFD.Make: b'Canon', piexif.ImageIFD.Model: b'EOS 5D'},
+            'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2022:07:01 10:00:00', piexif.ExifIFD.PixelXDimension: 64,
+                     piexif.ExifIFD.PixelYDimension: 64},
+            'GPS': {piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (0, 1)),
+                    piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((2, 1), (21, 1), (0, 1))},
+            '1st': {}, 'thumbnail': thumbnail.tobytes()}
+    piexif.insert(piexif.dump(exif), str(path))
+
+
+# Test that photos with corrupted EXIF data are read as having no or partial metadata, instead of raising
+def test_corrupted_exif_never_raises(tmp_path):
+    original = tmp_path / 'original.jpg'
+    write_photo(original)
+    data = original.read_bytes()
+    exif_start = data.index(b'Exif\x00\x00') + 6
+    exif_end = exif_start - 8 + struct.unpack_from('>H', data, exif_start - 8)[0]
+
+    rng = random.Random(1)
+    photo = tmp_path / 'photo.jpg'
+    for i in range(500):
+        corrupted = bytearray(data)
+        for j in range(rng.randint(1, 6)):
+            corrupted[rng.randrange(exif_start, exif_end)] = rng.randrange(256)
+        photo.write_bytes(corrupted)
+
+        metadata = TidyMyFiles.read_metadata(str(photo))
+        TidyMyFiles.load_quality_image(str(photo))
+        assert isinstance(metadata['camera_brand'], str)
+
+
+# Test that an EXIF entry with more values than the EXIF data can hold is refused before piexif allocates them
+def test_check_exif_sizes_refuses_huge_counts():
+    # IFD0 with one Make entry of 2**31 ASCII characters
+    tiff_data = b'II*\x00' + struct.pack('<I', 8) + struct.pack('<HHHII', 1, piexif.ImageIFD.Make, 2, 2 ** 31, 26) + bytes(4)
+
+    with pytest.raises(ValueError):
+        TidyMyFiles.check_exif_sizes(tiff_data)
+
+
+# Test that GPS references that aren't bytes are handled as missing coordinates
+def test_gps_coordinates_with_malformed_reference():
+    gps = {piexif.GPSIFD.GPSLatitudeRef: 78, piexif.GPSIFD.GPSLatitude: ((48, 1), (51, 1), (0, 1)),
+           piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((2, 1), (21, 1))}
+
+    assert TidyMyFiles.get_gps_coordinates({'GPS': gps}) == (None, None)
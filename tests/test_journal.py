@@ -0,0 +1,64 @@
+import json
+
+import TidyMyFiles
+
+
+# Function to write journal entries to the journal of a folder
+def write_journal(folder, entries):
+    with open(folder / TidyMyFiles.JOURNAL_FILENAME, 'w', encoding='utf-8') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+
+# Function to read the entries of the journal archive of a folder
+def read_archive(folder):
+    with open(folder / TidyMyFiles.JOURNAL_ARCHIVE_FILENAME, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+# Test that finished runs are moved to the archive without the entries only needed to resume them, and that the run
+# that may be resumed stays in the journal
+def test_archive_keeps_unfinished_run_in_journal(tmp_path):
+    finished_run = [{'op': 'run', 'run': '1'}, {'op': 'move', 'source': '/a', 'destination': '/b'},
+                    {'op': 'skip', 'source': '/c', 'size': 1, 'mtime_ns': 1, 'reason': "Low brightness"},
+                    {'op': 'moved', 'source': '/a', 'destination': '/b'}, {'op': 'end', 'run': '1'}]
+    unfinished_run = [{'op': 'run', 'run': '2'}, {'op': 'move', 'source': '/d', 'destination': '/e'}]
+    write_journal(tmp_path, finished_run + unfinished_run)
+
+    TidyMyFiles.archive_journal(str(tmp_path), TidyMyFiles.read_journal(str(tmp_path)))
+    # A crash before the journal was trimmed archives the same runs again
+    write_journal(tmp_path, finished_run + unfinished_run)
+    TidyMyFiles.archive_journal(str(tmp_path), TidyMyFiles.read_journal(str(tmp_path)))
+
+    assert [entry['op'] for entry in read_archive(tmp_path)] == ['run', 'moved', 'end']
+    assert TidyMyFiles.read_journal(str(tmp_path)) == unfinished_run
+    assert TidyMyFiles.read_journal(str(tmp_path), archived=True) == \
+        [entry for entry in finished_run if entry['op'] != 'move' and entry['op'] != 'skip'] + unfinished_run
+
+
+# Test that the runs are archived when they finish, and that duplicates removed by a later run are still audited against the copies kept by an earlier one
+def test_finished_runs_are_archived(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'video.mp4').write_bytes(b'v' * 100)
+    destination = tmp_path / 'destination'
+
+    TidyMyFiles.Organizer(str(source), str(destination), brightness_threshold=None, verbose=False).run()
+    (source / 'copy.mp4').write_bytes(b'v' * 100)
+    TidyMyFiles.Organizer(str(source), str(destination), brightness_threshold=None, verbose=False).run()
+
+    assert not (destination / TidyMyFiles.JOURNAL_FILENAME).exists()
+    assert [entry['op'] for entry in read_archive(destination)] == ['run', 'moved', 'end', 'run', 'remove', 'end']
+    assert [status for entry, kept_path, status in TidyMyFiles.check_removals(str(destination))] == ['ok']
+
+
+# Test that a file left in place is journaled once while it is unchanged
+def test_skip_is_journaled_once(tmp_path):
+    (tmp_path / 'photo.jpg').write_bytes(b'photo')
+    organizer = TidyMyFiles.Organizer(str(tmp_path), str(tmp_path / 'destination'), verbose=False)
+    organizer.start_run()
+    organizer.skip_file(str(tmp_path / 'photo.jpg'), "Low brightness")
+    organizer.skip_file(str(tmp_path / 'photo.jpg'), "Low brightness")
+    organizer.finish_run()
+
+    assert [entry['op'] for entry in TidyMyFiles.read_journal(str(tmp_path / 'destination'))] == ['run', 'skip']
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import TidyMyFiles
+
+
+# Test that a file created at the destination path of a move after the destination folder was indexed is kept, and
+# the moved file gets the next free name
+def test_move_never_replaces_file_created_since_indexing(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    content = os.urandom(1000)
+    (source / 'video.mp4').write_bytes(content)
+
+    execute_moves = TidyMyFiles.Organizer.execute_moves
+
+    def create_then_execute_moves(self, moves):
+        for move in moves:
+            os.makedirs(os.path.dirname(move['destination']), exist_ok=True)
+            with open(move['destination'], 'wb') as f:
+                f.write(b'created by another program')
+        execute_moves(self, moves)
+    monkeypatch.setattr(TidyMyFiles.Organizer, 'execute_moves', create_then_execute_moves)
+    summary = TidyMyFiles.Organizer(str(source), str(tmp_path / 'destination'), brightness_threshold=None,
+                                    verbose=False).run()
+
+    assert summary['files_moved'] == 1
+    contents = sorted(path.read_bytes() for path in (tmp_path / 'destination').rglob('*.mp4'))
+    assert contents == sorted([content, b'created by another program'])
+
+
+# Test that a copy across devices never replaces a file at its destination path, and leaves the original in place
+def test_copy_across_devices_never_replaces(tmp_path):
+    original = tmp_path / 'video.mp4'
+    original.write_bytes(b'original')
+    destination = tmp_path / 'moved.mp4'
+    destination.write_bytes(b'existing')
+
+    with pytest.raises(FileExistsError):
+        TidyMyFiles.copy_across_devices(str(original), str(destination))
+
+    assert original.read_bytes() == b'original'
+    assert destination.read_bytes() == b'existing'
+    assert sorted(os.listdir(tmp_path)) == ['moved.mp4', 'video.mp4']
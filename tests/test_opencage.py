@@ -0,0 +1,82 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import TidyMyFiles
+
+pytest.importorskip('opencage')
+pytest.importorskip('requests')
+
+
+# Class of a stub OpenCage server answering 429 to the first request for each location and a city afterwards, and
+# recording when each request arrived and how many were in flight at once
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)['q'][0]
+        with server.lock:
+            server.request_times.append(time.monotonic())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first_request = query not in server.seen_queries
+            server.seen_queries.add(query)
+
+        # Keep the request open a little, so that concurrent requests overlap
+        time.sleep(0.05)
+        if first_request:
+            status, body = 429, {'rate': {'limit': 2500, 'remaining': 0, 'reset': 0}, 'results': []}
+        else:
+            status, body = 200, {'results': [{'components': {'city': f"City {query}"}}]}
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.request_times = []
+    server.seen_queries = set()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Test that locations answered with 429 are tried again, that requests start at most requests_per_second per second,
+# and that no more than concurrency requests are in flight at once
+def test_reverse_geocode_many_retries_and_spacing(stub_server):
+    url = f"http://127.0.0.1:{stub_server.server_address[1]}/geocode/v1/json"
+    requests_per_second = 10
+    geocoder = TidyMyFiles.OpenCageBackend('test-key', url, requests_per_second=requests_per_second, concurrency=2)
+    coordinates = [(48.85, 2.35), (51.5, -0.12), (40.71, -74.0)]
+
+    results = asyncio.run(geocoder.reverse_geocode_many(coordinates))
+
+    assert results == [f"City {lat:.6f},{lon:.6f}" for lat, lon in coordinates]
+    # One 429 and one success for each location
+    assert len(stub_server.request_times) == 2 * len(coordinates)
+    assert stub_server.max_in_flight <= 2
+
+    request_times = sorted(stub_server.request_times)
+    gaps = [later - earlier for earlier, later in zip(request_times, request_times[1:])]
+    # The arrival of a request can lag its start by a few milliseconds
+    assert min(gaps) >= 1 / requests_per_second - 0.02
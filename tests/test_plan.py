@@ -0,0 +1,52 @@
+import json
+import os
+
+import pytest
+
+import TidyMyFiles
+
+
+# Function to plan the organization of a source folder holding a video and a copy of it, returning the plan path
+def plan_duplicate(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    content = os.urandom(2000)
+    (source / 'a.mp4').write_bytes(content)
+    (source / 'b.mp4').write_bytes(content)
+    plan_path = tmp_path / 'plan.jsonl'
+    TidyMyFiles.Organizer(str(source), str(tmp_path / 'destination'), brightness_threshold=None,
+                          plan_path=str(plan_path), verbose=False).run()
+    return source, plan_path
+
+
+# Test that a planned duplicate is left in place when it or its kept copy changed since the plan was made, even with
+# the same size
+@pytest.mark.parametrize('changed', ['duplicate', 'kept', 'missing'])
+def test_apply_keeps_duplicate_that_changed(tmp_path, changed):
+    source, plan_path = plan_duplicate(tmp_path)
+    removal = next(entry for entry in map(json.loads, plan_path.read_text().splitlines()[1:])
+                   if entry['action'] == 'remove')
+    duplicate, kept = source / removal['source'], source / removal['duplicate_of']
+    if changed == 'duplicate':
+        duplicate.write_bytes(os.urandom(2000))
+    elif changed == 'kept':
+        kept.write_bytes(os.urandom(2000))
+    else:
+        kept.unlink()
+    content = duplicate.read_bytes()
+
+    summary = TidyMyFiles.Organizer(None, None, verbose=False).apply_plan(str(plan_path))
+
+    assert summary['reasons']["Changed since the plan was made"] >= 1
+    assert duplicate.read_bytes() == content
+
+
+# Test that an unchanged planned duplicate is removed
+def test_apply_removes_unchanged_duplicate(tmp_path):
+    source, plan_path = plan_duplicate(tmp_path)
+
+    summary = TidyMyFiles.Organizer(None, None, verbose=False).apply_plan(str(plan_path))
+
+    assert summary['reasons']["Duplicate - Removed"] == 1
+    assert summary['files_moved'] == 1
+    assert not list(source.rglob('*.mp4'))
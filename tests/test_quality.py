@@ -0,0 +1,56 @@
+import numpy as np
+import piexif
+import pytest
+
+import TidyMyFiles
+
+cv2 = pytest.importorskip('cv2')
+
+THRESHOLD = TidyMyFiles.DEFAULT_BRIGHTNESS_THRESHOLD
+
+
+# Function to make a grayscale image with a mean gray level close to a level, as flat noise, a gradient or a
+# checkerboard of large squares, whose reduced-size versions average the pixels differently
+def make_image(pattern, level, seed):
+    rng = np.random.default_rng(seed)
+    if pattern == 'noise':
+        image = level + rng.normal(0, 6, (480, 640))
+    elif pattern == 'gradient':
+        image = level + np.linspace(-20, 20, 640)[None, :].repeat(480, axis=0)
+    else:
+        squares = (np.indices((480, 640)) // 37).sum(axis=0) % 2
+        image = level + np.where(squares, 15, -15)
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+
+# Function to write an image as a JPEG photo, with an EXIF thumbnail of it when asked
+def write_photo(path, image, thumbnail):
+    ok, data = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+    path.write_bytes(data.tobytes())
+    if thumbnail:
+        ok, thumbnail_data = cv2.imencode('.jpg', cv2.resize(image, (160, 120), interpolation=cv2.INTER_AREA))
+        exif = {'0th': {}, 'Exif': {piexif.ExifIFD.PixelXDimension: 640, piexif.ExifIFD.PixelYDimension: 480},
+                '1st': {piexif.ImageIFD.JPEGInterchangeFormat: 0, piexif.ImageIFD.JPEGInterchangeFormatLength: 0},
+                'thumbnail': thumbnail_data.tobytes()}
+        piexif.insert(piexif.dump(exif), str(path))
+
+
+# Test that the fast brightness check gives the verdict of the full-resolution one for images whose brightness is
+# within twice BRIGHTNESS_TOLERANCE of the threshold
+@pytest.mark.parametrize('thumbnail', [False, True])
+@pytest.mark.parametrize('pattern', ['noise', 'gradient', 'checkerboard'])
+def test_fast_quality_check_matches_full_near_threshold(tmp_path, pattern, thumbnail):
+    tolerance = TidyMyFiles.BRIGHTNESS_TOLERANCE
+    image_paths = []
+    for i, level in enumerate(np.linspace(THRESHOLD - 2 * tolerance, THRESHOLD + 2 * tolerance, 21)):
+        image_path = tmp_path / f"image{i}.jpg"
+        write_photo(image_path, make_image(pattern, level, i), thumbnail)
+        image_paths.append(str(image_path))
+
+    fast_scores = TidyMyFiles.score_images(image_paths, fast=True, brightness_threshold=THRESHOLD)
+    full_scores = TidyMyFiles.score_images(image_paths, fast=False, brightness_threshold=THRESHOLD)
+
+    # The images are on both sides of the threshold
+    assert {brightness < THRESHOLD for brightness, sharpness, clipping in full_scores} == {True, False}
+    for image_path, fast, full in zip(image_paths, fast_scores, full_scores):
+        assert (fast[0] < THRESHOLD) == (full[0] < THRESHOLD), image_path
@@ -0,0 +1,18 @@
+import TidyMyFiles
+
+
+# Test that each file of the source folder is counted once by the walk, and once by the first walk grouping the files
+# by size
+def test_walk_counts_each_file_once(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'trip').mkdir(parents=True)
+    for i in range(3):
+        (source / 'trip' / f"video{i}.mp4").write_bytes(bytes([i]) * 100)
+    (source / 'notes.txt').write_text("notes")
+
+    organizer = TidyMyFiles.Organizer(str(source), str(tmp_path / 'destination'), brightness_threshold=None,
+                                      verbose=False)
+    organizer.run()
+
+    assert organizer.stage_stats['walk']['calls'] == 4
+    assert organizer.stage_stats['size_index']['calls'] == 4
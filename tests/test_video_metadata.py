@@ -0,0 +1,59 @@
+import datetime
+import struct
+import time
+
+import pytest
+
+import TidyMyFiles
+
+
+# Function to build a QuickTime atom from its type and content
+def atom(atom_type, content):
+    return struct.pack('>I4s', 8 + len(content), atom_type) + content
+
+
+# Function to build a QuickTime user data string
+def quicktime_string(value):
+    data = value.encode()
+    return struct.pack('>HH', len(data), 0) + data
+
+
+# Fixture setting the local time zone to UTC, since the creation time of videos is in UTC and capture dates in local
+# time
+@pytest.fixture
+def utc(monkeypatch):
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+# Test that the metadata of a video is read from the mvhd and udta atoms, without reading the track atoms
+def test_read_video_metadata_skips_tracks(tmp_path, utc):
+    mvhd = atom(b'mvhd', bytes(4) + struct.pack('>I', 3700000000) + bytes(92))
+    udta = atom(b'udta', atom(b'\xa9xyz', quicktime_string('+48.8566+002.3522/'))
+                + atom(b'\xa9mak', quicktime_string('Apple')) + atom(b'\xa9mod', quicktime_string('iPhone 12')))
+    trak = atom(b'trak', bytes(1_000_000))
+    video = tmp_path / 'video.m4v'
+    video.write_bytes(atom(b'ftyp', b'isom' + bytes(4)) + atom(b'mdat', bytes(100_000))
+                      + atom(b'moov', mvhd + trak + udta))
+
+    metadata = TidyMyFiles.read_video_metadata(str(video))
+
+    assert metadata['capture_date'] == datetime.datetime(2021, 3, 31, 1, 46, 40)
+    assert (metadata['lat'], metadata['lon']) == (48.8566, 2.3522)
+    assert (metadata['camera_brand'], metadata['camera_model']) == ('Apple', 'iPhone 12')
+    assert metadata['bytes_read'] < len(mvhd) + len(udta) + 100
+    assert str(video).lower().endswith(TidyMyFiles.MEDIA_EXTENSIONS)
+
+
+# Test that a video with a creation time out of the range of dates is read without a capture date
+def test_read_video_metadata_ignores_garbage_creation_time(tmp_path):
+    mvhd = atom(b'mvhd', bytes([1, 0, 0, 0]) + struct.pack('>QQ', 2 ** 63, 2 ** 63) + bytes(96))
+    video = tmp_path / 'video.mp4'
+    video.write_bytes(atom(b'ftyp', b'isom' + bytes(4)) + atom(b'moov', mvhd))
+
+    metadata = TidyMyFiles.read_video_metadata(str(video))
+
+    assert 'capture_date' not in metadata
@@ -0,0 +1,47 @@
+import time
+
+import TidyMyFiles
+
+
+# Function to stop watching with Ctrl+C the first time the organizer waits for the next poll
+def stop_at_first_wait(seconds):
+    raise KeyboardInterrupt
+
+
+# Function to write files that arrived in a watched folder, old enough to be picked up by the first poll
+def write_arrived_files(source, files):
+    source.mkdir()
+    for filename, content in files.items():
+        (source / filename).write_bytes(content)
+    time.sleep(0.2)
+
+
+# Test that only the arrived files sharing a size are hashed, and that stopping between polls ends the run
+def test_watch_hashes_only_files_sharing_a_size(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    write_arrived_files(source, {'a.mp4': b'a' * 100, 'b.mp4': b'b' * 100, 'c.mp4': b'c' * 200, 'd.mp4': b'a' * 100})
+    organizer = TidyMyFiles.Organizer(str(source), str(destination), brightness_threshold=None, verbose=False)
+
+    monkeypatch.setattr(TidyMyFiles.time, 'sleep', stop_at_first_wait)
+    summary = organizer.watch(0.1)
+
+    assert summary['files_moved'] == 3
+    assert summary['reasons']["Duplicate - Removed"] == 1
+    assert organizer.stage_stats['hash']['bytes_read'] == 300
+    assert TidyMyFiles.find_interrupted_run(TidyMyFiles.read_journal(str(destination))) is None
+
+
+# Test that stopping while files are being organized leaves the run to be resumed
+def test_watch_stopped_while_organizing_can_be_resumed(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    destination = tmp_path / 'destination'
+    write_arrived_files(source, {'a.mp4': b'a' * 100})
+    organizer = TidyMyFiles.Organizer(str(source), str(destination), brightness_threshold=None, verbose=False)
+
+    def stop_while_moving(self, moves):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(TidyMyFiles.Organizer, 'execute_moves', stop_while_moving)
+    organizer.watch(0.1)
+
+    assert TidyMyFiles.find_interrupted_run(TidyMyFiles.read_journal(str(destination))) is not None
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import piexif
+import pytest
+
+import TidyMyFiles
+
+cv2 = pytest.importorskip('cv2')
+
+
+# Function to write a JPEG photo of a brightness, with a capture date and GPS coordinates when given
+def write_photo(path, brightness, seed, date=None, gps=None):
+    image = np.full((48, 64, 3), brightness, np.uint8) + \
+        np.random.default_rng(seed).integers(0, 20, (48, 64, 3), dtype=np.uint8)
+    ok, data = cv2.imencode('.jpg', image)
+    path.write_bytes(data.tobytes())
+    exif = {'0th': {piexif.ImageIFD.Make: b'Canon', piexif.ImageIFD.Model: b'EOS 5D'}, 'Exif': {}, 'GPS': {}}
+    if date:
+        exif['Exif'][piexif.ExifIFD.DateTimeOriginal] = date
+    if gps:
+        exif['GPS'] = {piexif.GPSIFD.GPSLatitudeRef: b'N', piexif.GPSIFD.GPSLatitude: ((gps[0], 1), (0, 1), (0, 1)),
+                       piexif.GPSIFD.GPSLongitudeRef: b'E', piexif.GPSIFD.GPSLongitude: ((gps[1], 1), (0, 1), (0, 1))}
+    piexif.insert(piexif.dump(exif), str(path))
+
+
+# Function to write a source folder with photos of the same days, copies, a dark photo, geotagged photos and videos
+def write_source(source):
+    (source / 'a' / 'b').mkdir(parents=True)
+    (source / 'd').mkdir()
+    for i in range(8):
+        write_photo(source / 'a' / f"img{i}.jpg", 120, i, date=b"2021:05:0%d 10:00:00" % (i % 3 + 1))
+    shutil.copy(source / 'a' / 'img0.jpg', source / 'a' / 'b' / 'copy0.jpg')
+    shutil.copy(source / 'a' / 'img1.jpg', source / 'd' / 'copy1.JPG')
+    write_photo(source / 'd' / 'dark.jpg', 3, 10)
+    for i in range(3):
+        write_photo(source / 'd' / f"paris{i}.jpg", 130, 20 + i, date=b"2022:07:01 1%d:00:00" % i, gps=(49, 2))
+    (source / 'd' / 'video.mp4').write_bytes(b'v' * 10000)
+    (source / 'd' / 'video_copy.mp4').write_bytes(b'v' * 10000)
+    (source / 'd' / 'other.mp4').write_bytes(b'o' * 10000)
+    (source / 'd' / 'notes.txt').write_text("notes")
+    for path in source.rglob('*'):
+        os.utime(path, (1600000000, 1600000000))
+
+
+# Function to get the SHA-256 of each organized file by its path in a destination folder, leaving out the cache and
+# the journal
+def read_tree(destination):
+    return {str(path.relative_to(destination)): hashlib.sha256(path.read_bytes()).hexdigest()
+            for path in destination.rglob('*') if path.is_file() and not path.name.startswith('.tidymyfiles')}
+
+
+# Test that organizing with several workers gives the same destination tree and the same reasons as with one
+def test_workers_give_same_result(tmp_path):
+    cities_file = tmp_path / 'cities.txt'
+    cities_file.write_text("1\tParis\tParis\t\t48.85341\t2.3488\tP\tPPLC\tFR\t\t\t\t\t\t2138551\t\t0\tEurope/Paris\t"
+                           "2020-01-01\n", encoding='utf-8')
+    write_source(tmp_path / 'source')
+
+    trees = []
+    reasons = []
+    for workers in (1, 4):
+        source = tmp_path / f"source{workers}"
+        shutil.copytree(tmp_path / 'source', source)
+        destination = tmp_path / f"destination{workers}"
+        summary = TidyMyFiles.Organizer(str(source), str(destination), workers=workers,
+                                        geocoder=TidyMyFiles.GeoNamesBackend(str(cities_file)), verbose=False).run()
+        trees.append(read_tree(destination))
+        reasons.append(summary['reasons'])
+
+    assert trees[0] == trees[1]
+    assert reasons[0] == reasons[1]
+    assert len(trees[0]) == 16
+    assert reasons[0]["Duplicate - Removed"] == 3